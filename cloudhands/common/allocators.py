@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+#   encoding: UTF-8
+
+import bisect
+import ipaddress
+import logging
+import random
+
+import sqlalchemy.exc
+
+from cloudhands.common.queries import in_network
+from cloudhands.common.schema import IPAddress
+
+__doc__ = """
+The allocators module hands out free addresses from the IP pool of a
+subscription without reading every allocated address on each request.
+"""
+
+
+class IntervalSet(object):
+    """
+    A set of integers held as sorted, disjoint, inclusive intervals. Taking
+    the lowest member is O(1); adding or removing any member is a binary
+    search followed by a list update.
+    """
+
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, n):
+        i = bisect.bisect_right(self.starts, n) - 1
+        return i >= 0 and n <= self.ends[i]
+
+    def __iter__(self):
+        for start, end in zip(self.starts, self.ends):
+            yield from range(start, end + 1)
+
+    def add_interval(self, start, end):
+        """
+        Adds the integers from `start` to `end` inclusive, merging any
+        intervals they overlap or adjoin.
+        """
+        i = bisect.bisect_left(self.ends, start - 1)
+        j = bisect.bisect_right(self.starts, end + 1)
+        merged = 0
+        if i < j:
+            merged = sum(
+                e - s + 1 for s, e in zip(self.starts[i:j], self.ends[i:j]))
+            start = min(start, self.starts[i])
+            end = max(end, self.ends[j - 1])
+        self.starts[i:j] = [start]
+        self.ends[i:j] = [end]
+        self.size += end - start + 1 - merged
+
+    def add(self, n):
+        if n in self:
+            return False
+        self.add_interval(n, n)
+        return True
+
+    def discard(self, n):
+        """
+        Removes `n` from the set, splitting its interval if need be.
+        """
+        i = bisect.bisect_right(self.starts, n) - 1
+        if i < 0 or n > self.ends[i]:
+            return False
+
+        start, end = self.starts[i], self.ends[i]
+        if start == end:
+            del self.starts[i]
+            del self.ends[i]
+        elif n == start:
+            self.starts[i] = n + 1
+        elif n == end:
+            self.ends[i] = n - 1
+        else:
+            self.ends[i] = n - 1
+            self.starts.insert(i + 1, n + 1)
+            self.ends.insert(i + 1, end)
+        self.size -= 1
+        return True
+
+    def first(self):
+        return self.starts[0] if self.starts else None
+
+    def choice(self, rng=random):
+        """
+        Returns a member chosen at random, or None if the set is empty.
+        """
+        if not self.size:
+            return None
+
+        k = rng.randrange(self.size)
+        for start, end in zip(self.starts, self.ends):
+            if k <= end - start:
+                return start + k
+            k -= end - start + 1
+
+
+def key(address):
+    """
+    Maps an address to an integer. The IP version is held in the high
+    bits so that IPv4 and IPv6 addresses never share a key.
+    """
+    address = ipaddress.ip_address(address)
+    return address.version << 128 | int(address)
+
+
+def address(key):
+    if key >> 128 == 4:
+        return ipaddress.IPv4Address(key & (1 << 128) - 1)
+    else:
+        return ipaddress.IPv6Address(key & (1 << 128) - 1)
+
+
+def host_range(network):
+    """
+    Returns the keys of the first and last assignable addresses of
+    `network`. The network address is excluded, as is the broadcast
+    address of an IPv4 network, except where the network is too small
+    to spare them.
+    """
+    first = key(network.network_address)
+    last = key(network.broadcast_address)
+    if network.num_addresses > 2:
+        first += 1
+        if network.version == 4:
+            last -= 1
+    return first, last
+
+
+def hold_transaction(session):
+    """
+    Makes sure the DBAPI connection of `session` is in a transaction. The
+    pysqlite driver begins one only before DML, so a SAVEPOINT issued
+    first would start the transaction itself, and its RELEASE would commit
+    it.
+    """
+    connection = session.connection()
+    if not getattr(connection.connection, "in_transaction", True):
+        connection.execute("BEGIN")
+
+
+class AddressPool(object):
+    """
+    Keeps the free addresses of one or more networks in an
+    :py:class:`IntervalSet`.
+
+    The pool is loaded once with an indexed range scan of the addresses
+    already allocated. After that, each allocation takes the lowest free
+    address without reading the database. Other processes may be
+    allocating from the same networks. The unique constraint on
+    :py:class:`~cloudhands.common.schema.IPAddress` values arbitrates
+    between them. When an address turns out to be taken, it is dropped
+    from the pool and a free address is chosen at random, so that
+    competing processes do not keep colliding.
+    """
+
+    def __init__(self, *networks):
+        self.networks = [ipaddress.ip_network(i) for i in networks]
+        self.free = IntervalSet()
+        self.loaded = False
+
+    def __len__(self):
+        return len(self.free)
+
+    def load(self, session):
+        """
+        Discards the state of the pool and rebuilds it from the database.
+        """
+        self.free = IntervalSet()
+        for net in self.networks:
+            self.free.add_interval(*host_range(net))
+            for (ip,) in in_network(
+                session, IPAddress.packed, net).with_entities(
+                IPAddress.packed):
+                self.free.discard(key(ip))
+        self.loaded = True
+        return self
+
+    def release(self, value):
+        """
+        Returns an address to the pool once its IPAddress has been deleted.
+        """
+        self.free.add(key(value))
+
+    def allocate(
+        self, session, touch, provider=None, retries=8, rng=random):
+        """
+        Creates and flushes an
+        :py:class:`~cloudhands.common.schema.IPAddress` for the next free
+        address, attached to `touch`.
+
+        Pending work in `session` is flushed first. Each attempt is made in
+        a savepoint, so an address taken by another process costs only
+        that attempt. Nothing is committed; that is left to the caller,
+        who should :py:meth:`release` the address if the work is rolled
+        back.
+
+        Returns the IPAddress, or None if the pool is exhausted or
+        `retries` attempts were taken by other processes.
+        """
+        log = logging.getLogger("cloudhands.common.allocators")
+        if not self.loaded:
+            self.load(session)
+
+        session.flush()
+        hold_transaction(session)
+        n = self.free.first()
+        for attempt in range(retries):
+            if n is None:
+                return None
+
+            self.free.discard(n)
+            ip = IPAddress(value=str(address(n)), provider=provider)
+            try:
+                with session.begin_nested():
+                    ip.touch = touch
+                    session.add(ip)
+            except sqlalchemy.exc.IntegrityError as e:
+                log.debug(e)
+                n = self.free.choice(rng)
+            else:
+                return ip
+        return None
+
+
+pools = {}
+"""Address pools in this process, by subscription uuid."""
+
+
+def subscription_pool(session, subscription, *networks):
+    """
+    Returns the address pool of `subscription`, creating and loading it
+    from `networks` on first use. Later calls return the same pool
+    without touching the database.
+    """
+    try:
+        return pools[subscription.uuid]
+    except KeyError:
+        pool = AddressPool(*networks).load(session)
+        return pools.setdefault(subscription.uuid, pool)
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+#   encoding: UTF-8
+
+from collections import OrderedDict
+from collections import defaultdict
+import datetime
+
+import sqlalchemy
+from sqlalchemy import Column
+from sqlalchemy import Index
+from sqlalchemy import MetaData
+from sqlalchemy import and_
+from sqlalchemy import exists
+from sqlalchemy import func
+from sqlalchemy import select
+from sqlalchemy.orm import aliased
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.schema import Table
+
+from cloudhands.common.queries import chunks
+from cloudhands.common.schema import CurrentState
+from cloudhands.common.schema import Resource
+from cloudhands.common.schema import Touch
+from cloudhands.common.schema import later_than
+
+__doc__ = """
+The archival module moves old Touches and their resources out of the hot
+tables into a separate SQLite database, and reads them back on request.
+"""
+
+
+def inheritance(cls):
+    """
+    Returns the tables of a mapped class, base table first.
+    """
+    rv = OrderedDict()
+    for m in reversed(list(cls.__mapper__.iterate_to_root())):
+        rv[m.local_table] = m
+    return list(rv)
+
+
+class TouchArchive(object):
+    """
+    Mirrors the touches, resources and resource subclass tables in an
+    attached SQLite database. The mirror tables carry no foreign keys,
+    since SQLite cannot enforce them across databases.
+
+    Archived Touches are loaded as ordinary
+    :py:class:`~cloudhands.common.schema.Touch` objects, but they are
+    detached from the session once their resources and references have
+    been loaded. They are snapshots, so they will not expire when the
+    session commits.
+    """
+
+    def __init__(self, name="archive"):
+        self.name = name
+        self.metadata = MetaData()
+        hot = [Touch.__table__] + [
+            t for m in Resource.__mapper__.self_and_descendants
+            for t in inheritance(m.class_)]
+        self.tables = OrderedDict(
+            (t, self.mirror(t)) for t in OrderedDict.fromkeys(hot))
+
+        touches = self.tables[Touch.__table__]
+        resources = self.tables[Resource.__table__]
+        Index(
+            "ix_{}_touches_artifact_id_at".format(name),
+            touches.c.artifact_id, touches.c.at)
+        Index(
+            "ix_{}_resources_touch_id".format(name), resources.c.touch_id)
+
+    def mirror(self, table):
+        return Table(
+            table.name, self.metadata,
+            *[Column(c.name, c.type, primary_key=c.primary_key)
+              for c in table.columns],
+            schema=self.name)
+
+    def attach(self, engine, path):
+        """
+        Attaches the SQLite database at `path` to the connections of
+        `engine` and creates the mirror tables in it. This should be done
+        before the engine is in use, since SQLite cannot attach a
+        database within a transaction.
+        """
+        statement = "ATTACH DATABASE ? AS {}".format(self.name)
+
+        def on_connect(dbapi_con, con_record):
+            dbapi_con.execute(statement, (path,))
+
+        sqlalchemy.event.listen(engine, "connect", on_connect)
+        connection = engine.connect()
+        try:
+            attached = [
+                row[1] for row in connection.execute("pragma database_list")]
+            if self.name not in attached:
+                connection.execute(statement, (path,))
+            self.metadata.create_all(connection)
+        finally:
+            connection.close()
+
+    def move(self, session, before):
+        """
+        Moves Touches made before `before`, with their resources, into the
+        archive and commits. `before` may be a datetime or a timedelta
+        giving the retention period.
+
+        The latest Touch of every artifact stays in the hot tables. So do
+        the Touches holding the highest touch and resource ids, so that
+        SQLite never reuses an id which is in the archive.
+
+        Returns the number of Touches archived.
+        """
+        if isinstance(before, datetime.timedelta):
+            before = datetime.datetime.utcnow() - before
+
+        session.flush()
+        connection = session.connection()
+        touches = Touch.__table__
+        resources = Resource.__table__
+        current = CurrentState.__table__
+        topTouch = connection.execute(
+            select([func.max(touches.c.id)])).scalar()
+        topResource = connection.execute(
+            select([func.max(resources.c.id)])).scalar() or 0
+        if topTouch is None:
+            return 0
+
+        candidates = select([touches.c.id]).where(
+            touches.c.at < before).where(
+            touches.c.id < topTouch).where(
+            ~exists().where(current.c.touch_id == touches.c.id)).where(
+            ~exists().where(and_(
+                resources.c.touch_id == touches.c.id,
+                resources.c.id >= topResource)))
+        ids = [row.id for row in connection.execute(candidates)]
+
+        try:
+            for chunk in chunks(ids):
+                owned = select([resources.c.id]).where(
+                    resources.c.touch_id.in_(chunk))
+                criteria = OrderedDict(
+                    (hot, hot.c.id.in_(owned)) for hot in self.tables)
+                criteria[touches] = touches.c.id.in_(chunk)
+                criteria[resources] = resources.c.touch_id.in_(chunk)
+
+                for hot, cold in self.tables.items():
+                    connection.execute(cold.insert().from_select(
+                        [c.name for c in hot.columns],
+                        select(list(hot.columns)).where(criteria[hot])))
+                for hot in reversed(list(self.tables)):
+                    connection.execute(hot.delete().where(criteria[hot]))
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+
+        return len(ids)
+
+    def entity(self, cls):
+        """
+        Returns an alias of the mapped class `cls` which loads from the
+        archive tables.
+        """
+        tables = [self.tables[t] for t in inheritance(cls)]
+        base = tables[0]
+        columns = OrderedDict()
+        join = base
+        for table in tables:
+            if table is not base:
+                join = join.join(table, table.c.id == base.c.id)
+            for col in table.columns:
+                columns.setdefault(col.name, col)
+        query = select(list(columns.values())).select_from(join)
+        return aliased(cls, query.alias(), adapt_on_names=True)
+
+    def touches(self, session, artifact, after=None, limit=None):
+        """
+        Returns the archived Touches of `artifact` in chronological order,
+        with their resources loaded from the archive.
+
+        `after` is a datetime or Touch as accepted by
+        :py:meth:`~cloudhands.common.schema.Artifact.touches_since`.
+        If `limit` is given, only the latest Touches are returned.
+        """
+        entity = self.entity(Touch)
+        query = session.query(entity).filter(
+            entity.artifact_id == artifact.id)
+        if after is not None:
+            query = query.filter(later_than(entity, after))
+        if limit is not None:
+            query = query.order_by(
+                entity.at.desc(), entity.id.desc()).limit(limit)
+            rv = list(reversed(query.all()))
+        else:
+            rv = query.order_by(entity.at, entity.id).all()
+        self.load_resources(session, rv)
+        return self.detach(session, rv)
+
+    def get(self, session, ident):
+        """
+        Returns the archived Touch with id `ident`, or None.
+        """
+        entity = self.entity(Touch)
+        rv = session.query(entity).filter(entity.id == ident).first()
+        if rv is not None:
+            self.load_resources(session, [rv])
+            self.detach(session, [rv])
+        return rv
+
+    def detach(self, session, touches):
+        """
+        Loads the references of archived Touches and their resources, then
+        removes them from the session. This stops a commit from expiring
+        them, since they could not then be refreshed from the hot tables.
+        """
+        for touch in touches:
+            for key in ("artifact", "actor", "state"):
+                getattr(touch, key)
+            for resource in touch.resources:
+                resource.provider
+                set_committed_value(resource, "touch", touch)
+            session.expunge(touch)
+        return touches
+
+    def load_resources(self, session, touches):
+        """
+        Populates the `resources` collection of archived Touches, making
+        one query per resource class present.
+        """
+        table = self.tables[Resource.__table__]
+        byTyp = defaultdict(list)
+        for ids in chunks(i.id for i in touches):
+            for row in session.execute(
+                select([table.c.id, table.c.typ]).where(
+                    table.c.touch_id.in_(ids))):
+                byTyp[row.typ].append(row.id)
+
+        byTouch = defaultdict(list)
+        for typ, ids in byTyp.items():
+            entity = self.entity(
+                Resource.__mapper__.polymorphic_map[typ].class_)
+            for batch in chunks(ids):
+                for obj in session.query(entity).filter(
+                    entity.id.in_(batch)):
+                    byTouch[obj.touch_id].append(obj)
+
+        for touch in touches:
+            set_committed_value(
+                touch, "resources",
+                sorted(byTouch[touch.id], key=lambda x: x.id))
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+#   encoding: UTF-8
+
+import argparse
+from collections import namedtuple
+from collections import OrderedDict
+import datetime
+import logging
+import re
+import sqlite3
+import sys
+
+import sqlalchemy
+from sqlalchemy import event
+from sqlalchemy.orm import sessionmaker
+
+from cloudhands.common import __version__
+from cloudhands.common.connectors import Registry
+from cloudhands.common.connectors import SQLite3Connector
+from cloudhands.common.queries import in_network
+from cloudhands.common.queries import in_state
+from cloudhands.common.schema import metadata
+from cloudhands.common.schema import Actor
+from cloudhands.common.schema import Appliance
+from cloudhands.common.schema import Artifact
+from cloudhands.common.schema import Component
+from cloudhands.common.schema import CurrentState
+from cloudhands.common.schema import IPAddress
+from cloudhands.common.schema import NATRouting
+from cloudhands.common.schema import Provider
+from cloudhands.common.schema import Resource
+from cloudhands.common.schema import State
+from cloudhands.common.schema import Touch
+from cloudhands.common.states import ApplianceState
+
+__doc__ = """
+Runs EXPLAIN QUERY PLAN over a catalogue of the standard queries made of
+the common database and reports any which scan a whole table.
+"""
+
+DFLT_DB = ":memory:"
+
+Check = namedtuple("Check", ["name", "plan", "scans"])
+
+catalogue = OrderedDict([
+    ("artifact by uuid",
+        lambda s: s.query(Artifact).filter(Artifact.uuid == "0" * 32)),
+    ("appliance by uuid",
+        lambda s: s.query(Appliance).filter(Appliance.uuid == "0" * 32)),
+    ("actor by uuid",
+        lambda s: s.query(Actor).filter(Actor.uuid == "0" * 32)),
+    ("provider by uuid",
+        lambda s: s.query(Provider).filter(Provider.uuid == "0" * 32)),
+    ("component by handle",
+        lambda s: s.query(Component).filter(Component.handle == "")),
+    ("state by name",
+        lambda s: s.query(ApplianceState).filter(
+            ApplianceState.name == "")),
+    ("current state of artifact",
+        lambda s: s.query(State).join(
+            CurrentState, CurrentState.state_id == State.id).filter(
+            CurrentState.artifact_id == 0)),
+    ("appliances in state",
+        lambda s: in_state(s, Appliance, State(id=0))),
+    ("history of artifact",
+        lambda s: s.query(Touch).filter(
+            Touch.artifact_id == 0).order_by(Touch.at)),
+    ("latest touch of artifact",
+        lambda s: s.query(Touch).filter(
+            Touch.artifact_id == 0).order_by(
+            Touch.at.desc(), Touch.id.desc()).limit(1)),
+    ("touches of artifact since",
+        lambda s: s.query(Touch).filter(
+            Touch.artifact_id == 0).filter(
+            Touch.at > datetime.datetime.utcnow())),
+    ("touches in state",
+        lambda s: s.query(Touch).filter(Touch.state_id == 0)),
+    ("touches by actor",
+        lambda s: s.query(Touch).filter(Touch.actor_id == 0)),
+    ("resources of touch",
+        lambda s: s.query(Resource).filter(Resource.touch_id == 0)),
+    ("ipaddresses of touch",
+        lambda s: s.query(IPAddress).filter(IPAddress.touch_id == 0)),
+    ("ipaddresses in network",
+        lambda s: in_network(s, IPAddress.packed, "192.168.2.0/24")),
+    ("natroutings in network",
+        lambda s: in_network(s, NATRouting.ip_int_packed, "10.0.0.0/24")),
+    ("resources of artifact",
+        lambda s: s.query(Resource).join(Touch).filter(
+            Touch.artifact_id == 0)),
+])
+"""The catalogue maps a description to a function which builds a query
+given a session. Parameters are dummy values; only the plan matters.
+"""
+
+scan = re.compile(r"^SCAN (?:TABLE )?(?P<table>\w+)")
+
+
+def explain(session, query):
+    """
+    Returns the lines of the SQLite query plan for `query`.
+
+    The statement is compiled and bound in the usual way; it is prefixed
+    with EXPLAIN QUERY PLAN only as it is passed to the cursor.
+    """
+    def prefix(conn, cursor, statement, parameters, context, executemany):
+        return "EXPLAIN QUERY PLAN " + statement, parameters
+
+    connection = session.connection()
+    event.listen(connection, "before_cursor_execute", prefix, retval=True)
+    try:
+        rv = connection.execute(query.statement)
+        return [row[-1] for row in rv.cursor.fetchall()]
+    finally:
+        event.remove(connection, "before_cursor_execute", prefix)
+
+
+def audit(session, catalogue=catalogue):
+    """
+    Generates a :py:class:`Check` for each query in the catalogue. The
+    `scans` attribute lists the tables which the query reads in full.
+    """
+    for name, build in catalogue.items():
+        plan = explain(session, build(session))
+        scans = [m.group("table") for m in (scan.match(i) for i in plan)
+                 if m and m.group("table") not in ("CONSTANT", "SUBQUERY")]
+        yield Check(name, plan, scans)
+
+
+def open_session(path):
+    """
+    Returns a session on the SQLite database at `path` which leaves its
+    schema as it finds it. A database file is opened read-only, so
+    that missing indexes are reported rather than created. An in-memory
+    database has a fresh schema made for it.
+    """
+    url = Registry().url(sqlite3, path)
+    engine = SQLite3Connector().reader(url)
+    if engine is None:
+        engine = sqlalchemy.create_engine("sqlite://")
+        metadata.create_all(engine)
+    return sessionmaker(bind=engine)()
+
+
+def main(args):
+    log = logging.getLogger("cloudhands.common.audit")
+    logging.basicConfig(
+        level=args.log_level,
+        format="%(asctime)s %(levelname)-7s %(name)s|%(message)s")
+
+    session = open_session(args.db)
+    rv = 0
+    for check in audit(session):
+        if check.scans:
+            log.warning("{} scans {}".format(
+                check.name, ", ".join(check.scans)))
+            rv = 1
+        else:
+            log.info("{} OK".format(check.name))
+        for line in check.plan:
+            log.debug(line)
+    return rv
+
+
+def parser(description=__doc__):
+    rv = argparse.ArgumentParser(description=description)
+    rv.add_argument(
+        "--version", action="store_true", default=False,
+        help="Print the current version number")
+    rv.add_argument(
+        "-v", "--verbose", required=False,
+        action="store_const", dest="log_level",
+        const=logging.DEBUG, default=logging.INFO,
+        help="Increase the verbosity of output")
+    rv.add_argument(
+        "--db", default=DFLT_DB,
+        help="Set the path to the database [{}]".format(DFLT_DB))
+    return rv
+
+
+def run():
+    p = parser()
+    args = p.parse_args()
+    if args.version:
+        sys.stdout.write(__version__ + "\n")
+        rv = 0
+    else:
+        rv = main(args)
+    sys.exit(rv)
+
+if __name__ == "__main__":
+    run()
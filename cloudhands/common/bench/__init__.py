@@ -0,0 +1,7 @@
+#!/usr/bin/env python3
+#   encoding: UTF-8
+
+__doc__ = """
+Benchmarks of the workloads which cloudhands places on its database and
+message queues. Each module may be run as a script.
+"""
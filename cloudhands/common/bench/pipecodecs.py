@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+#   encoding: UTF-8
+
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+from cloudhands.common import __version__
+from cloudhands.common.pipes import SimplePipeQueue
+from cloudhands.common.pipes import codecs
+
+__doc__ = """
+Compares the message rates of the PipeQueue codecs. Messages are small
+tuples like those the controllers exchange. Each codec is timed encoding
+and decoding in memory, then passing messages through a FIFO.
+"""
+
+DFLT_N = 20000
+DFLT_BATCH = 100
+
+
+def messages(n):
+    ident = uuid.uuid4().hex
+    return [("touch", ident, "operational", i, 1.5 * i) for i in range(n)]
+
+
+def in_memory(codec, msgs):
+    """
+    Returns the time taken to encode `msgs` and decode them again.
+    """
+    start = time.perf_counter()
+    data = b"".join(codec.encode(i) for i in msgs)
+    rv = codec.decode(bytearray(data))
+    elapsed = time.perf_counter() - start
+    assert rv == msgs
+    return elapsed
+
+
+def through_fifo(name, msgs, path, batch):
+    """
+    Returns the time taken to pass `msgs` through a FIFO. They are sent
+    in batches small enough not to fill the pipe, since one process both
+    writes and reads.
+    """
+    rv = []
+    with SimplePipeQueue(path, history=False, codec=name) as pq:
+        start = time.perf_counter()
+        for i in range(0, len(msgs), batch):
+            for msg in msgs[i:i + batch]:
+                pq.put_nowait(msg)
+            for msg in msgs[i:i + batch]:
+                rv.append(pq.get())
+        elapsed = time.perf_counter() - start
+    assert rv == msgs
+    return elapsed
+
+
+def main(args):
+    log = logging.getLogger("cloudhands.common.bench.pipecodecs")
+    logging.basicConfig(
+        level=args.log_level,
+        format="%(asctime)s %(levelname)-7s %(name)s|%(message)s")
+
+    msgs = messages(args.n)
+    with tempfile.TemporaryDirectory() as locn:
+        path = os.path.join(locn, "bench.fifo")
+        for name in args.codecs:
+            codec = codecs[name]()
+            memory = in_memory(codec, msgs)
+            fifo = through_fifo(name, msgs, path, args.batch)
+            log.info("{:<8} {:>10.0f} msgs/s in memory {:>10.0f} msgs/s "
+                     "through FIFO".format(
+                         name, args.n / memory, args.n / fifo))
+    return 0
+
+
+def parser(description=__doc__):
+    rv = argparse.ArgumentParser(description=description)
+    rv.add_argument(
+        "--version", action="store_true", default=False,
+        help="Print the current version number")
+    rv.add_argument(
+        "-v", "--verbose", required=False,
+        action="store_const", dest="log_level",
+        const=logging.DEBUG, default=logging.INFO,
+        help="Increase the verbosity of output")
+    rv.add_argument(
+        "-n", type=int, default=DFLT_N,
+        help="Set the number of messages [{}]".format(DFLT_N))
+    rv.add_argument(
+        "--batch", type=int, default=DFLT_BATCH,
+        help="Set the messages sent per batch [{}]".format(DFLT_BATCH))
+    rv.add_argument(
+        "codecs", nargs="*", default=sorted(codecs),
+        help="Name the codecs to compare [all]")
+    return rv
+
+
+def run():
+    p = parser()
+    args = p.parse_args()
+    if args.version:
+        sys.stdout.write(__version__ + "\n")
+        rv = 0
+    else:
+        rv = main(args)
+    sys.exit(rv)
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+#   encoding: UTF-8
+
+import argparse
+import logging
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+from cloudhands.common import __version__
+from cloudhands.common.pipes import ChunkedCodec
+from cloudhands.common.pipes import SimplePipeQueue
+
+__doc__ = """
+Times many producer processes writing to one FIFO with the chunked codec,
+and checks that every message arrives intact and in order. Payloads are
+a mix of small tuples and messages larger than PIPE_BUF.
+"""
+
+DFLT_N = 2000
+DFLT_PRODUCERS = 4
+
+mixes = {
+    "small": (0, 0),
+    "mixed": (65536, 0.1),
+    "large": (65536, 1),
+}
+"""Large payload size and the fraction of messages which are large."""
+
+
+def payload(mix, i):
+    size, share = mixes[mix]
+    if share and i % round(1 / share) == 0:
+        return "x" * size
+    return "x" * 16
+
+
+def produce(path, mix, n, inner):
+    codec = ChunkedCodec(inner)
+    with SimplePipeQueue(path, codec=codec, readable=False) as pq:
+        for i in range(n):
+            pq.put_nowait((os.getpid(), i, payload(mix, i)))
+
+
+def measure(path, mix, n, producers, inner):
+    """
+    Returns the time taken for every producer to deliver `n` messages,
+    and the bytes of payload received.
+    """
+    received = {}
+    volume = 0
+    codec = ChunkedCodec(inner)
+    with SimplePipeQueue(path, history=False, codec=codec) as pq:
+        procs = [
+            multiprocessing.Process(
+                target=produce, args=(path, mix, n, inner))
+            for i in range(producers)]
+        start = time.perf_counter()
+        for p in procs:
+            p.start()
+        for i in range(n * producers):
+            pid, seq, data = pq.get()
+            assert seq == received.get(pid, -1) + 1
+            assert data == payload(mix, seq)
+            received[pid] = seq
+            volume += len(data)
+        elapsed = time.perf_counter() - start
+        for p in procs:
+            p.join()
+    return elapsed, volume
+
+
+def main(args):
+    log = logging.getLogger("cloudhands.common.bench.producers")
+    logging.basicConfig(
+        level=args.log_level,
+        format="%(asctime)s %(levelname)-7s %(name)s|%(message)s")
+
+    with tempfile.TemporaryDirectory() as locn:
+        path = os.path.join(locn, "bench.fifo")
+        for mix in args.mixes:
+            for inner in ("marshal", "pickle"):
+                elapsed, volume = measure(
+                    path, mix, args.n, args.producers, inner)
+                log.info(
+                    "{:<6} {:<8} {:>10.0f} msgs/s {:>8.1f} MB/s".format(
+                        mix, inner, args.n * args.producers / elapsed,
+                        volume / elapsed / 1e6))
+    return 0
+
+
+def parser(description=__doc__):
+    rv = argparse.ArgumentParser(description=description)
+    rv.add_argument(
+        "--version", action="store_true", default=False,
+        help="Print the current version number")
+    rv.add_argument(
+        "-v", "--verbose", required=False,
+        action="store_const", dest="log_level",
+        const=logging.DEBUG, default=logging.INFO,
+        help="Increase the verbosity of output")
+    rv.add_argument(
+        "-n", type=int, default=DFLT_N,
+        help="Set the number of messages per producer [{}]".format(DFLT_N))
+    rv.add_argument(
+        "--producers", type=int, default=DFLT_PRODUCERS,
+        help="Set the number of producer processes [{}]".format(
+            DFLT_PRODUCERS))
+    rv.add_argument(
+        "mixes", nargs="*", default=sorted(mixes),
+        help="Name the payload mixes to run [all]")
+    return rv
+
+
+def run():
+    p = parser()
+    args = p.parse_args()
+    if args.version:
+        sys.stdout.write(__version__ + "\n")
+        rv = 0
+    else:
+        rv = main(args)
+    sys.exit(rv)
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+#   encoding: UTF-8
+
+import argparse
+import datetime
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import uuid
+
+from cloudhands.common import __version__
+from cloudhands.common.connectors import initialise
+from cloudhands.common.connectors import Registry
+from cloudhands.common.connectors import SQLite3Connector
+from cloudhands.common.schema import Appliance
+from cloudhands.common.schema import Component
+from cloudhands.common.schema import Organisation
+from cloudhands.common.schema import Provider
+from cloudhands.common.schema import ProviderReport
+from cloudhands.common.schema import Touch
+from cloudhands.common.states import ApplianceState
+
+__doc__ = """
+Times the Touch write workload of a controller against each SQLite
+performance profile. Every Touch carries one resource and is committed on
+its own, as the controllers do.
+"""
+
+DFLT_N = 1000
+
+
+def workload(session, n):
+    """
+    Makes `n` Touches against one Appliance, committing each. Returns the
+    elapsed time in seconds.
+    """
+    org = Organisation(
+        uuid=uuid.uuid4().hex, name="bench-{}".format(uuid.uuid4().hex))
+    actor = Component(handle="bench.{}".format(uuid.uuid4().hex),
+                      uuid=uuid.uuid4().hex)
+    provider = Provider(name="bench", uuid=uuid.uuid4().hex)
+    app = Appliance(uuid=uuid.uuid4().hex, model="bench", organisation=org)
+    session.add_all((org, actor, provider, app))
+    session.commit()
+
+    states = [ApplianceState.get(session, i)
+              for i in ("requested", "configuring")]
+    start = time.perf_counter()
+    for i in range(n):
+        touch = Touch(
+            artifact=app, actor=actor, state=states[i % 2],
+            at=datetime.datetime.utcnow())
+        session.add(ProviderReport(
+            creation="bench", touch=touch, provider=provider))
+        session.commit()
+    return time.perf_counter() - start
+
+
+def measure(profile, n, path):
+    r = Registry()
+    con = r.connect(sqlite3, path, profile=profile)
+    try:
+        initialise(con.session)
+        return workload(con.session, n)
+    finally:
+        con.session.close()
+        r.disconnect(sqlite3, path)
+
+
+def main(args):
+    log = logging.getLogger("cloudhands.common.bench.profiles")
+    logging.basicConfig(
+        level=args.log_level,
+        format="%(asctime)s %(levelname)-7s %(name)s|%(message)s")
+
+    for profile in args.profiles:
+        with tempfile.TemporaryDirectory() as locn:
+            path = os.path.join(locn, "bench.sl3")
+            elapsed = measure(profile, args.n, path)
+        log.info("{:<10} {:>8.1f} touches/s".format(
+            profile or "default", args.n / elapsed))
+    return 0
+
+
+def parser(description=__doc__):
+    rv = argparse.ArgumentParser(description=description)
+    rv.add_argument(
+        "--version", action="store_true", default=False,
+        help="Print the current version number")
+    rv.add_argument(
+        "-v", "--verbose", required=False,
+        action="store_const", dest="log_level",
+        const=logging.DEBUG, default=logging.INFO,
+        help="Increase the verbosity of output")
+    rv.add_argument(
+        "-n", type=int, default=DFLT_N,
+        help="Set the number of Touches to write [{}]".format(DFLT_N))
+    rv.add_argument(
+        "profiles", nargs="*",
+        default=[None] + sorted(SQLite3Connector.profiles),
+        help="Name the profiles to compare [all]")
+    return rv
+
+
+def run():
+    p = parser()
+    args = p.parse_args()
+    if args.version:
+        sys.stdout.write(__version__ + "\n")
+        rv = 0
+    else:
+        rv = main(args)
+    sys.exit(rv)
+
+if __name__ == "__main__":
+    run()
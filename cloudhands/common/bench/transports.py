@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+#   encoding: UTF-8
+
+import argparse
+from collections import OrderedDict
+import logging
+import multiprocessing
+import os
+import select
+import sys
+import tempfile
+import time
+
+from cloudhands.common import __version__
+from cloudhands.common.pipes import SimplePipeQueue
+from cloudhands.common.pipes import SimpleRingQueue
+from cloudhands.common.pipes import SimpleSocketQueue
+
+__doc__ = """
+Compares the transports of the pipes module. Producer processes send
+timestamped messages through each in turn; the reader reports throughput
+and the percentiles of latency from send to receipt.
+"""
+
+DFLT_N = 5000
+DFLT_PRODUCERS = 2
+DFLT_SIZE = 64
+
+transports = OrderedDict([
+    ("fifo", SimplePipeQueue),
+    ("socket", SimpleSocketQueue),
+    ("ring", SimpleRingQueue),
+])
+
+
+def produce(cls, path, n, size):
+    data = "x" * size
+    with cls(path, codec="marshal", readable=False) as pq:
+        for i in range(n):
+            # perf_counter reads a clock shared by all processes on Linux
+            pq.put_nowait((os.getpid(), i, time.perf_counter(), data))
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def measure(cls, path, n, producers, size):
+    """
+    Returns the time taken for every producer to deliver `n` messages,
+    and the sorted latencies of the messages in seconds.
+    """
+    latencies = []
+    with cls(path, history=False, codec="marshal") as pq:
+        procs = [
+            multiprocessing.Process(
+                target=produce, args=(cls, path, n, size))
+            for i in range(producers)]
+        start = time.perf_counter()
+        for p in procs:
+            p.start()
+        for i in range(n * producers):
+            pid, seq, sent, data = pq.get()
+            latencies.append(time.perf_counter() - sent)
+        elapsed = time.perf_counter() - start
+        for p in procs:
+            p.join()
+    return elapsed, sorted(latencies)
+
+
+def main(args):
+    log = logging.getLogger("cloudhands.common.bench.transports")
+    logging.basicConfig(
+        level=args.log_level,
+        format="%(asctime)s %(levelname)-7s %(name)s|%(message)s")
+
+    if args.size + 32 > select.PIPE_BUF:
+        log.warning("Messages larger than PIPE_BUF may interleave on a FIFO")
+
+    with tempfile.TemporaryDirectory() as locn:
+        for name in args.transports:
+            path = os.path.join(locn, "bench." + name)
+            elapsed, latencies = measure(
+                transports[name], path, args.n, args.producers, args.size)
+            log.info(
+                "{:<6} {:>10.0f} msgs/s "
+                "p50 {:>8.1f} us p99 {:>8.1f} us".format(
+                    name, len(latencies) / elapsed,
+                    percentile(latencies, 50) * 1e6,
+                    percentile(latencies, 99) * 1e6))
+    return 0
+
+
+def parser(description=__doc__):
+    rv = argparse.ArgumentParser(description=description)
+    rv.add_argument(
+        "--version", action="store_true", default=False,
+        help="Print the current version number")
+    rv.add_argument(
+        "-v", "--verbose", required=False,
+        action="store_const", dest="log_level",
+        const=logging.DEBUG, default=logging.INFO,
+        help="Increase the verbosity of output")
+    rv.add_argument(
+        "-n", type=int, default=DFLT_N,
+        help="Set the number of messages per producer [{}]".format(DFLT_N))
+    rv.add_argument(
+        "--producers", type=int, default=DFLT_PRODUCERS,
+        help="Set the number of producer processes [{}]".format(
+            DFLT_PRODUCERS))
+    rv.add_argument(
+        "--size", type=int, default=DFLT_SIZE,
+        help="Set the payload size in bytes [{}]".format(DFLT_SIZE))
+    rv.add_argument(
+        "transports", nargs="*", default=list(transports),
+        help="Name the transports to run [all]")
+    return rv
+
+
+def run():
+    p = parser()
+    args = p.parse_args()
+    if args.version:
+        sys.stdout.write(__version__ + "\n")
+        rv = 0
+    else:
+        rv = main(args)
+    sys.exit(rv)
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+#   encoding: UTF-8
+
+from collections import OrderedDict
+import datetime
+
+from sqlalchemy import func
+from sqlalchemy import inspect
+from sqlalchemy import select
+from sqlalchemy.orm.interfaces import MANYTOONE
+
+from cloudhands.common.schema import Resource
+from cloudhands.common.schema import Touch
+from cloudhands.common.schema import advance_current_state
+
+__doc__ = """
+The bulk module writes Touches and their resources in batches. It bypasses
+the ORM unit of work, issuing one executemany INSERT per table instead of
+one statement per object.
+"""
+
+
+def identify(obj):
+    """
+    Returns the primary key of a persistent object. Integers are passed
+    through so that callers may supply ids directly.
+    """
+    if obj is None or isinstance(obj, int):
+        return obj
+
+    rv = inspect(obj).identity
+    if rv is None:
+        raise ValueError("{!r} is not persistent".format(obj))
+    return rv[0]
+
+
+def next_id(connection, table):
+    return (connection.execute(
+        select([func.max(table.c.id)])).scalar() or 0) + 1
+
+
+def columns(obj):
+    """
+    Generates (table, values) for each table in the inheritance hierarchy
+    of `obj`, base table first. Primary keys and `touch_id` are left for
+    the caller to fill in.
+    """
+    mapper = inspect(obj).mapper
+    tables = OrderedDict(
+        (m.local_table, m) for m in reversed(list(mapper.iterate_to_root())))
+    related = {
+        local: (rel.key, remote)
+        for rel in mapper.relationships if rel.direction is MANYTOONE
+        for local, remote in rel.local_remote_pairs}
+
+    for table in tables:
+        values = {}
+        for col in table.columns:
+            if col.primary_key or col.name == "touch_id":
+                continue
+            elif col is mapper.polymorphic_on:
+                values[col.name] = mapper.polymorphic_identity
+                continue
+
+            value = getattr(obj, mapper.get_property_by_column(col).key)
+            if value is None and col in related:
+                key, remote = related[col]
+                target = getattr(obj, key)
+                if target is not None:
+                    value = identify(target)
+            values[col.name] = value
+        yield table, values
+
+
+def append(session, records):
+    """
+    Writes a batch of Touches together with their resources and commits
+    them in a single transaction.
+
+    Each record is a tuple of (artifact, actor, state, resources) with an
+    optional fifth element giving the time of the Touch. Artifacts, actors
+    and states must be persistent or given as ids. Resources are transient
+    instances of :py:class:`~cloudhands.common.schema.Resource` subclasses;
+    they are not added to the session.
+
+    The first Touch is inserted alone. That takes the database write lock,
+    so the remaining ids can be allocated from the table maxima.
+
+    Returns the list of new Touch ids, in record order.
+    """
+    records = list(records)
+    if not records:
+        return []
+
+    session.flush()
+    now = datetime.datetime.utcnow()
+    connection = session.connection()
+    touches = Touch.__table__
+    try:
+        rows = [
+            dict(artifact_id=identify(r[0]), actor_id=identify(r[1]),
+                 state_id=identify(r[2]), at=r[4] if len(r) > 4 else now)
+            for r in records]
+        connection.execute(touches.insert(), rows[0])
+        base = next_id(connection, touches) - 1
+        for n, row in enumerate(rows):
+            row["id"] = base + n
+        if len(rows) > 1:
+            connection.execute(touches.insert(), rows[1:])
+
+        batches = OrderedDict()
+        resourceId = next_id(connection, Resource.__table__)
+        for row, record in zip(rows, records):
+            for obj in record[3]:
+                for table, values in columns(obj):
+                    values["id"] = resourceId
+                    if "touch_id" in table.c:
+                        values["touch_id"] = row["id"]
+                    batches.setdefault(table, []).append(values)
+                resourceId += 1
+
+        for table, values in batches.items():
+            connection.execute(table.insert(), values)
+
+        latest = {}
+        for row in rows:
+            held = latest.get(row["artifact_id"])
+            if held is None or (
+                (row["at"], row["id"]) > (held["at"], held["id"])):
+                latest[row["artifact_id"]] = row
+        latest.pop(None, None)
+        for artifact_id, row in latest.items():
+            advance_current_state(
+                connection, artifact_id, row["state_id"], row["id"], row["at"])
+
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+
+    return [row["id"] for row in rows]
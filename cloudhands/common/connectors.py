@@ -1,30 +1,309 @@
 #!/usr/bin/env python3
 #   encoding: UTF-8
 
+import asyncio
 from collections import namedtuple
-from itertools import chain
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import hashlib
 import logging
+import random
 import sqlite3
+import time
+import urllib.parse
 import uuid
 
 import sqlalchemy
+import sqlalchemy.exc
+from sqlalchemy import CHAR
+from sqlalchemy import Column
+from sqlalchemy import MetaData
+from sqlalchemy import Table
+from sqlalchemy import and_
+from sqlalchemy import select
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.pool import StaticPool
+from sqlalchemy.schema import CreateIndex
+from sqlalchemy.schema import CreateTable
+from sqlalchemy.util import LRUCache
 
 from cloudhands.common.components import burstCtrl  # TODO: Entry point
 from cloudhands.common.components import identityCtrl  # TODO: Entry point
 from cloudhands.common.discovery import fsms
 
 from cloudhands.common.schema import metadata
+from cloudhands.common.schema import Actor
 from cloudhands.common.schema import Component
+from cloudhands.common.schema import CurrentState
 from cloudhands.common.schema import State
+from cloudhands.common.schema import rebuild_current_states
+from cloudhands.common.schema import upgrade_packed_addresses
 
 Connection = namedtuple("Connection", ["module", "path", "engine", "session"])
 
+fingerprints = Table(
+    "schemafingerprints", MetaData(),
+    Column("fingerprint", CHAR(length=40), primary_key=True))
+"""Holds the fingerprint of the schema last created in a database. It is
+kept apart from the common metadata so as not to alter the fingerprint.
+"""
 
-class SQLite3Connector(object):
+
+def schema_fingerprint(metadata, dialect, cache={}):
+    """
+    Returns a SHA-1 digest of the DDL which `metadata` generates for
+    `dialect`. Digests are cached for the life of the process, so long as
+    no tables are added.
+    """
+    key = (metadata, dialect.name, tuple(metadata.tables))
+    if key in cache:
+        return cache[key]
+
+    hsh = hashlib.sha1()
+    for table in metadata.sorted_tables:
+        hsh.update(str(CreateTable(table).compile(dialect=dialect)).encode())
+        for index in sorted(table.indexes, key=lambda x: str(x.name)):
+            hsh.update(
+                str(CreateIndex(index).compile(dialect=dialect)).encode())
+    return cache.setdefault(key, hsh.hexdigest())
+
+
+def schema_shortfall(connection, metadata=metadata):
+    """
+    Returns the columns and indexes which `metadata` declares but the
+    database lacks, as a list of names like 'touches.at'. Tables which
+    are missing altogether are not reported.
+    """
+    inspector = sqlalchemy.inspect(connection)
+    held = set(inspector.get_table_names())
+    rv = []
+    for table in metadata.sorted_tables:
+        if table.name not in held:
+            continue
+        columns = {i["name"] for i in inspector.get_columns(table.name)}
+        indexes = {i["name"] for i in inspector.get_indexes(table.name)}
+        rv.extend(
+            "{}.{}".format(table.name, i.name) for i in table.columns
+            if i.name not in columns)
+        rv.extend(
+            "{}.{}".format(table.name, i.name) for i in table.indexes
+            if i.name not in indexes)
+    return rv
+
+
+def create_indexes(connection, metadata=metadata):
+    """
+    Creates the indexes which `metadata` declares on tables that existed
+    before the index was added to the schema. Returns the number created.
+    """
+    inspector = sqlalchemy.inspect(connection)
+    held = set(inspector.get_table_names())
+    n = 0
+    for table in metadata.sorted_tables:
+        if table.name not in held:
+            continue
+        indexes = {i["name"] for i in inspector.get_indexes(table.name)}
+        for index in sorted(table.indexes, key=lambda x: str(x.name)):
+            if index.name not in indexes:
+                index.create(connection)
+                n += 1
+    return n
+
+
+def create_schema(engine, metadata=metadata):
+    """
+    Creates the schema in the database of `engine` unless its stored
+    fingerprint shows it to be up to date. An up to date database costs a
+    single query.
+
+    Tables which exist already are not altered by `create_all`, so their
+    new columns are added by upgrade steps, and their missing indexes are
+    created separately. The fingerprint is stored only if the database
+    then holds every column and index of the schema; otherwise a warning
+    is logged and the work is attempted again on the next connection.
+
+    When the current state projection is added to a database which holds
+    Touches already, it is built from their history.
+
+    Returns True if DDL was run.
+    """
+    log = logging.getLogger("cloudhands.common.schema")
+    fingerprint = schema_fingerprint(metadata, engine.dialect)
+    try:
+        stored = engine.execute(
+            select([fingerprints.c.fingerprint])).scalar()
+    except sqlalchemy.exc.DBAPIError:
+        stored = None
+
+    if stored == fingerprint:
+        return False
+
+    with engine.begin() as connection:
+        held = set(sqlalchemy.inspect(connection).get_table_names())
+        metadata.create_all(connection)
+        projection = CurrentState.__table__
+        if (projection.name in metadata.tables and
+                projection.name not in held and "touches" in held):
+            n = rebuild_current_states(connection)
+            log.info("Projected current state of {} artifacts".format(n))
+        n = upgrade_packed_addresses(connection)
+        if n:
+            log.info("Packed {} addresses".format(n))
+        n = create_indexes(connection, metadata)
+        if n:
+            log.info("Created {} indexes".format(n))
+        missing = schema_shortfall(connection, metadata)
+        if missing:
+            log.warning("Schema is out of date. Missing {}".format(
+                ", ".join(missing)))
+        else:
+            fingerprints.create(connection, checkfirst=True)
+            connection.execute(fingerprints.delete())
+            connection.execute(
+                fingerprints.insert(), fingerprint=fingerprint)
+    return True
+
+
+class Connector(object):
+    """
+    A functor which creates a SQLAlchemy engine for a database URL. It
+    serves any dialect which needs no special configuration.
+
+    Keyword arguments tune the engine:
+
+    pool_size, max_overflow, pool_timeout
+        Size the connection pool. The dialect's default pool is used
+        when `pool_size` is not given.
+    statement_cache_size
+        Keeps that many compiled statements in an LRU cache per engine.
+    isolation_level
+        Sets the transaction isolation level of every connection.
+    execution_options
+        A dictionary of default execution options for the engine.
+
+    Other keyword arguments are passed to
+    :py:func:`sqlalchemy.create_engine` as they are.
+    """
+
+    def __init__(
+        self, pool_size=None, max_overflow=0, pool_timeout=30,
+        statement_cache_size=None, isolation_level=None,
+        execution_options=None, **kwargs
+    ):
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.pool_timeout = pool_timeout
+        self.statement_cache_size = statement_cache_size
+        self.isolation_level = isolation_level
+        self.execution_options = dict(execution_options or {})
+        self.kwargs = kwargs
+
+    def pool_args(self, url):
+        if self.pool_size is None:
+            return {}
+        else:
+            return {
+                "poolclass": QueuePool,
+                "pool_size": self.pool_size,
+                "max_overflow": self.max_overflow,
+                "pool_timeout": self.pool_timeout,
+            }
+
+    def engine_args(self, url, module=None):
+        rv = dict(self.kwargs)
+        rv.update(self.pool_args(url))
+        if module is not None:
+            rv["module"] = module
+        if self.isolation_level is not None:
+            rv["isolation_level"] = self.isolation_level
+
+        options = dict(self.execution_options)
+        if self.statement_cache_size is not None:
+            options["compiled_cache"] = LRUCache(self.statement_cache_size)
+        if options:
+            rv["execution_options"] = options
+        return rv
+
+    def configure(self, engine):
+        """
+        Override to register event listeners on a new engine.
+        """
+        pass
+
+    def reader(self, url, module=None):
+        """
+        Returns a separate engine for read-only work on the database at
+        `url`, or None if the dialect offers none.
+        """
+        return None
+
+    def __call__(self, url, module=None):
+        """
+        Creates, configures and returns a SQLAlchemy engine connected
+        to the database at `url`. The schema is created if it is missing
+        or has changed.
+        """
+        engine = sqlalchemy.create_engine(
+            url, **self.engine_args(url, module))
+        self.configure(engine)
+        metadata.bind = engine
+        create_schema(engine)
+        return engine
+
+
+class SQLite3Connector(Connector):
     """
     A functor which sets up a SQLALchemy connection to a SQLite3 database.
+
+    A named performance profile may be given. Its pragmas are applied to
+    every new connection, in the order they are declared.
+
+    By default the engine holds a single connection which every thread
+    shares. Giving a `pool_size` selects pooled mode instead: each thread
+    checks out a connection of its own, up to `pool_size` plus
+    `max_overflow` at once, waiting at most `pool_timeout` seconds for one
+    to come free. Pooled mode needs a database file; an in-memory database
+    is private to its connection and so cannot be pooled.
+
+    The `statement_cache_size` also sizes the prepared statement cache of
+    the sqlite3 module.
+
+    Read-only engines open the database file again with a `mode=ro` URI,
+    and set the query_only pragma. They are always pooled, with
+    `pool_size` connections or four if none is given.
+    """
+
+    profiles = {
+        "durable": OrderedDict([
+            ("journal_mode", "WAL"),
+            ("synchronous", "FULL"),
+            ("cache_size", -16384),
+            ("temp_store", "DEFAULT"),
+            ("busy_timeout", 5000),
+        ]),
+        "balanced": OrderedDict([
+            ("journal_mode", "WAL"),
+            ("synchronous", "NORMAL"),
+            ("cache_size", -65536),
+            ("mmap_size", 268435456),
+            ("temp_store", "MEMORY"),
+            ("busy_timeout", 5000),
+        ]),
+        "bulk-load": OrderedDict([
+            ("journal_mode", "WAL"),
+            ("synchronous", "OFF"),
+            ("cache_size", -262144),
+            ("mmap_size", 1073741824),
+            ("temp_store", "MEMORY"),
+            ("busy_timeout", 30000),
+        ]),
+    }
+    """Pragmas by profile name. Negative cache sizes are in KiB.
+    WAL lets readers proceed while a controller writes; `synchronous`
+    trades durability on power loss for commit latency.
     """
 
     @staticmethod
@@ -35,66 +314,419 @@ class SQLite3Connector(object):
     def on_connect(dbapi_con, con_record):
         SQLite3Connector.sqlite_fk_pragma(dbapi_con, con_record)
 
-    def __call__(self, module, path):
+    def __init__(self, profile=None, **kwargs):
+        super().__init__(**kwargs)
+        self.profile = profile
+        self.pragmas = self.profiles[profile] if profile else OrderedDict()
+
+    def sqlite_profile_pragmas(self, dbapi_con, con_record):
+        for key, value in self.pragmas.items():
+            dbapi_con.execute("pragma {}={}".format(key, value))
+
+    @staticmethod
+    def sqlite_query_only_pragma(dbapi_con, con_record):
+        dbapi_con.execute("pragma query_only=ON")
+
+    def pool_args(self, url):
+        if self.pool_size is None:
+            return {"poolclass": StaticPool}
+        elif url.database in (None, "", ":memory:"):
+            raise ValueError("In-memory databases cannot be pooled")
+        else:
+            return super().pool_args(url)
+
+    def engine_args(self, url, module=None):
+        rv = super().engine_args(url, module)
+        connect_args = dict(rv.get("connect_args", {}))
+        connect_args["check_same_thread"] = False
+        if self.statement_cache_size is not None:
+            connect_args["cached_statements"] = self.statement_cache_size
+        rv["connect_args"] = connect_args
+        return rv
+
+    def configure(self, engine):
+        sqlalchemy.event.listen(engine, "connect", self.on_connect)
+        sqlalchemy.event.listen(
+            engine, "connect", self.sqlite_profile_pragmas)
+
+    def reader(self, url, module=None):
         """
-        Creates, configures and returns a SQLAlchemy engine connected
-        to a SQLite3 database.
+        Returns an engine whose connections can only read the database
+        file at `url`, or None for an in-memory database, which no other
+        connection can see.
         """
-        #TODO: use sqlalchemy.engine.url.URL
-        sqlaPath = "sqlite:///" + path
-        engine = sqlalchemy.create_engine(
-            sqlaPath, module=module, poolclass=StaticPool,
-            connect_args={"check_same_thread": False})
-        sqlalchemy.event.listen(engine, "connect", self.on_connect)
-        metadata.bind = engine
-        metadata.create_all()
+        if url.database in (None, "", ":memory:"):
+            return None
+
+        module = module or sqlite3
+        uri = "file:{}?mode=ro".format(urllib.parse.quote(url.database))
+        args = self.engine_args(url)
+        connect_args = args.pop("connect_args")
+        args.update({
+            "creator": lambda: module.connect(uri, uri=True, **connect_args),
+            "poolclass": QueuePool,
+            "pool_size": self.pool_size or 4,
+            "max_overflow": self.max_overflow,
+            "pool_timeout": self.pool_timeout,
+        })
+        engine = sqlalchemy.create_engine("sqlite://", **args)
+        self.configure(engine)
+        sqlalchemy.event.listen(
+            engine, "connect", self.sqlite_query_only_pragma)
         return engine
 
 
+def is_busy(exc):
+    """
+    Returns True if `exc` reports that the database was locked by another
+    connection.
+    """
+    return (
+        isinstance(exc, sqlalchemy.exc.OperationalError) and
+        any(i in str(exc.orig).lower() for i in ("locked", "busy")))
+
+
+class UnitOfWork(object):
+    """
+    Commits the work done in a block, or rolls it back if the block
+    raises. When the database is busy the block is run again, after a
+    jittered backoff. Since the block must be repeatable, the attempts are
+    iterated over, eg::
+
+        uow = UnitOfWork(session)
+        for attempt in uow:
+            with attempt as session:
+                session.add(Touch(...))
+
+    The number of retries taken is kept in `retries`. The error is raised
+    once `limit` retries have failed. Used directly as a context manager,
+    the block is attempted only once.
+    """
+
+    def __init__(self, session, limit=5, delay=0.02, cap=1.0, rng=random):
+        self.session = session
+        self.limit = limit
+        self.delay = delay
+        self.cap = cap
+        self.rng = rng
+        self.retries = 0
+        self._retry = False
+        self._done = False
+
+    def __iter__(self):
+        while not self._done:
+            self._retry = True
+            yield self
+
+    def __enter__(self):
+        return self.session
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            try:
+                self.session.commit()
+            except Exception as e:
+                if not self.backoff(e):
+                    raise
+                return False
+            self._done = True
+            return False
+
+        self.backoff(exc_val)
+        return not self._done
+
+    def backoff(self, exc):
+        """
+        Rolls back after `exc`, then sleeps before a retry if one is
+        due. Returns True if the block is to be run again.
+        """
+        self.session.rollback()
+        if self._retry and is_busy(exc) and self.retries < self.limit:
+            time.sleep(self.rng.uniform(
+                0, min(self.cap, self.delay * 2 ** self.retries)))
+            self.retries += 1
+            log = logging.getLogger("cloudhands.common.unitofwork")
+            log.debug("Retry {} after {}".format(self.retries, exc))
+            return True
+        self._done = True
+        return False
+
+
+class AsyncSession(object):
+    """
+    Wraps a SQLAlchemy session for use from a coroutine. Work which may
+    touch the database runs on the thread pool of the
+    :py:class:`Registry`, so the event loop keeps servicing pipes while
+    it waits. Calls are made one at a time, since a session is not safe
+    to use from two threads at once.
+
+    Queries are built on the wrapped session as usual, since that does no
+    I/O, eg::
+
+        con = Registry().async_connect(sqlite3, path, pool_size=4)
+        q = con.session.session.query(Touch).filter(Touch.actor == actor)
+        touches = await con.session.all(q)
+
+    """
+
+    def __init__(self, session, registry):
+        self.session = session
+        self.registry = registry
+        self.lock = asyncio.Lock()
+
+    async def run(self, fn, *args, **kwargs):
+        """
+        Calls `fn` with the wrapped session and any further arguments,
+        returning its result.
+        """
+        async with self.lock:
+            return await self.registry.run(
+                fn, self.session, *args, **kwargs)
+
+    async def all(self, query):
+        return await self.run(lambda s: query.with_session(s).all())
+
+    async def first(self, query):
+        return await self.run(lambda s: query.with_session(s).first())
+
+    async def scalar(self, query):
+        return await self.run(lambda s: query.with_session(s).scalar())
+
+    async def commit(self):
+        await self.run(lambda s: s.commit())
+
+    async def rollback(self):
+        await self.run(lambda s: s.rollback())
+
+    async def close(self):
+        await self.run(lambda s: s.close())
+
+
 class Registry(object):
+    """
+    Keeps one engine per database URL for the life of the process. All
+    instances share the same state.
+
+    The connector for a URL is looked up by its dialect name in
+    `connectors`. Register a :py:class:`Connector` subclass there to
+    configure another dialect. Legacy callers may give a DBAPI module and
+    a path in place of a URL; `dialects` maps the module to its dialect.
+
+    Read-only work may be routed through :py:meth:`reader`, which keeps a
+    second engine per URL so that long reads stay off the connections
+    which write.
+
+    Coroutines use :py:meth:`run` or :py:meth:`async_connect`, which pass
+    database work to a bounded thread pool shared by the process.
+    """
 
     _shared_state = {}
 
     connectors = {
-        sqlite3: SQLite3Connector,
+        "sqlite": SQLite3Connector,
+    }
+
+    dialects = {
+        sqlite3: "sqlite",
     }
 
     def __init__(self):
         self.__dict__ = self._shared_state
         if not hasattr(self, "_engines"):
             self._engines = {}
+        if not hasattr(self, "_readers"):
+            self._readers = {}
+        if not hasattr(self, "_executor"):
+            self._executor = None
+        if not hasattr(self, "_factories"):
+            self._factories = {}
 
     @property
     def items(self):
         return self._engines.keys()
 
-    def connect(self, module, path):
-        if (module, path) not in self._engines:
-            connector = self.connectors[module]()
-            self._engines[(module, path)] = connector(module, path)
-        engine = self._engines[(module, path)]
-        session = sessionmaker(bind=engine)(autoflush=False)
-        return Connection(module, path, engine, session)
+    def session_factory(self, engine):
+        """
+        Returns the session class for `engine`, which is made once and
+        kept until the engine is disconnected.
+        """
+        try:
+            return self._factories[engine]
+        except KeyError:
+            return self._factories.setdefault(
+                engine, sessionmaker(bind=engine, autoflush=False))
+
+    def url(self, module, path=None):
+        """
+        Returns a SQLAlchemy URL, given either a URL or a DBAPI module
+        and a path.
+        """
+        if path is None:
+            return make_url(module)
+        else:
+            return make_url("{}:///{}".format(self.dialects[module], path))
+
+    def connect(self, module, path=None, **kwargs):
+        """
+        Returns a Connection to a database, given by URL or by DBAPI module
+        and path. The engine is created on first use, when keyword
+        arguments are passed to the connector to tune it, eg::
 
-    def disconnect(self, module, path):
-        engine = self._engines.pop((module, path), None)
-        return Connection(module, path, engine, None)
+            Registry().connect(
+                "sqlite:////var/cloudhands/ops.sl3",
+                profile="balanced", pool_size=8,
+                statement_cache_size=256)
+
+        An :py:class:`~cloudhands.common.instrumentation.Instrument` given
+        as `instrument` is attached to a new engine.
+        """
+        url = self.url(module, path)
+        key = str(url)
+        instrument = kwargs.pop("instrument", None)
+        if key not in self._engines:
+            connector = self.connectors.get(
+                url.get_backend_name(), Connector)(**kwargs)
+            self._engines[key] = connector(
+                url, module=None if path is None else module)
+            if instrument is not None:
+                instrument.attach(self._engines[key])
+        engine = self._engines[key]
+        session = self.session_factory(engine)()
+        return Connection(
+            module if path is not None else engine.dialect.dbapi,
+            url.database, engine, session)
+
+    def reader(self, module, path=None, **kwargs):
+        """
+        Returns a Connection for read-only work on a database, given as to
+        :py:meth:`connect`. The engine which writes is created first, along
+        with the schema, if need be.
+
+        Where the connector offers no read-only engine, as for an
+        in-memory SQLite database, the session is bound to the engine
+        which writes, and nothing stops it from writing.
+        """
+        url = self.url(module, path)
+        key = str(url)
+        instrument = kwargs.pop("instrument", None)
+        if key not in self._readers:
+            con = self.connect(module, path, instrument=instrument, **kwargs)
+            connector = self.connectors.get(
+                url.get_backend_name(), Connector)(**kwargs)
+            engine = connector.reader(
+                url, module=None if path is None else module)
+            if engine is not None and instrument is not None:
+                instrument.attach(engine)
+            self._readers[key] = engine or con.engine
+        engine = self._readers[key]
+        session = self.session_factory(engine)()
+        return Connection(
+            module if path is not None else engine.dialect.dbapi,
+            url.database, engine, session)
+
+    def executor(self, max_workers=4):
+        """
+        Returns the thread pool for database work, creating it with
+        `max_workers` threads on first use.
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        return self._executor
+
+    async def run(self, fn, *args, **kwargs):
+        """
+        Calls `fn` on the thread pool, returning its result without
+        blocking the event loop, eg::
+
+            n = await Registry().run(initialise, session)
+
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self.executor(), functools.partial(fn, *args, **kwargs))
+
+    def async_connect(self, module, path=None, **kwargs):
+        """
+        Returns a Connection as from :py:meth:`connect`, but whose session
+        is an :py:class:`AsyncSession`.
+
+        The thread pool is sized on first use to match a connection pool,
+        so that no thread waits for a connection.
+        """
+        if "pool_size" in kwargs:
+            self.executor(kwargs["pool_size"] + kwargs.get("max_overflow", 0))
+        con = self.connect(module, path, **kwargs)
+        return con._replace(session=AsyncSession(con.session, self))
+
+    def disconnect(self, module, path=None):
+        """
+        Forgets the engines for a database, given as to
+        :py:meth:`connect`. Connection pools are disposed of, which closes
+        their idle connections.
+        """
+        url = self.url(module, path)
+        engine = self._engines.pop(str(url), None)
+        for i in (engine, self._readers.pop(str(url), None)):
+            self._factories.pop(i, None)
+            if i is not None and isinstance(i.pool, QueuePool):
+                i.dispose()
+        if path is None:
+            module = engine and engine.dialect.dbapi
+        return Connection(module, url.database, engine, None)
 
 
 def initialise(session):
+    """
+    Seeds the States of every discovered state machine and the Components
+    of the system, in a single transaction. Rows which already exist are
+    left alone, so this is safe to run from many processes at once.
+
+    Returns the number of rows added.
+    """
     log = logging.getLogger("cloudhands.common.initialise")
-    items = chain(
-        (State(fsm=m.table, name=s) for m in fsms for s in m.values),
-        (Component(uuid=uuid.uuid4().hex, handle=i)
-             for i in (burstCtrl, identityCtrl))
-        )
-    n = 0
-    for i in items:  # Add them individually to permit schema changes
-        try:
-            session.add(i)
-            session.commit()
-            n += 1
-        except Exception as e:
-            session.rollback()
-            log.debug(e)
+    states = State.__table__
+    actors = Actor.__table__
+    components = Component.__table__
+    handles = (burstCtrl, identityCtrl)
+
+    session.flush()
+    connection = session.connection()
+    try:
+        held = {tuple(row) for row in connection.execute(
+            select([states.c.fsm, states.c.name]))}
+        wanted = [
+            {"fsm": m.table, "name": s}
+            for m in fsms for s in m.values if (m.table, s) not in held]
+        n = 0
+        if wanted:
+            n += connection.execute(
+                states.insert().prefix_with("OR IGNORE", dialect="sqlite"),
+                wanted).rowcount
+
+        held = {row.handle for row in connection.execute(
+            select([actors.c.handle]).select_from(
+                actors.join(components)).where(
+                actors.c.handle.in_(handles)))}
+        missing = [i for i in handles if i not in held]
+        if missing:
+            connection.execute(
+                actors.insert().prefix_with("OR IGNORE", dialect="sqlite"),
+                [{"typ": "component", "uuid": uuid.uuid4().hex, "handle": i}
+                 for i in missing])
+            n += connection.execute(
+                components.insert().prefix_with(
+                    "OR IGNORE", dialect="sqlite").from_select(
+                    ["id"], select([actors.c.id]).where(and_(
+                        actors.c.typ == "component",
+                        actors.c.handle.in_(missing))))).rowcount
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+
+    for item in wanted:
+        log.debug("State {fsm}.{name}".format(**item))
+    for item in missing:
+        log.debug("Component {}".format(item))
+    log.info("Added {} rows".format(n))
     return n
@@ -4,6 +4,9 @@
 import datetime
 import uuid
 
+from sqlalchemy.exc import IntegrityError
+
+from cloudhands.common.connectors import UnitOfWork
 from cloudhands.common.schema import Component
 from cloudhands.common.schema import EmailAddress
 from cloudhands.common.schema import Group
@@ -50,21 +53,17 @@ def user(session, handle, surname=None):
 
 
 def registration(session, user, email, version):
-    unknown = session.query(RegistrationState).filter(
-        RegistrationState.name == "pre_registration_person").one()
-    reg = Registration(
-        uuid=uuid.uuid4().hex,
-        model=version)
-    now = datetime.datetime.utcnow()
-    act = Touch(artifact=reg, actor=user, state=unknown, at=now)
-    ea = EmailAddress(touch=act, value=email)
+    unknown = RegistrationState.get(session, "pre_registration_person")
     try:
-        session.add(ea)
-        session.commit()
-    except Exception as e:
-        session.rollback()
+        for attempt in UnitOfWork(session):
+            with attempt:
+                reg = Registration(
+                    uuid=uuid.uuid4().hex,
+                    model=version)
+                now = datetime.datetime.utcnow()
+                act = Touch(artifact=reg, actor=user, state=unknown, at=now)
+                session.add(EmailAddress(touch=act, value=email))
+    except IntegrityError:
         reg = None
-    finally:
-        session.flush()
 
     return reg
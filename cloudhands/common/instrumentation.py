@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+#   encoding: UTF-8
+
+import bisect
+from collections import OrderedDict
+import logging
+import re
+import threading
+import time
+
+import sqlalchemy
+
+__doc__ = """
+The instrumentation module times the statements which an engine executes.
+It keeps latency histograms by statement, counts the rows returned and
+measures how long each connection checkout waits. Statements which run
+over a threshold are logged with their query plan.
+"""
+
+bounds = [
+    m * 10 ** e for e in range(-4, 1) for m in (1, 2.5, 5)] + [10]
+"""Upper bounds in seconds of the histogram buckets. A final bucket holds
+everything slower.
+"""
+
+literals = [
+    (re.compile(r"'(?:[^']|'')*'"), "?"),
+    (re.compile(r"\b\d+(?:\.\d+)?\b"), "?"),
+    (re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)"), "(?...)"),
+    (re.compile(r"\s+"), " "),
+]
+
+
+def normalise(statement):
+    """
+    Returns `statement` with literal values and lists of parameters
+    folded, so that statements differing only in those are counted
+    together.
+    """
+    for regex, sub in literals:
+        statement = regex.sub(sub, statement)
+    return statement.strip()
+
+
+class Histogram(object):
+    """
+    Counts observations in the buckets given by :py:data:`bounds`.
+    """
+
+    def __init__(self):
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def snapshot(self):
+        return OrderedDict([
+            ("count", self.count),
+            ("seconds", self.total),
+            ("max", self.max),
+            ("buckets", list(zip(bounds + [float("inf")], self.buckets))),
+        ])
+
+
+class Statistics(object):
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.rows = 0
+
+
+class CountingCursor(object):
+    """
+    Stands in for a DBAPI cursor, counting the rows fetched from it. The
+    count is reported once the cursor is exhausted or closed.
+    """
+
+    def __init__(self, cursor, report):
+        self._cursor = cursor
+        self._report = report
+        self._rows = 0
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def _finish(self):
+        if self._report is not None:
+            self._report(self._rows)
+            self._report = None
+
+    def fetchone(self):
+        rv = self._cursor.fetchone()
+        if rv is None:
+            self._finish()
+        else:
+            self._rows += 1
+        return rv
+
+    def fetchmany(self, *args):
+        rv = self._cursor.fetchmany(*args)
+        self._rows += len(rv)
+        if not rv:
+            self._finish()
+        return rv
+
+    def fetchall(self):
+        rv = self._cursor.fetchall()
+        self._rows += len(rv)
+        self._finish()
+        return rv
+
+    def close(self):
+        self._finish()
+        return self._cursor.close()
+
+
+class Instrument(object):
+    """
+    Collects statement statistics from the engines it is attached to.
+    Pass one to :py:meth:`~cloudhands.common.connectors.Registry.connect`
+    to instrument a new engine, eg::
+
+        instrument = Instrument(threshold=0.1)
+        Registry().connect(sqlite3, path, instrument=instrument)
+        ...
+        stats = instrument.snapshot()
+
+    Statements taking longer than `threshold` seconds are logged as
+    warnings, along with their query plan if `explain` is True. Only the
+    normalised statement is logged, since bound values may be passwords
+    or addresses. Set `parameters` True to log them too, at DEBUG level.
+    """
+
+    def __init__(
+        self, threshold=None, explain=True, parameters=False,
+        name="slowquery"
+    ):
+        self.threshold = threshold
+        self.explain = explain
+        self.parameters = parameters
+        self.log = logging.getLogger("cloudhands.common." + name)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.statements = {}
+            self.checkout = Histogram()
+
+    def attach(self, engine):
+        sqlalchemy.event.listen(
+            engine, "before_cursor_execute", self.before_execute)
+        sqlalchemy.event.listen(
+            engine, "after_cursor_execute", self.after_execute)
+        sqlalchemy.event.listen(engine, "handle_error", self.handle_error)
+        sqlalchemy.event.listen(
+            engine, "engine_disposed", self.time_checkout)
+        self.time_checkout(engine)
+        return engine
+
+    def time_checkout(self, engine):
+        """
+        Times each checkout from the pool of `engine`. A disposed engine
+        has a new pool, so this is done again when that happens.
+        """
+        pool = engine.pool
+        connect = pool.connect
+
+        def timed_connect():
+            start = time.perf_counter()
+            try:
+                return connect()
+            finally:
+                elapsed = time.perf_counter() - start
+                with self.lock:
+                    self.checkout.observe(elapsed)
+
+        pool.connect = timed_connect
+
+    def before_execute(
+        self, conn, cursor, statement, parameters, context, executemany
+    ):
+        conn.info.setdefault("cloudhands_start", []).append(
+            time.perf_counter())
+
+    def handle_error(self, context):
+        starts = context.connection and context.connection.info.get(
+            "cloudhands_start")
+        if starts:
+            starts.pop()
+
+    def after_execute(
+        self, conn, cursor, statement, parameters, context, executemany
+    ):
+        elapsed = time.perf_counter() - conn.info["cloudhands_start"].pop()
+        key = normalise(statement)
+        with self.lock:
+            stats = self.statements.setdefault(key, Statistics())
+            stats.latency.observe(elapsed)
+
+        if cursor.description is None:
+            self.count_rows(stats, max(cursor.rowcount, 0))
+        elif context is not None:
+            context.cursor = CountingCursor(
+                cursor, lambda n: self.count_rows(stats, n))
+
+        if self.threshold is not None and elapsed > self.threshold:
+            self.slow(conn, statement, parameters, executemany, elapsed)
+
+    def count_rows(self, stats, n):
+        with self.lock:
+            stats.rows += n
+
+    def slow(self, conn, statement, parameters, executemany, elapsed):
+        self.log.warning("{:.3f}s {}".format(elapsed, normalise(statement)))
+        if self.parameters:
+            self.log.debug(parameters)
+        if not self.explain:
+            return
+
+        if executemany:
+            parameters = parameters[0] if parameters else ()
+        prefix = (
+            "EXPLAIN QUERY PLAN " if conn.dialect.name == "sqlite"
+            else "EXPLAIN ")
+        try:
+            cursor = conn.connection.cursor()
+            try:
+                cursor.execute(prefix + statement, parameters)
+                for row in cursor.fetchall():
+                    self.log.warning("plan: {}".format(row[-1]))
+            finally:
+                cursor.close()
+        except Exception as e:
+            self.log.debug(e)
+
+    def snapshot(self):
+        """
+        Returns the statistics gathered so far, as nested dictionaries
+        and lists suitable for serialising to a metrics endpoint.
+        """
+        with self.lock:
+            return OrderedDict([
+                ("statements", OrderedDict(
+                    (key, OrderedDict(
+                        list(stats.latency.snapshot().items()) +
+                        [("rows", stats.rows)]))
+                    for key, stats in sorted(self.statements.items()))),
+                ("checkout", self.checkout.snapshot()),
+            ])
@@ -3,93 +3,853 @@
 
 import ast
 import asyncio
+from collections import deque
+import fcntl
+import hashlib
+import logging
+import marshal
 import os
-from pprint import pprint
+import pickle
+from pprint import pformat
+import random
+import select
+import socket
+import struct
 import sys
+import time
+
+from multiprocessing import resource_tracker
+from multiprocessing import shared_memory
 
 __doc__ = """
 Provides an interprocess Queue for use with the asyncio event loop.
 """
 
+
+def load(loads, payload, rv):
+    """
+    Appends to `rv` the message which `loads` makes of `payload`. A payload
+    which cannot be decoded is logged and dropped, so that one bad message
+    does not hold up those behind it.
+    """
+    try:
+        rv.append(loads(payload))
+    except Exception as e:
+        log = logging.getLogger("cloudhands.common.pipes")
+        log.error("Dropped message of {} bytes: {!r}".format(
+            len(payload), e))
+
+
+class LiteralCodec:
+    """
+    Writes each message as a Python literal on a line of its own. This is
+    the original format of the queue. It is slow, but it is safe to read
+    from an untrusted writer, and easy to inspect.
+    """
+
+    def frames(self, msg):
+        """
+        Returns the byte strings to write for `msg`. Each is written
+        whole where the FIFO allows it.
+        """
+        return [self.encode(msg)]
+
+    def encode(self, msg):
+        try:
+            text = pformat(msg, compact=True, width=sys.maxsize)
+        except TypeError:  # 'compact' is new in Python 3.4
+            text = pformat(msg, width=sys.maxsize)
+        return (text + "\n").encode("utf-8")
+
+    def decode(self, buf):
+        """
+        Returns the messages held complete in the bytearray `buf`, and
+        removes them from it. A message which cannot be decoded is logged
+        and dropped.
+        """
+        rv = []
+        pos = 0
+        while True:
+            end = buf.find(b"\n", pos)
+            if end == -1:
+                break
+            line = bytes(buf[pos:end])
+            pos = end + 1
+            load(lambda x: ast.literal_eval(x.decode("utf-8")), line, rv)
+        del buf[:pos]
+        return rv
+
+
+class FramedCodec:
+    """
+    Writes each message as a binary payload preceded by its length. A
+    subclass supplies `dumps` and `loads` to serialise the payload.
+    """
+
+    header = struct.Struct("!I")
+
+    def frames(self, msg):
+        return [self.encode(msg)]
+
+    def encode(self, msg):
+        payload = self.dumps(msg)
+        return self.header.pack(len(payload)) + payload
+
+    def decode(self, buf):
+        rv = []
+        pos = 0
+        size = self.header.size
+        while len(buf) - pos >= size:
+            n, = self.header.unpack_from(buf, pos)
+            if len(buf) - pos - size < n:
+                break
+            payload = bytes(buf[pos + size:pos + size + n])
+            pos += size + n
+            load(self.loads, payload, rv)
+        del buf[:pos]
+        return rv
+
+
+class MarshalCodec(FramedCodec):
+    """
+    Serialises with :py:mod:`marshal`, which handles the builtin types
+    only. The format may change between Python versions, so both ends
+    must run the same one.
+    """
+
+    def dumps(self, msg):
+        return marshal.dumps(msg)
+
+    def loads(self, payload):
+        return marshal.loads(payload)
+
+
+class PickleCodec(FramedCodec):
+    """
+    Serialises with :py:mod:`pickle`, at the highest protocol by default.
+    Unpickling can run arbitrary code, so use this only on a FIFO which
+    no untrusted process can write to.
+    """
+
+    def __init__(self, protocol=pickle.HIGHEST_PROTOCOL):
+        self.protocol = protocol
+
+    def dumps(self, msg):
+        return pickle.dumps(msg, protocol=self.protocol)
+
+    def loads(self, payload):
+        return pickle.loads(payload)
+
+
+class ChunkedCodec:
+    """
+    Splits each message into chunks no bigger than PIPE_BUF, which the
+    kernel writes to a FIFO atomically. Every chunk carries the id of its
+    producer and the sequence number of its message, so that the reader
+    can reassemble the messages of many concurrent writers. The message
+    itself is encoded with the `inner` codec.
+
+    The producer id joins the process id to a random nonce, so a forked
+    child does not take the id of its parent.
+    """
+
+    header = struct.Struct("!QIBH")
+    LAST = 1
+
+    def __init__(self, inner="marshal", size=select.PIPE_BUF):
+        self.inner = codecs[inner]() if isinstance(inner, str) else inner
+        self.size = size
+        self.nonce = random.getrandbits(32)
+        self.seq = 0
+        self.partial = {}
+
+    @property
+    def producer(self):
+        return os.getpid() << 32 | self.nonce
+
+    def frames(self, msg):
+        payload = self.inner.encode(msg)
+        producer = self.producer
+        seq = self.seq
+        self.seq = (self.seq + 1) & 0xffffffff
+        step = self.size - self.header.size
+        rv = []
+        for pos in range(0, max(len(payload), 1), step):
+            chunk = payload[pos:pos + step]
+            flags = self.LAST if pos + step >= len(payload) else 0
+            rv.append(
+                self.header.pack(producer, seq, flags, len(chunk)) + chunk)
+        return rv
+
+    def encode(self, msg):
+        return b"".join(self.frames(msg))
+
+    def decode(self, buf):
+        log = logging.getLogger("cloudhands.common.pipes")
+        rv = []
+        pos = 0
+        size = self.header.size
+        while len(buf) - pos >= size:
+            producer, seq, flags, n = self.header.unpack_from(buf, pos)
+            if len(buf) - pos - size < n:
+                break
+            chunk = buf[pos + size:pos + size + n]
+            pos += size + n
+
+            held = self.partial.get(producer)
+            if held is not None and held[0] != seq:
+                log.warning("Dropped incomplete message {} of {:x}".format(
+                    held[0], producer))
+                held = None
+            if held is None:
+                held = self.partial[producer] = (seq, bytearray())
+            held[1].extend(chunk)
+            if flags & self.LAST:
+                del self.partial[producer]
+                rv.extend(self.inner.decode(held[1]))
+        del buf[:pos]
+        return rv
+
+
+codecs = {
+    "chunked": ChunkedCodec,
+    "literal": LiteralCodec,
+    "marshal": MarshalCodec,
+    "pickle": PickleCodec,
+}
+"""Codec classes by name. Both ends of a queue must use the same codec."""
+
+
 class SimplePipeQueue:
+    """
+    A queue over a named pipe. Reads and writes block.
+
+    The FIFO is one of several transports. The methods from
+    :py:meth:`open_transport` to :py:meth:`close_transport` are all that a
+    transport need supply; the socket and ring transports below override
+    them.
+    """
 
     @classmethod
     def pipequeue(cls, *args, **kwargs):
         return cls(*args, **kwargs).__enter__()
 
-    def __init__(self, path, history=True):
+    def __init__(
+        self, path, history=True, codec="literal", chunk=65536,
+        readable=True
+    ):
         self.path = path
         self.history = history
+        self.readable = readable
+        self.codec = codecs[codec]() if isinstance(codec, str) else codec
+        self.chunk = chunk
+        self._buf = bytearray()
+        self._ready = deque()
 
     def __enter__(self):
+        self.open_transport()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        if not self.history:
+            os.remove(self.path)
+        return False
+
+    def open_transport(self):
         try:
             os.mkfifo(self.path)
         except FileExistsError:
             if not self.history:
                 raise
 
-        fd = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
-        self._out = os.fdopen(fd, 'r', buffering=1, encoding="utf-8")
-        self._in = open(self.path, "w", buffering=1, encoding="utf-8")
+        if self.readable:
+            fd = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+            self._out = os.fdopen(fd, "rb", buffering=0)
+        else:
+            self._out = None
+        self._in = open(self.path, "wb", buffering=0)
 
-        return self
+    def sources(self):
+        """
+        Returns the objects to wait on for messages to read.
+        """
+        return [self._out] if self.readable else []
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self.close()
-        if not self.history:
-            os.remove(self.path)
-        return False
+    def read(self, limit=None):
+        """
+        Reads what is waiting in the FIFO, and decodes every message which
+        is complete. Reading stops once `limit` messages are decoded.
+        Returns the number decoded.
+        """
+        n = 0
+        while limit is None or n < limit:
+            data = self._out.read(self.chunk)
+            if not data:
+                break
+            self._buf.extend(data)
+            msgs = self.codec.decode(self._buf)
+            self._ready.extend(msgs)
+            n += len(msgs)
+        return n
 
-    def put_nowait(self, msg):
+    def write(self, data):
+        """
+        Writes all of `data`, waiting for room if need be.
+        """
+        self._in.write(data)
+
+    def nonblocking(self, flag=True):
+        """
+        Makes :py:meth:`send` return at once when there is no room, or
+        wait again if `flag` is False.
+        """
+        os.set_blocking(self._in.fileno(), not flag)
+
+    def send(self, data):
+        """
+        Writes what it can of `data` without waiting. Returns the number
+        of bytes written.
+        """
         try:
-            pprint(msg, stream=self._in, compact=True, width=sys.maxsize)
-        except TypeError:  # 'compact' is new in Python 3.4
-            pprint(msg, stream=self._in, width=sys.maxsize)
-        finally:
-            self._in.flush()
+            return os.write(self._in.fileno(), data)
+        except BlockingIOError:
+            return 0
+
+    def writer_fd(self):
+        """
+        Returns a descriptor which polls writable when :py:meth:`send`
+        may make progress, or None if the transport has none.
+        """
+        return self._in.fileno()
+
+    def forget(self, source):
+        """
+        Called before a transport closes one of its sources.
+        """
+        pass
+
+    def close_transport(self):
+        if self._out is not None:
+            self._out.close()
+        self._in.close()
+
+    def put_nowait(self, msg):
+        for frame in self.codec.frames(msg):
+            self.write(frame)
 
     def get(self):
-        payload = self._out.readline().rstrip("\n")
-        return ast.literal_eval(payload)
+        while not self._ready:
+            select.select(self.sources(), [], [])
+            self.read()
+        return self._ready.popleft()
 
     def close(self):
-        self._out.close()
-        self._in.close()
+        self.close_transport()
 
 
 class PipeQueue(SimplePipeQueue):
+    """
+    A queue whose reads and writes never block the event loop.
+
+    Writes are non-blocking. Whatever the FIFO cannot take at once is
+    buffered, and sent when the FIFO becomes writable. The coroutine
+    :py:meth:`put` returns once its message is written, so a slow reader
+    holds up only the coroutines which write to it.
+
+    Received messages are held until a consumer takes them. If `maxsize`
+    is given, no more than that are queued. The transport is read only
+    while there is room, and what is decoded beyond it, at most one
+    `chunk` of input, is held back until there is. Reading stops once
+    `high_water` messages are held, so the FIFO fills and writers are made
+    to wait. Reading resumes when the holding falls to `low_water`. The
+    callables `on_high` and `on_low` are passed the queue as each mark is
+    crossed. By default the marks are `maxsize` and half of it.
+
+    On closing, a writer waits for whatever is still buffered to be
+    written. A queue which reads its own FIFO cannot, since nothing would
+    then read it; the buffer is discarded with a warning.
+
+    Several processes may write to one FIFO. A writer opens the queue with
+    `readable` False and, for messages larger than PIPE_BUF, should use
+    the chunked codec, eg::
+
+        with PipeQueue(path, codec="chunked", readable=False) as pq:
+            await pq.put(msg)
 
-    @staticmethod
-    def get_when_ready(fObj, q):
-        payload = fObj.readline().rstrip("\n")
-        q.put_nowait(ast.literal_eval(payload))
+    """
 
-    def __init__(self, *args, **kwargs):
+    def get_when_ready(self):
+        room = self.room()
+        if room is None or room > 0:
+            self.read(room)
+        self.fill()
+        if self._paused:
+            return
+        elif self._q.full() or (
+            self.high_water and self._q.qsize() >= self.high_water
+        ):
+            self._paused = True
+            self.unwatch()
+            if self.on_high is not None:
+                self.on_high(self)
+        else:
+            self.watch()
+
+    def __init__(
+        self, *args, maxsize=0, high_water=None, low_water=None,
+        on_high=None, on_low=None, **kwargs
+    ):
         super().__init__(*args, **kwargs)
-        self._q = asyncio.Queue()
+        self.maxsize = maxsize
+        self._q = asyncio.Queue(maxsize)
+        self.high_water = high_water or maxsize
+        self.low_water = (
+            low_water if low_water is not None else self.high_water // 2)
+        self.on_high = on_high
+        self.on_low = on_low
+        self._paused = False
+        self._watched = set()
+        self._outbox = deque()
+        self._sent = 0
+        self._queued = 0
+        self._waiters = deque()
+        self._writing = False
+        self._timer = None
+        self._resume = None
 
     def __enter__(self):
         super().__enter__()
 
-        fd = self._out.fileno()
-        loop = asyncio.get_event_loop()
-        loop.add_reader(fd, PipeQueue.get_when_ready, self._out, self._q)
+        self._loop = asyncio.get_event_loop()
+        self.nonblocking()
+        self.watch()
         return self
 
-    @asyncio.coroutine
-    def get(self):
-        rv = yield from self._q.get()
+    def watch(self):
+        """
+        Registers every source of the transport with the event loop.
+        """
+        for source in self.sources():
+            fd = source.fileno()
+            if fd not in self._watched:
+                self._watched.add(fd)
+                self._loop.add_reader(fd, self.get_when_ready)
+
+    def unwatch(self):
+        while self._watched:
+            self._loop.remove_reader(self._watched.pop())
+
+    def forget(self, source):
+        fd = source.fileno()
+        if fd in self._watched:
+            self._watched.discard(fd)
+            self._loop.remove_reader(fd)
+
+    def room(self):
+        """
+        Returns the number of messages which may yet be read, or None if
+        there is no limit.
+        """
+        if self.maxsize:
+            return self.maxsize - self._q.qsize() - len(self._ready)
+        else:
+            return None
+
+    def fill(self):
+        """
+        Moves decoded messages to the queue while it has room.
+        """
+        while self._ready and not self._q.full():
+            self._q.put_nowait(self._ready.popleft())
+
+    def taken(self):
+        """
+        Resumes reading once consumers have brought the holding of
+        messages down to the low water mark. A read is scheduled at once,
+        since data left in a ring brings no further wake-up.
+        """
+        self.fill()
+        if (self._paused and not self._ready and
+                self._q.qsize() <= self.low_water):
+            self._paused = False
+            self.watch()
+            self._resume = self._loop.call_soon(self.get_when_ready)
+            if self.on_low is not None:
+                self.on_low(self)
+
+    async def get(self):
+        rv = await self._q.get()
+        self.taken()
         return rv
 
-    @asyncio.coroutine
-    def put(self, msg):
+    async def get_many(self, max_n, timeout=None):
+        """
+        Waits up to `timeout` seconds for a message, then returns it along
+        with any others already received, up to `max_n` in all. Returns an
+        empty list if none arrives in time.
+        """
+        try:
+            msg = await asyncio.wait_for(self._q.get(), timeout)
+        except asyncio.TimeoutError:
+            return []
+
+        rv = [msg]
+        while len(rv) < max_n and not self._q.empty():
+            rv.append(self._q.get_nowait())
+        self.taken()
+        return rv
+
+    def put_nowait(self, msg):
+        """
+        Sends `msg`, buffering whatever the transport cannot take at once.
+        Returns the count of bytes which must be sent for `msg` to be
+        written in full.
+        """
+        for frame in self.codec.frames(msg):
+            self._outbox.append(frame)
+            self._queued += len(frame)
+        self.flush()
+        return self._queued
+
+    def flush(self):
+        """
+        Writes as much of the buffer as the transport will take, and wakes
+        the writers whose messages have gone. Frames are joined into writes
+        of up to PIPE_BUF, so that frames which fit are never split.
+
+        If the transport offers no descriptor to poll, a full buffer is
+        retried after a millisecond.
+        """
+        while self._outbox:
+            data = self._outbox.popleft()
+            while (self._outbox and
+                   len(data) + len(self._outbox[0]) <= select.PIPE_BUF):
+                data += self._outbox.popleft()
+            n = self.send(data)
+            if n < len(data):
+                self._outbox.appendleft(data[n:])
+            self._sent += n
+            if not n:
+                break
+
+        while self._waiters and self._waiters[0][0] <= self._sent:
+            target, future = self._waiters.popleft()
+            if not future.done():
+                future.set_result(None)
+
+        fd = self.writer_fd()
+        if self._outbox and not self._writing:
+            self._writing = True
+            if fd is None:
+                self._timer = self._loop.call_later(0.001, self.retry)
+            else:
+                self._loop.add_writer(fd, self.flush)
+        elif not self._outbox and self._writing:
+            self.idle(fd)
+
+    def retry(self):
+        self._writing = False
+        self._timer = None
+        self.flush()
+
+    def idle(self, fd):
+        self._writing = False
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        elif fd is not None:
+            self._loop.remove_writer(fd)
+
+    async def put(self, msg):
+        target = self.put_nowait(msg)
+        if self._sent < target:
+            waiter = asyncio.Future()
+            self._waiters.append((target, waiter))
+            await waiter
         future = asyncio.Future()
-        self.put_nowait(msg)
         future.set_result(msg)
         return future
 
+    def drain(self):
+        """
+        Writes out the buffer, waiting for room as need be. A queue which
+        reads its own FIFO discards the buffer instead, and logs a warning.
+        """
+        if not self._outbox:
+            return
+        elif self.readable:
+            log = logging.getLogger("cloudhands.common.pipes")
+            log.warning("Discarded {} unsent bytes".format(
+                sum(len(i) for i in self._outbox)))
+            self._outbox.clear()
+            return
+
+        self.nonblocking(False)
+        while self._outbox:
+            data = self._outbox.popleft()
+            self.write(data)
+            self._sent += len(data)
+        while self._waiters and self._waiters[0][0] <= self._sent:
+            self._waiters.popleft()[1].set_result(None)
+
     def close(self):
-        loop = asyncio.get_event_loop()
-        loop.remove_reader(self._out.fileno())
-        self._out.close()
+        self.unwatch()
+        if self._resume is not None:
+            self._resume.cancel()
+        if self._writing:
+            self.idle(self.writer_fd())
+        self.drain()
+        while self._waiters:
+            self._waiters.popleft()[1].cancel()
+        super().close()
+
+
+class SocketTransport:
+    """
+    Carries messages over a Unix domain stream socket at `path` in place
+    of a FIFO. The reader listens and accepts any number of writers. Each
+    writer has its own stream, so messages are never interleaved and any
+    codec is safe with many producers.
+    """
+
+    def open_transport(self):
+        if self.readable and os.path.exists(self.path):
+            if not self.history:
+                raise FileExistsError(self.path)
+            os.remove(self.path)
+
+        self._conns = {}
+        if self.readable:
+            self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._server.bind(self.path)
+            self._server.listen(64)
+            self._server.setblocking(False)
+        else:
+            self._server = None
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(self.path)
+
+    def sources(self):
+        if not self.readable:
+            return []
+        return [self._server] + list(self._conns)
+
+    def read(self, limit=None):
+        """
+        Accepts waiting writers, then reads what is waiting on each
+        connection until `limit` messages are decoded. Returns the number
+        decoded.
+        """
+        while True:
+            try:
+                conn, addr = self._server.accept()
+            except BlockingIOError:
+                break
+            conn.setblocking(False)
+            self._conns[conn] = bytearray()
+
+        n = 0
+        for conn, buf in list(self._conns.items()):
+            while limit is None or n < limit:
+                try:
+                    data = conn.recv(self.chunk)
+                except BlockingIOError:
+                    break
+                if not data:
+                    self.forget(conn)
+                    del self._conns[conn]
+                    conn.close()
+                    break
+                buf.extend(data)
+                msgs = self.codec.decode(buf)
+                self._ready.extend(msgs)
+                n += len(msgs)
+        return n
+
+    def write(self, data):
+        self._sock.sendall(data)
+
+    def nonblocking(self, flag=True):
+        self._sock.setblocking(not flag)
+
+    def send(self, data):
+        try:
+            return self._sock.send(data)
+        except BlockingIOError:
+            return 0
+
+    def writer_fd(self):
+        return self._sock.fileno()
+
+    def close_transport(self):
+        for conn in self._conns:
+            conn.close()
+        self._conns.clear()
+        self._sock.close()
+        if self._server is not None:
+            self._server.close()
+
+
+class SimpleSocketQueue(SocketTransport, SimplePipeQueue):
+    pass
+
+
+class SocketQueue(SocketTransport, PipeQueue):
+    pass
+
+
+class RingTransport:
+    """
+    Carries messages through a ring buffer in shared memory, for high
+    rates between processes on one host.
+
+    The reader creates the ring, of `size` bytes, and a FIFO at `path`.
+    Writers copy frames into the ring under a lock, then write a byte to
+    the FIFO to wake the reader. A frame is copied whole or not at
+    all, so many producers may share a ring; no frame may be larger than
+    the ring.
+
+    The ring begins with two counters, of the bytes ever written and
+    read. Only writers move the first, and only the reader the second.
+    """
+
+    header = struct.Struct("!QQ")
+
+    def __init__(self, *args, size=1 << 20, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.size = size
+
+    @property
+    def name(self):
+        """
+        The name of the shared memory block, derived from `path`.
+        """
+        locn = os.path.abspath(self.path).encode("utf-8")
+        return "cloudhands-" + hashlib.sha1(locn).hexdigest()[:16]
+
+    def open_transport(self):
+        try:
+            os.mkfifo(self.path)
+        except FileExistsError:
+            if not self.history:
+                raise
+
+        if self.readable:
+            try:
+                old = shared_memory.SharedMemory(name=self.name)
+            except FileNotFoundError:
+                pass
+            else:
+                old.close()
+                old.unlink()
+            self._shm = shared_memory.SharedMemory(
+                name=self.name, create=True,
+                size=self.header.size + self.size)
+            self.header.pack_into(self._shm.buf, 0, 0, 0)
+            fd = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+            self._out = os.fdopen(fd, "rb", buffering=0)
+        else:
+            self._shm = shared_memory.SharedMemory(name=self.name)
+            # The reader owns the block; stop this process unlinking it
+            resource_tracker.unregister(
+                self._shm._name, "shared_memory")
+            self._out = None
+        self._in = open(self.path, "wb", buffering=0)
+        os.set_blocking(self._in.fileno(), False)
+        self._lock = open(self.path + ".lock", "ab")
+        self.capacity = self._shm.size - self.header.size
+
+    def counters(self):
+        """
+        Returns the bytes written and read. The first is read until it
+        is stable, since a writer may be updating it.
+        """
+        while True:
+            head, tail = self.header.unpack_from(self._shm.buf, 0)
+            if self.header.unpack_from(self._shm.buf, 0)[0] == head:
+                return head, tail
+
+    def read(self, limit=None):
+        """
+        Reads what the ring holds, in pieces of up to `chunk` bytes, until
+        `limit` messages are decoded. What is left stays in the ring, where
+        it holds up writers.
+        """
+        while self._out.read(self.chunk):
+            pass
+
+        head, tail = self.counters()
+        cap = self.capacity
+        base = self.header.size
+        n = 0
+        while tail < head and (limit is None or n < limit):
+            start = tail % cap
+            end = min(start + head - tail, cap, start + self.chunk)
+            self._buf.extend(self._shm.buf[base + start:base + end])
+            tail += end - start
+            msgs = self.codec.decode(self._buf)
+            self._ready.extend(msgs)
+            n += len(msgs)
+        struct.pack_into("!Q", self._shm.buf, 8, tail)
+        return n
+
+    def send(self, data):
+        if len(data) > self.capacity:
+            raise ValueError("Frame larger than ring")
+
+        cap = self.capacity
+        base = self.header.size
+        fcntl.flock(self._lock, fcntl.LOCK_EX)
+        try:
+            head, tail = self.counters()
+            if cap - (head - tail) < len(data):
+                return 0
+            pos = 0
+            while pos < len(data):
+                start = (head + pos) % cap
+                end = min(start + len(data) - pos, cap)
+                self._shm.buf[base + start:base + end] = (
+                    data[pos:pos + end - start])
+                pos += end - start
+            struct.pack_into("!Q", self._shm.buf, 0, head + len(data))
+        finally:
+            fcntl.flock(self._lock, fcntl.LOCK_UN)
+
+        try:
+            os.write(self._in.fileno(), b"\0")
+        except BlockingIOError:
+            pass  # The reader has a wake-up pending already
+        return len(data)
+
+    def write(self, data):
+        while not self.send(data):
+            time.sleep(0.0001)
+
+    def nonblocking(self, flag=True):
+        pass
+
+    def writer_fd(self):
+        return None
+
+    def close_transport(self):
+        self._lock.close()
+        self._shm.close()
+        if self.readable:
+            # A forked writer shares the tracker, and may have unregistered
+            resource_tracker.register(self._shm._name, "shared_memory")
+            self._shm.unlink()
+            self._out.close()
+            try:
+                os.remove(self.path + ".lock")
+            except FileNotFoundError:
+                pass
         self._in.close()
+
+
+class SimpleRingQueue(RingTransport, SimplePipeQueue):
+    pass
+
+
+class RingQueue(RingTransport, PipeQueue):
+    pass
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+#   encoding: UTF-8
+
+from collections import OrderedDict
+from collections import defaultdict
+import ipaddress
+import uuid
+
+from sqlalchemy import select
+from sqlalchemy.orm.attributes import set_committed_value
+
+from cloudhands.common.schema import Actor
+from cloudhands.common.schema import Artifact
+from cloudhands.common.schema import CurrentState
+from cloudhands.common.schema import Provider
+from cloudhands.common.schema import Resource
+from cloudhands.common.schema import State
+from cloudhands.common.schema import Touch
+
+__doc__ = """
+The queries module provides efficient answers to the questions most
+often asked of the common database.
+"""
+
+
+def current_state(session, artifact):
+    """
+    Returns the :py:class:`~cloudhands.common.schema.State` of the
+    latest Touch made to `artifact`, or None if it has never been touched.
+    """
+    return session.query(State).join(
+        CurrentState, CurrentState.state_id == State.id).filter(
+        CurrentState.artifact_id == artifact.id).first()
+
+
+def in_state(session, cls, *states):
+    """
+    Returns a query for artifacts of type `cls` whose latest Touch put
+    them in one of the given `states`. The cost of the query does not
+    depend on the length of each artifact's history.
+
+    The result may be refined further by the caller, eg::
+
+        in_state(session, Appliance, preprovision).filter(
+            Appliance.organisation == org).all()
+
+    """
+    query = session.query(cls).join(
+        CurrentState, CurrentState.artifact_id == cls.id)
+    ids = [i.id for i in states]
+    if len(ids) == 1:
+        return query.filter(CurrentState.state_id == ids[0])
+    else:
+        return query.filter(CurrentState.state_id.in_(ids))
+
+
+def latest_touches(session, cls=Artifact):
+    """
+    Returns a query which yields the latest Touch of every artifact of
+    type `cls`.
+    """
+    return session.query(Touch).join(
+        CurrentState, CurrentState.touch_id == Touch.id).join(
+        cls, CurrentState.artifact_id == cls.id)
+
+
+def chunks(seq, n=500):
+    """
+    Splits a sequence into lists short enough to be bound as the
+    parameters of an IN clause.
+    """
+    seq = list(seq)
+    for i in range(0, len(seq), n):
+        yield seq[i:i + n]
+
+
+def resource_bundles(session, items):
+    """
+    Loads the resources of a collection of Touches or Artifacts. Rather
+    than one polymorphic load per Touch, this makes one query to find
+    the type of every resource and then one query per resource class
+    actually present (more if there are many hundreds of Touches).
+
+    Returns an ordered mapping of Touch to a dictionary of resource class
+    to a list of resources. An Artifact contributes all its Touches in
+    chronological order. The `resources` collection of each Touch is
+    populated as a side effect, so it may be used freely afterwards.
+    """
+    items = list(items)
+    touches = [i for i in items if isinstance(i, Touch)]
+    artifactIds = [i.id for i in items if isinstance(i, Artifact)]
+    for ids in chunks(artifactIds):
+        touches.extend(session.query(Touch).filter(
+            Touch.artifact_id.in_(ids)).order_by(Touch.at, Touch.id).all())
+
+    table = Resource.__table__
+    byTyp = defaultdict(list)
+    for ids in chunks(i.id for i in touches):
+        for row in session.execute(
+            select([table.c.id, table.c.typ]).where(
+                table.c.touch_id.in_(ids))):
+            byTyp[row.typ].append(row.id)
+
+    byTouch = defaultdict(list)
+    for typ, ids in byTyp.items():
+        cls = Resource.__mapper__.polymorphic_map[typ].class_
+        for batch in chunks(ids):
+            for obj in session.query(cls).filter(cls.id.in_(batch)):
+                byTouch[obj.touch_id].append(obj)
+
+    rv = OrderedDict()
+    for touch in touches:
+        resources = sorted(byTouch[touch.id], key=lambda x: x.id)
+        set_committed_value(touch, "resources", resources)
+        bundle = rv.setdefault(touch, OrderedDict())
+        for obj in resources:
+            bundle.setdefault(type(obj), []).append(obj)
+    return rv
+
+
+def hexify(value):
+    """
+    Normalises a uuid given as a :py:class:`uuid.UUID` or a string, with
+    or without hyphens, to the 32 character hex form stored in the
+    database.
+    """
+    if isinstance(value, uuid.UUID):
+        return value.hex
+    else:
+        return uuid.UUID(hex=value).hex
+
+
+def by_uuid(session, value, *classes):
+    """
+    Returns the Artifact, Actor or Provider identified by `value`, or None.
+    Each lookup is a search of a unique index. The search can be narrowed,
+    and made cheaper, by naming the classes to look in, eg::
+
+        by_uuid(session, uuid, Appliance)
+
+    """
+    value = hexify(value)
+    for cls in classes or (Artifact, Actor, Provider):
+        rv = session.query(cls).filter(cls.uuid == value).first()
+        if rv is not None:
+            return rv
+    return None
+
+
+def by_uuids(session, cls, values):
+    """
+    Returns a dictionary of the objects of type `cls` identified by
+    `values`, keyed by hex uuid. Unknown uuids are omitted.
+    """
+    rv = {}
+    for batch in chunks({hexify(i) for i in values}):
+        rv.update(
+            (i.uuid, i) for i in session.query(cls).filter(
+                cls.uuid.in_(batch)))
+    return rv
+
+
+def in_range(session, column, start, end):
+    """
+    Returns a query for the objects whose packed address `column` lies
+    between `start` and `end` inclusive, in address order, eg::
+
+        in_range(session, NATRouting.ip_int_packed,
+                 "10.0.0.16", "10.0.0.31")
+
+    """
+    return session.query(column.class_).filter(
+        column.between(
+            ipaddress.ip_address(start), ipaddress.ip_address(end))).order_by(
+        column)
+
+
+def in_network(session, column, network):
+    """
+    Returns a query for the objects whose packed address `column` lies
+    within `network`, which may be given in CIDR notation, eg::
+
+        in_network(session, IPAddress.packed, "192.168.2.0/24")
+
+    """
+    network = ipaddress.ip_network(network, strict=False)
+    return in_range(
+        session, column, network.network_address, network.broadcast_address)
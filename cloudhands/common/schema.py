@@ -1,19 +1,38 @@
 #!/usr/bin/env python3
 #   encoding: UTF-8
 
+import datetime
+import ipaddress
+import weakref
+
 from sqlalchemy import Boolean
 from sqlalchemy import Column
 from sqlalchemy import DateTime
 from sqlalchemy import ForeignKey
 from sqlalchemy import Integer
 from sqlalchemy import ForeignKeyConstraint
+from sqlalchemy import Index
 from sqlalchemy import String
 from sqlalchemy import UniqueConstraint
+from sqlalchemy import and_
+from sqlalchemy import bindparam
+from sqlalchemy import event
+from sqlalchemy import exists
+from sqlalchemy import func
+from sqlalchemy import inspect
+from sqlalchemy import or_
+from sqlalchemy import select
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.schema import Table
 from sqlalchemy.types import CHAR
+from sqlalchemy.orm.attributes import get_history
+from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm import object_session
 from sqlalchemy.orm import relationship
 
+from cloudhands.common.types import PackedIPAddress
+
 Base = declarative_base()
 metadata = Base.metadata
 
@@ -85,14 +104,116 @@ class Artifact(Base):
 
     id = Column("id", Integer(), nullable=False, primary_key=True)
     typ = Column("typ", String(length=32), nullable=False)
-    uuid = Column("uuid", CHAR(length=32), nullable=False)
+    uuid = Column(
+        "uuid", CHAR(length=32), nullable=False, unique=True, index=True)
     model = Column("model", String(length=32), nullable=False)
     changes = relationship("Touch", order_by="Touch.at")
+    current = relationship("CurrentState", uselist=False, viewonly=True)
+    history = relationship(
+        "Touch", lazy="dynamic", order_by="Touch.at", viewonly=True)
 
     __mapper_args__ = {
         "polymorphic_identity": "artifact",
         "polymorphic_on": typ}
 
+    def _window(self):
+        """
+        Returns a query for this artifact's Touches, newest first, or None
+        if the artifact is not yet persistent.
+        """
+        if not inspect(self).persistent:
+            return None
+        else:
+            return self.history.order_by(None).order_by(
+                Touch.at.desc(), Touch.id.desc())
+
+    def latest_touch(self):
+        """
+        Returns the most recent :py:class:`~cloudhands.common.schema.Touch`
+        made to this artifact, or None. This reads a single indexed row
+        rather than loading :py:attr:`changes`.
+
+        Like the other history methods, it sees only Touches which have
+        been flushed to the database.
+        """
+        window = self._window()
+        if window is None:
+            return self.changes[-1] if self.changes else None
+        else:
+            return window.first()
+
+    def recent_touches(self, n, archive=None):
+        """
+        Returns the last `n` Touches made to this artifact, in
+        chronological order. If a
+        :py:class:`~cloudhands.common.archival.TouchArchive` is given,
+        archived Touches are included.
+        """
+        if n < 1:
+            return []
+
+        window = self._window()
+        if window is None:
+            return self.changes[-n:]
+
+        rv = list(reversed(window.limit(n).all()))
+        if archive is not None and len(rv) < n:
+            rv = sorted(
+                archive.touches(object_session(self), self, limit=n) + rv,
+                key=lambda x: (x.at, x.id))[-n:]
+        return rv
+
+    def touches_since(self, mark, archive=None):
+        """
+        Returns the Touches made to this artifact after `mark`, in
+        chronological order. The mark may be a datetime, a Touch or the
+        id of a Touch. If a
+        :py:class:`~cloudhands.common.archival.TouchArchive` is given,
+        archived Touches are included.
+
+        Raises NoResultFound if `mark` is the id of no known Touch.
+        """
+        window = self._window()
+        session = object_session(self)
+        if not isinstance(mark, (datetime.datetime, Touch)):
+            ident = mark
+            if window is None:
+                mark = next((i for i in self.changes if i.id == ident), None)
+            else:
+                mark = session.query(Touch).get(ident)
+                if mark is None and archive is not None:
+                    mark = archive.get(session, ident)
+            if mark is None:
+                raise NoResultFound("No Touch with id {}".format(ident))
+
+        if window is None:
+            when = getattr(mark, "at", mark)
+            return [i for i in self.changes if i.at > when]
+
+        rv = self.history.filter(later_than(Touch, mark)).order_by(
+            None).order_by(Touch.at, Touch.id).all()
+        if archive is not None:
+            rv = sorted(
+                archive.touches(session, self, after=mark) + rv,
+                key=lambda x: (x.at, x.id))
+        return rv
+
+    def latest_resources(self, typ=None):
+        """
+        Returns the resources of type `typ` attached to the latest Touch.
+        All resources are returned if no type is given.
+        """
+        latest = self.latest_touch()
+        if latest is None:
+            return []
+        elif typ is None:
+            return list(latest.resources)
+        elif not inspect(latest).persistent:
+            return [i for i in latest.resources if isinstance(i, typ)]
+        else:
+            return object_session(self).query(typ).filter(
+                typ.touch_id == latest.id).all()
+
 
 class Access(Artifact):
     """
@@ -280,6 +401,13 @@ class Component(Actor):
 class Touch(Base):
     __tablename__ = "touches"
 
+    __table_args__ = (
+        Index("ix_touches_artifact_id_at", "artifact_id", "at"),
+        Index("ix_touches_actor_id", "actor_id"),
+        Index("ix_touches_state_id", "state_id"),
+        Index("ix_touches_at", "at"),
+    )
+
     id = Column("id", Integer(), nullable=False, primary_key=True)
     artifact_id = Column("artifact_id", Integer, ForeignKey("artifacts.id"))
     actor_id = Column("actor_id", Integer, ForeignKey("actors.id"))
@@ -292,6 +420,32 @@ class Touch(Base):
     resources = relationship("Resource", cascade="all, delete-orphan")
 
 
+class CurrentState(Base):
+    """
+    This table is a projection of the latest
+    :py:class:`~cloudhands.common.schema.Touch` made to each artifact.
+
+    It is maintained incrementally as Touches are written, so that finding
+    artifacts in a particular state does not depend on the length of their
+    history. Rows are never written directly by application code.
+    """
+    __tablename__ = "currentstates"
+
+    __table_args__ = (Index("ix_currentstates_state_id", "state_id"),)
+
+    artifact_id = Column(
+        "artifact_id", Integer, ForeignKey("artifacts.id"),
+        nullable=False, primary_key=True)
+    state_id = Column("state_id", Integer, ForeignKey("states.id"))
+    touch_id = Column(
+        "touch_id", Integer, ForeignKey("touches.id"), nullable=False)
+    at = Column("at", DateTime(), nullable=False)
+
+    artifact = relationship("Artifact")
+    state = relationship("State")
+    touch = relationship("Touch")
+
+
 class Provider(Base):
     """
     This is the base table for all providers in the system.
@@ -350,6 +504,12 @@ class Resource(Base):
     """
     __tablename__ = "resources"
 
+    __table_args__ = (
+        Index("ix_resources_touch_id_typ", "touch_id", "typ"),
+        Index("ix_resources_typ", "typ"),
+        Index("ix_resources_provider_id", "provider_id"),
+    )
+
     id = Column("id", Integer(), nullable=False, primary_key=True)
     typ = Column("typ", String(length=32), nullable=False)
     provider_id = Column(
@@ -525,12 +685,16 @@ class IPAddress(Resource):
     """
     An Internet address. The address is stored as a string; no interpretation
     (ie: IPv4, IPv6) is placed on the value.
+
+    Where the value is a valid IPv4 or IPv6 address, it is also stored in
+    `packed` form, which sorts numerically and supports range queries.
     """
     __tablename__ = "ipaddresses"
 
     id = Column("id", Integer, ForeignKey("resources.id"),
                 nullable=False, primary_key=True)
     value = Column("value", String(length=64), nullable=False, unique=True)
+    packed = Column("packed", PackedIPAddress, nullable=True, index=True)
 
     __mapper_args__ = {"polymorphic_identity": "ipaddress"}
 
@@ -545,6 +709,10 @@ class NATRouting(Resource):
                 nullable=False, primary_key=True)
     ip_int = Column("ip_int", String(length=64), nullable=False, unique=False)
     ip_ext = Column("ip_ext", String(length=64), nullable=False, unique=True)
+    ip_int_packed = Column(
+        "ip_int_packed", PackedIPAddress, nullable=True, index=True)
+    ip_ext_packed = Column(
+        "ip_ext_packed", PackedIPAddress, nullable=True, index=True)
 
     __mapper_args__ = {"polymorphic_identity": "natrouting"}
 
@@ -638,6 +806,47 @@ class State(Base, Serializable):
 
     __mapper_args__ = {'polymorphic_on': fsm}
 
+    @classmethod
+    def detached(cls, session, name):
+        """
+        Returns a detached copy of the State called `name`, loading it
+        only if it is not yet in the cache for the session's engine.
+        States are written once by
+        :py:func:`~cloudhands.common.connectors.initialise` and never
+        change, so the cache is never invalidated.
+        """
+        cache = state_cache.setdefault(session.get_bind(cls), {})
+        key = (cls.__mapper__.polymorphic_identity, name)
+        try:
+            return cache[key]
+        except KeyError:
+            row = session.query(cls).filter(cls.name == name).one()
+            obj = type(row)(id=row.id, fsm=row.fsm, name=row.name)
+            make_transient_to_detached(obj)
+            return cache.setdefault(key, obj)
+
+    @classmethod
+    def get(cls, session, name):
+        """
+        Returns the persistent State called `name` belonging to `session`.
+        After the first call for a database this makes no round trip, eg::
+
+            operational = ApplianceState.get(session, "operational")
+
+        """
+        return session.merge(cls.detached(session, name), load=False)
+
+    @classmethod
+    def get_id(cls, session, name):
+        """
+        Returns the id of the State called `name`.
+        """
+        return cls.detached(session, name).id
+
+
+state_cache = weakref.WeakKeyDictionary()
+"""Detached State objects, by engine and (fsm, name)."""
+
 
 def fsm_factory(name, states):
     """
@@ -655,3 +864,195 @@ def fsm_factory(name, states):
     )
     class_ = type(className, (State,), attribs)
     return class_
+
+
+def later_than(entity, mark):
+    """
+    Returns a criterion selecting Touches made after `mark`, which may be
+    a datetime or a Touch. Touches made at the same instant are ordered
+    by their id. The `entity` is Touch or an alias of it.
+    """
+    if isinstance(mark, datetime.datetime):
+        return entity.at > mark
+    else:
+        return or_(
+            entity.at > mark.at,
+            and_(entity.at == mark.at, entity.id > mark.id))
+
+
+def advance_current_state(connection, artifact_id, state_id, touch_id, at):
+    """
+    Records a new Touch in the current state projection if it is later
+    than the one already held for the artifact. Touches made at the same
+    instant are ordered by their id.
+
+    Returns True if the projection was changed.
+    """
+    table = CurrentState.__table__
+    rv = connection.execute(
+        table.update().where(
+            table.c.artifact_id == artifact_id).where(
+            or_(table.c.at < at, and_(
+                table.c.at == at, table.c.touch_id <= touch_id))).values(
+            state_id=state_id, touch_id=touch_id, at=at))
+    if rv.rowcount:
+        return True
+
+    held = connection.execute(
+        select([table.c.artifact_id]).where(
+            table.c.artifact_id == artifact_id)).first()
+    if held is None:
+        connection.execute(
+            table.insert().values(
+                artifact_id=artifact_id, state_id=state_id,
+                touch_id=touch_id, at=at))
+        return True
+    else:
+        return False
+
+
+def refresh_current_state(connection, artifact_id, exclude=None):
+    """
+    Recalculates the current state of an artifact from its Touches,
+    optionally ignoring the Touch whose id is `exclude`.
+    """
+    touches = Touch.__table__
+    table = CurrentState.__table__
+    query = select(
+        [touches.c.id, touches.c.state_id, touches.c.at]).where(
+        touches.c.artifact_id == artifact_id).order_by(
+        touches.c.at.desc(), touches.c.id.desc()).limit(1)
+    if exclude is not None:
+        query = query.where(touches.c.id != exclude)
+
+    latest = connection.execute(query).first()
+    connection.execute(
+        table.delete().where(table.c.artifact_id == artifact_id))
+    if latest is not None:
+        connection.execute(
+            table.insert().values(
+                artifact_id=artifact_id, state_id=latest.state_id,
+                touch_id=latest.id, at=latest.at))
+
+
+def rebuild_current_states(connection):
+    """
+    Discards and rebuilds the current state projection from the full
+    Touch history. This is needed only for databases which predate the
+    projection table.
+
+    Returns the number of artifacts in the projection.
+    """
+    touches = Touch.__table__
+    later = touches.alias("later")
+    table = CurrentState.__table__
+    connection.execute(table.delete())
+    latest = select(
+        [touches.c.artifact_id, touches.c.state_id,
+         touches.c.id, touches.c.at]).where(
+        touches.c.artifact_id != None).where(
+        ~exists().where(
+            later.c.artifact_id == touches.c.artifact_id).where(
+            or_(later.c.at > touches.c.at, and_(
+                later.c.at == touches.c.at,
+                later.c.id > touches.c.id))))
+    connection.execute(
+        table.insert().from_select(
+            ["artifact_id", "state_id", "touch_id", "at"], latest))
+    return connection.execute(
+        select([func.count()]).select_from(table)).scalar()
+
+
+@event.listens_for(Touch, "after_insert")
+def touch_inserted(mapper, connection, target):
+    if target.artifact_id is not None:
+        advance_current_state(
+            connection, target.artifact_id, target.state_id,
+            target.id, target.at)
+
+
+@event.listens_for(Touch, "after_update")
+def touch_updated(mapper, connection, target):
+    if not any(get_history(target, i).has_changes()
+               for i in ("artifact_id", "state_id", "at")):
+        return
+
+    previous = get_history(target, "artifact_id").deleted or []
+    for artifact_id in set(list(previous) + [target.artifact_id]):
+        if artifact_id is not None:
+            refresh_current_state(connection, artifact_id)
+
+
+@event.listens_for(Touch, "before_delete")
+def touch_deleted(mapper, connection, target):
+    if target.artifact_id is not None:
+        refresh_current_state(
+            connection, target.artifact_id, exclude=target.id)
+
+
+def packed_address(value):
+    """
+    Returns `value` as an :py:mod:`ipaddress` object, or None if it is
+    not an address. An interface such as '192.168.1.4/24' gives its
+    address.
+    """
+    try:
+        return ipaddress.ip_interface(value).ip
+    except (TypeError, ValueError):
+        return None
+
+
+@event.listens_for(IPAddress.value, "set")
+def ipaddress_value_set(target, value, oldvalue, initiator):
+    target.packed = packed_address(value)
+
+
+@event.listens_for(NATRouting.ip_int, "set")
+def natrouting_ip_int_set(target, value, oldvalue, initiator):
+    target.ip_int_packed = packed_address(value)
+
+
+@event.listens_for(NATRouting.ip_ext, "set")
+def natrouting_ip_ext_set(target, value, oldvalue, initiator):
+    target.ip_ext_packed = packed_address(value)
+
+
+def upgrade_packed_addresses(connection):
+    """
+    Adds the packed address columns to tables which predate them, and
+    fills in those left NULL from the string form of the address. It is
+    safe to run more than once.
+
+    Returns the number of values filled in.
+    """
+    inspector = inspect(connection)
+    held = set(inspector.get_table_names())
+    pairs = (
+        (IPAddress.__table__, "value", "packed"),
+        (NATRouting.__table__, "ip_int", "ip_int_packed"),
+        (NATRouting.__table__, "ip_ext", "ip_ext_packed"),
+    )
+    n = 0
+    for table, src, dst in pairs:
+        if table.name not in held:
+            continue
+        columns = {i["name"] for i in inspector.get_columns(table.name)}
+        if dst not in columns:
+            connection.execute("ALTER TABLE {} ADD COLUMN {} {}".format(
+                table.name, dst,
+                table.c[dst].type.compile(dialect=connection.dialect)))
+
+        rows = connection.execute(
+            select([table.c.id, table.c[src]]).where(
+                table.c[dst] == None)).fetchall()
+        values = [
+            {"_id": id_, "_packed": packed_address(value)}
+            for id_, value in rows if packed_address(value) is not None]
+        if values:
+            connection.execute(
+                table.update().where(
+                    table.c.id == bindparam("_id")).values({
+                    dst: bindparam("_packed", type_=table.c[dst].type)}),
+                values)
+            n += len(values)
+    return n
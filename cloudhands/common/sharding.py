@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+#   encoding: UTF-8
+
+import heapq
+import uuid
+
+from sqlalchemy import Integer
+from sqlalchemy import inspect
+from sqlalchemy.orm.interfaces import MANYTOONE
+
+from cloudhands.common.connectors import initialise
+from cloudhands.common.connectors import Registry
+from cloudhands.common.queries import by_uuid
+from cloudhands.common.schema import Artifact
+from cloudhands.common.schema import Component
+
+__doc__ = """
+The sharding module spreads artifacts over several databases. An artifact
+lives, with all its Touches and resources, on the shard chosen by its
+uuid. Reference data is copied to every shard.
+"""
+
+
+def shard_key(value):
+    """
+    Returns the integer from which the shard of `value` is chosen.
+    `value` is a uuid, in any form accepted by :py:class:`uuid.UUID`, or
+    an object with a `uuid` attribute.
+    """
+    value = getattr(value, "uuid", value)
+    if isinstance(value, uuid.UUID):
+        return value.int
+    return uuid.UUID(value).int
+
+
+def copy(obj, session=None):
+    """
+    Returns a transient copy of a mapped object. Integer primary keys and
+    foreign keys are left out, since their values are local to a database.
+
+    Objects to which `obj` refers are found by uuid through `session`,
+    which is on the database the copy is for. A reference which cannot be
+    resolved that way raises ValueError rather than being lost.
+    """
+    mapper = inspect(obj).mapper
+    rv = mapper.class_()
+    links = set()
+    for prop in mapper.column_attrs:
+        if any(c.primary_key and isinstance(c.type, Integer)
+               for c in prop.columns):
+            continue
+        elif any(c.foreign_keys for c in prop.columns):
+            if getattr(obj, prop.key) is not None:
+                links.update(prop.columns)
+        else:
+            setattr(rv, prop.key, getattr(obj, prop.key))
+
+    for rel in mapper.relationships:
+        if rel.direction is not MANYTOONE or rel.viewonly:
+            continue
+        target = getattr(obj, rel.key)
+        if target is None:
+            continue
+        cls = type(target)
+        held = None
+        if session is not None and hasattr(cls, "uuid"):
+            held = session.query(cls).filter(
+                cls.uuid == target.uuid).first()
+        if held is None:
+            raise ValueError("Cannot resolve {}.{} of {}".format(
+                mapper.class_.__name__, rel.key, cls.__name__))
+        setattr(rv, rel.key, held)
+        links.difference_update(rel.local_columns)
+
+    if links:
+        raise ValueError("Cannot copy {} of {}".format(
+            ", ".join(sorted(i.name for i in links)),
+            mapper.class_.__name__))
+    return rv
+
+
+def replicate(session, *objs):
+    """
+    Copies `objs` to the database of `session` unless they are held there
+    already, matching them by uuid. Objects may refer to those before them.
+    Returns the persistent objects in the order given. Nothing is
+    committed.
+    """
+    rv = []
+    for obj in objs:
+        cls = type(obj)
+        held = session.query(cls).filter(cls.uuid == obj.uuid).first()
+        if held is None:
+            held = copy(obj, session)
+            session.add(held)
+            session.flush()
+        rv.append(held)
+    return rv
+
+
+class Shards(object):
+    """
+    A fixed set of databases, each given by URL and managed by the
+    :py:class:`~cloudhands.common.connectors.Registry`. Keyword arguments
+    are passed to the connector of every shard.
+
+    The number and order of the URLs must not change once data is
+    written, since they determine where each artifact is found.
+    """
+
+    def __init__(self, *urls, registry=None, **kwargs):
+        self.registry = registry or Registry()
+        self.urls = urls
+        self.connections = [
+            self.registry.connect(url, **kwargs) for url in urls]
+
+    def __len__(self):
+        return len(self.urls)
+
+    def index(self, value):
+        return shard_key(value) % len(self.urls)
+
+    def session(self, value):
+        """
+        Returns a new session on the shard which holds the artifact
+        identified by `value`, a uuid or an object with one. Touches of an
+        artifact belong on its shard too.
+        """
+        return self.registry.connect(self.urls[self.index(value)]).session
+
+    def sessions(self):
+        return [self.registry.connect(url).session for url in self.urls]
+
+    def map(self, fn, *args):
+        """
+        Calls `fn` with a new session on each shard, in parallel on the
+        thread pool of the registry. Returns the results in shard order.
+        """
+        return list(self.registry.executor().map(
+            lambda s: fn(s, *args), self.sessions()))
+
+    def initialise(self):
+        """
+        Seeds every shard. The Components are made on the first shard and
+        copied by uuid to the others, so that an actor has the same
+        identity everywhere. Returns the total number of rows added.
+        """
+        first, *others = self.sessions()
+        n = initialise(first)
+        components = first.query(Component).all()
+
+        def work(session):
+            held = session.query(Component).count()
+            replicate(session, *components)
+            rv = session.query(Component).count() - held
+            session.commit()
+            return rv + initialise(session)
+
+        return n + sum(self.registry.executor().map(work, others))
+
+    def replicate(self, *objs):
+        """
+        Copies reference objects, such as Organisations and Providers, to
+        every shard which lacks them, matching them by uuid. Objects which
+        refer to others, such as CatalogueItems, must be given after them.
+        Returns, for each shard, the persistent copies in the order given.
+        """
+        def work(session):
+            rv = replicate(session, *objs)
+            session.commit()
+            return rv
+
+        return self.map(work)
+
+    def query(self, build, key=None):
+        """
+        Runs the query made by `build` from a session on every shard, in
+        parallel, and returns the combined results.
+
+        If the query on each shard is ordered by `key`, passing the same
+        `key` function merges the results into one ordered list.
+
+        The sessions are closed once the rows are loaded, so objects are
+        returned detached. Any relationships needed should be loaded
+        eagerly by the query.
+        """
+        def work(session):
+            try:
+                return build(session).all()
+            finally:
+                session.close()
+
+        results = self.map(work)
+        if key is None:
+            return [i for rows in results for i in rows]
+        else:
+            return list(heapq.merge(*results, key=key))
+
+    def artifact(self, value, cls=Artifact):
+        """
+        Returns the artifact identified by `value`, a uuid, from its
+        shard, or None.
+        """
+        return by_uuid(self.session(value), value, cls)
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+#   encoding: UTF-8
+
+import datetime
+import ipaddress
+import random
+import sqlite3
+import unittest
+import uuid
+
+import cloudhands.common
+from cloudhands.common.allocators import AddressPool
+from cloudhands.common.allocators import IntervalSet
+from cloudhands.common.allocators import pools
+from cloudhands.common.allocators import subscription_pool
+from cloudhands.common.connectors import initialise
+from cloudhands.common.connectors import Registry
+
+from cloudhands.common.schema import Component
+from cloudhands.common.schema import IPAddress
+from cloudhands.common.schema import Node
+from cloudhands.common.schema import Organisation
+from cloudhands.common.schema import Provider
+from cloudhands.common.schema import Subscription
+from cloudhands.common.schema import Touch
+
+from cloudhands.common.states import SubscriptionState
+
+
+class IntervalSetTests(unittest.TestCase):
+
+    def test_add_and_discard(self):
+        s = IntervalSet()
+        self.assertIs(None, s.first())
+        self.assertIs(None, s.choice())
+        s.add_interval(10, 19)
+        s.add_interval(30, 39)
+        self.assertEqual(20, len(s))
+        self.assertTrue(s.discard(15))
+        self.assertFalse(s.discard(15))
+        self.assertFalse(s.discard(25))
+        self.assertEqual([10, 16, 30], s.starts)
+        self.assertEqual(19, len(s))
+
+        self.assertTrue(s.add(15))
+        self.assertFalse(s.add(15))
+        self.assertEqual([10, 30], s.starts)
+        s.add_interval(18, 31)
+        self.assertEqual([(10, 39)], list(zip(s.starts, s.ends)))
+        self.assertEqual(list(range(10, 40)), list(s))
+
+        self.assertEqual(10, s.first())
+        rng = random.Random(0)
+        for i in range(100):
+            self.assertIn(s.choice(rng), s)
+
+
+class AddressPoolTests(unittest.TestCase):
+
+    def setUp(self):
+        """ Populate test database"""
+        session = Registry().connect(sqlite3, ":memory:").session
+        initialise(session)
+        org = Organisation(uuid=uuid.uuid4().hex, name="TestOrg")
+        provider = Provider(uuid=uuid.uuid4().hex, name="testcloud.io")
+        subs = Subscription(
+            uuid=uuid.uuid4().hex,
+            model=cloudhands.common.__version__,
+            organisation=org, provider=provider)
+        actor = session.query(Component).first()
+        active = SubscriptionState.get(session, "active")
+        act = Touch(
+            artifact=subs, actor=actor, state=active,
+            at=datetime.datetime.utcnow())
+        net = ipaddress.ip_network("172.16.144.0/29")
+        session.add_all(
+            IPAddress(value=str(ip), provider=provider, touch=act)
+            for ip in net.hosts())
+        session.commit()
+
+    def tearDown(self):
+        """ Every test gets its own in-memory database """
+        pools.clear()
+        r = Registry()
+        r.disconnect(sqlite3, ":memory:")
+
+    def touch(self, session):
+        return Touch(
+            artifact=session.query(Subscription).one(),
+            actor=session.query(Component).first(),
+            state=SubscriptionState.get(session, "active"),
+            at=datetime.datetime.utcnow())
+
+    def test_allocation_skips_existing_addresses(self):
+        session = Registry().connect(sqlite3, ":memory:").session
+        subs = session.query(Subscription).one()
+        pool = subscription_pool(session, subs, "172.16.144.0/28")
+        self.assertIs(pool, subscription_pool(session, subs))
+        self.assertEqual(8, len(pool))
+
+        ip = pool.allocate(session, self.touch(session))
+        self.assertEqual("172.16.144.7", ip.value)
+        self.assertEqual(7, len(pool))
+
+        allocated = [
+            pool.allocate(session, self.touch(session)).value
+            for i in range(7)]
+        self.assertEqual(
+            ["172.16.144.{}".format(n) for n in range(8, 15)], allocated)
+        self.assertIs(None, pool.allocate(session, self.touch(session)))
+
+        session.delete(session.query(IPAddress).filter(
+            IPAddress.value == "172.16.144.9").one())
+        session.commit()
+        pool.release("172.16.144.9")
+        ip = pool.allocate(session, self.touch(session))
+        self.assertEqual("172.16.144.9", ip.value)
+
+    def test_allocation_recovers_from_contention(self):
+        session = Registry().connect(sqlite3, ":memory:").session
+        pool = AddressPool("172.16.144.0/28").load(session)
+
+        # Another process takes addresses behind the pool's back
+        session.add_all(
+            IPAddress(value="172.16.144.{}".format(n), touch=self.touch(
+                session)) for n in (7, 8))
+        session.commit()
+
+        ip = pool.allocate(
+            session, self.touch(session), rng=random.Random(0))
+        self.assertIn(ip.value, ["172.16.144.{}".format(n)
+                                 for n in range(9, 15)])
+        self.assertLessEqual(len(pool), 6)
+        self.assertEqual(9, session.query(IPAddress).count())
+
+    def test_contention_keeps_pending_work(self):
+        session = Registry().connect(sqlite3, ":memory:").session
+        pool = AddressPool("172.16.144.0/28").load(session)
+        session.add_all(
+            IPAddress(value="172.16.144.{}".format(n), touch=self.touch(
+                session)) for n in (7, 8))
+        session.commit()
+
+        act = self.touch(session)
+        session.add(Node(name="test", touch=act))
+        ip = pool.allocate(session, act, rng=random.Random(0))
+        self.assertNotIn(ip.value, ("172.16.144.7", "172.16.144.8"))
+        session.commit()
+        self.assertEqual(1, session.query(Node).count())
+        self.assertEqual(9, session.query(IPAddress).count())
+
+    def test_allocation_is_not_committed(self):
+        session = Registry().connect(sqlite3, ":memory:").session
+        pool = AddressPool("172.16.144.0/28").load(session)
+        act = self.touch(session)
+        session.add(act)
+        session.commit()
+
+        ip = pool.allocate(session, act)
+        session.rollback()
+        pool.release(ip.value)
+        self.assertEqual(6, session.query(IPAddress).count())
+        self.assertEqual(8, len(pool))
+
+    def test_ipv6_pool(self):
+        session = Registry().connect(sqlite3, ":memory:").session
+        pool = AddressPool("2001:db8::/126", "10.0.0.0/30").load(session)
+        self.assertEqual(5, len(pool))
+        values = [
+            pool.allocate(session, self.touch(session)).value
+            for i in range(5)]
+        self.assertEqual(
+            ["10.0.0.1", "10.0.0.2", "2001:db8::1", "2001:db8::2",
+             "2001:db8::3"], values)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+#   encoding: UTF-8
+
+import datetime
+import sqlite3
+import unittest
+import uuid
+
+import cloudhands.common
+from cloudhands.common.archival import TouchArchive
+from cloudhands.common.connectors import initialise
+from cloudhands.common.connectors import Registry
+
+from cloudhands.common.queries import current_state
+from cloudhands.common.schema import Appliance
+from cloudhands.common.schema import Node
+from cloudhands.common.schema import Organisation
+from cloudhands.common.schema import ProviderReport
+from cloudhands.common.schema import Resource
+from cloudhands.common.schema import Touch
+from cloudhands.common.schema import User
+
+from cloudhands.common.states import ApplianceState
+
+
+class TouchArchiveTests(unittest.TestCase):
+
+    def setUp(self):
+        """ Populate test database"""
+        con = Registry().connect(sqlite3, ":memory:")
+        self.archive = TouchArchive()
+        self.archive.attach(con.engine, ":memory:")
+
+        session = con.session
+        initialise(session)
+        user = User(handle="Anon", uuid=uuid.uuid4().hex)
+        org = Organisation(uuid=uuid.uuid4().hex, name="TestOrg")
+        running = ApplianceState.get(session, "running")
+        self.start = datetime.datetime.utcnow() - datetime.timedelta(days=10)
+        for name in ("server01", "server02"):
+            app = Appliance(
+                uuid=uuid.uuid4().hex,
+                model=cloudhands.common.__version__,
+                organisation=org)
+            act = Touch(
+                artifact=app, actor=user, state=running, at=self.start)
+            session.add(Node(name=name, touch=act))
+            for n in range(1, 10):
+                act = Touch(
+                    artifact=app, actor=user, state=running,
+                    at=self.start + datetime.timedelta(days=n))
+                session.add(ProviderReport(power="on", touch=act))
+        session.commit()
+
+    def tearDown(self):
+        """ Every test gets its own in-memory database """
+        r = Registry()
+        r.disconnect(sqlite3, ":memory:")
+
+    def test_move_keeps_latest_touches(self):
+        session = Registry().connect(sqlite3, ":memory:").session
+        before = self.start + datetime.timedelta(days=5, hours=1)
+        self.assertEqual(12, self.archive.move(session, before))
+        self.assertEqual(8, session.query(Touch).count())
+        self.assertEqual(8, session.query(Resource).count())
+        self.assertEqual(0, session.query(Node).count())
+
+        for app in session.query(Appliance):
+            self.assertEqual(4, len(app.recent_touches(10)))
+            self.assertEqual(
+                self.start + datetime.timedelta(days=9),
+                app.latest_touch().at)
+            self.assertIs(
+                ApplianceState.get(session, "running"),
+                current_state(session, app))
+
+        self.assertEqual(0, self.archive.move(session, before))
+        self.assertEqual(6, self.archive.move(
+            session, datetime.timedelta(seconds=0)))
+        self.assertEqual(2, session.query(Touch).count())
+
+    def test_history_reads_archive_on_request(self):
+        session = Registry().connect(sqlite3, ":memory:").session
+        self.archive.move(session, datetime.timedelta(days=3))
+        app = session.query(Appliance).first()
+
+        history = app.recent_touches(20, archive=self.archive)
+        self.assertEqual(10, len(history))
+        self.assertEqual(
+            [self.start + datetime.timedelta(days=n) for n in range(10)],
+            [i.at for i in history])
+        self.assertEqual([Node], [type(i) for i in history[0].resources])
+        self.assertEqual("server01", history[0].resources[0].name)
+        self.assertEqual(
+            [ProviderReport], [type(i) for i in history[1].resources])
+        self.assertIs(history[1], history[1].resources[0].touch)
+
+        session.commit()
+        self.assertEqual(
+            [i.id for i in history[-3:]],
+            [i.id for i in app.recent_touches(3, archive=self.archive)])
+        self.assertEqual(
+            [i.id for i in history[2:]],
+            [i.id for i in app.touches_since(
+                history[1], archive=self.archive)])
+        self.assertEqual(
+            [i.id for i in history[2:]],
+            [i.id for i in app.touches_since(
+                history[1].id, archive=self.archive)])
+        self.assertEqual(
+            [i.id for i in history[7:]],
+            [i.id for i in app.touches_since(
+                history[6].at + datetime.timedelta(seconds=1),
+                archive=self.archive)])
+
+    def test_archived_ids_are_not_reused(self):
+        session = Registry().connect(sqlite3, ":memory:").session
+        self.archive.move(session, datetime.timedelta(seconds=0))
+        app = session.query(Appliance).first()
+        archived = app.recent_touches(20, archive=self.archive)
+
+        act = Touch(
+            artifact=app, actor=archived[0].actor, state=archived[0].state,
+            at=datetime.datetime.utcnow())
+        session.add(Node(name="server03", touch=act))
+        session.commit()
+        self.assertGreater(act.id, max(i.id for i in archived))
+        self.assertIs(act, app.latest_touch())
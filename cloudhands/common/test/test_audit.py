@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+#   encoding: UTF-8
+
+from collections import OrderedDict
+import os.path
+import sqlite3
+import tempfile
+import unittest
+
+from cloudhands.common.audit import audit
+from cloudhands.common.audit import catalogue
+from cloudhands.common.audit import open_session
+from cloudhands.common.connectors import Registry
+from cloudhands.common.schema import Label
+
+
+class AuditTests(unittest.TestCase):
+
+    def tearDown(self):
+        """ Every test gets its own in-memory database """
+        r = Registry()
+        r.disconnect(sqlite3, ":memory:")
+
+    def test_catalogue_has_no_scans(self):
+        session = Registry().connect(sqlite3, ":memory:").session
+        checks = list(audit(session))
+        self.assertEqual(len(catalogue), len(checks))
+        for check in checks:
+            self.assertTrue(check.plan)
+            self.assertFalse(check.scans, check)
+
+    def test_unindexed_query_is_reported(self):
+        session = Registry().connect(sqlite3, ":memory:").session
+        queries = OrderedDict([
+            ("label by name",
+                lambda s: s.query(Label).filter(Label.name == "")),
+        ])
+        check = next(audit(session, queries))
+        self.assertIn("labels", check.scans)
+
+
+class AuditFileTests(unittest.TestCase):
+
+    def setUp(self):
+        self.locn = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.locn.name, "audit.sl3")
+        Registry().connect(sqlite3, self.path)
+        Registry().disconnect(sqlite3, self.path)
+        con = sqlite3.connect(self.path)
+        con.execute("DROP INDEX ix_touches_actor_id")
+        con.commit()
+        con.close()
+
+    def tearDown(self):
+        self.locn.cleanup()
+
+    def indexes(self):
+        con = sqlite3.connect(self.path)
+        try:
+            return {row[0] for row in con.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index'")}
+        finally:
+            con.close()
+
+    def test_missing_index_is_reported(self):
+        session = open_session(self.path)
+        checks = {i.name: i for i in audit(session)}
+        session.close()
+        session.bind.dispose()
+        self.assertIn("touches", checks["touches by actor"].scans)
+        self.assertFalse(checks["touches in state"].scans)
+        self.assertNotIn("ix_touches_actor_id", self.indexes())
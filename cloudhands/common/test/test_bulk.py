@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+#   encoding: UTF-8
+
+import datetime
+import ipaddress
+import sqlite3
+import unittest
+import uuid
+
+import sqlalchemy.exc
+
+import cloudhands.common
+from cloudhands.common.bulk import append
+from cloudhands.common.connectors import initialise
+from cloudhands.common.connectors import Registry
+
+from cloudhands.common.queries import current_state
+from cloudhands.common.schema import Appliance
+from cloudhands.common.schema import Component
+from cloudhands.common.schema import IPAddress
+from cloudhands.common.schema import Label
+from cloudhands.common.schema import Node
+from cloudhands.common.schema import Organisation
+from cloudhands.common.schema import Provider
+from cloudhands.common.schema import Resource
+from cloudhands.common.schema import Subscription
+from cloudhands.common.schema import Touch
+
+from cloudhands.common.states import ApplianceState
+from cloudhands.common.states import SubscriptionState
+
+
+class BulkAppendTests(unittest.TestCase):
+
+    def setUp(self):
+        """ Populate test database"""
+        session = Registry().connect(sqlite3, ":memory:").session
+        initialise(session)
+        org = Organisation(uuid=uuid.uuid4().hex, name="TestOrg")
+        provider = Provider(uuid=uuid.uuid4().hex, name="testcloud.io")
+        session.add_all((
+            Subscription(
+                uuid=uuid.uuid4().hex,
+                model=cloudhands.common.__version__,
+                organisation=org, provider=provider),
+            Appliance(
+                uuid=uuid.uuid4().hex,
+                model=cloudhands.common.__version__,
+                organisation=org),
+        ))
+        session.commit()
+
+    def tearDown(self):
+        """ Every test gets its own in-memory database """
+        r = Registry()
+        r.disconnect(sqlite3, ":memory:")
+
+    def test_append_touches_with_resources(self):
+        session = Registry().connect(sqlite3, ":memory:").session
+        actor = session.query(Component).filter(
+            Component.handle == "burst.controller").one()
+        provider = session.query(Provider).one()
+        subs = session.query(Subscription).one()
+        app = session.query(Appliance).one()
+        active = session.query(SubscriptionState).filter(
+            SubscriptionState.name == "active").one()
+        provisioning = session.query(ApplianceState).filter(
+            ApplianceState.name == "provisioning").one()
+
+        now = datetime.datetime.utcnow()
+        net = ipaddress.ip_network("172.16.144.0/29")
+        ids = append(session, [
+            (subs, actor, active,
+                [IPAddress(value=str(ip), provider=provider)
+                 for ip in net.hosts()]),
+            (app, actor, provisioning,
+                [Label(name="test_server01"),
+                 Node(name="test_server01", provider=provider)], now),
+            (app.id, actor.id, provisioning.id, []),
+        ])
+
+        self.assertEqual(3, len(ids))
+        self.assertEqual(3, session.query(Touch).count())
+        self.assertEqual(6, session.query(IPAddress).count())
+        self.assertEqual(
+            {provider}, {i.provider for i in session.query(IPAddress)})
+        self.assertEqual(8, session.query(Resource).count())
+
+        touch = session.query(Touch).get(ids[1])
+        self.assertEqual(
+            {Label, Node}, {type(i) for i in touch.resources})
+        self.assertEqual(now, touch.at)
+        self.assertEqual(ids[2], app.latest_touch().id)
+        self.assertIs(provisioning, current_state(session, app))
+        self.assertIs(active, current_state(session, subs))
+
+        # The ORM carries on from where the bulk writer left off
+        act = Touch(artifact=app, actor=actor, state=provisioning,
+                    at=datetime.datetime.utcnow())
+        session.add(IPAddress(value="192.168.1.4", touch=act))
+        session.commit()
+        self.assertEqual(9, session.query(Resource).count())
+
+    def test_failed_append_writes_nothing(self):
+        session = Registry().connect(sqlite3, ":memory:").session
+        actor = session.query(Component).first()
+        subs = session.query(Subscription).one()
+        active = session.query(SubscriptionState).filter(
+            SubscriptionState.name == "active").one()
+
+        self.assertRaises(
+            sqlalchemy.exc.IntegrityError, append, session, [
+                (subs, actor, active, [IPAddress(value="192.168.1.4")]),
+                (subs, actor, active, [IPAddress(value="192.168.1.4")]),
+            ])
+        self.assertEqual(0, session.query(Touch).count())
+        self.assertEqual(0, session.query(Resource).count())
+        self.assertIs(None, current_state(session, subs))
+
+    def test_transient_reference_is_rejected(self):
+        session = Registry().connect(sqlite3, ":memory:").session
+        actor = Component(handle="transient", uuid=uuid.uuid4().hex)
+        subs = session.query(Subscription).one()
+        self.assertRaises(
+            ValueError, append, session, [(subs, actor, None, [])])
@@ -1,13 +1,39 @@
 #!/usr/bin/env python3
 # encoding: UTF-8
 
+import asyncio
+import datetime
+import ipaddress
+import os.path
 import sqlite3
+import sqlalchemy.exc
+import tempfile
+import threading
+import time
 import unittest
+import uuid
 
+import cloudhands.common
+from cloudhands.common.connectors import AsyncSession
+from cloudhands.common.connectors import Connector
+from cloudhands.common.connectors import create_schema
+from cloudhands.common.connectors import fingerprints
 from cloudhands.common.connectors import initialise
 from cloudhands.common.connectors import Registry
+from cloudhands.common.connectors import schema_fingerprint
+from cloudhands.common.connectors import schema_shortfall
+from cloudhands.common.connectors import SQLite3Connector
+from cloudhands.common.connectors import UnitOfWork
+from cloudhands.common.connectors import is_busy
 
+from cloudhands.common.schema import Component
+from cloudhands.common.schema import IPAddress
+from cloudhands.common.schema import metadata
+from cloudhands.common.schema import Organisation
+from cloudhands.common.schema import Provider
 from cloudhands.common.schema import State
+from cloudhands.common.schema import Subscription
+from cloudhands.common.schema import Touch
 
 
 class ConnectionTest(unittest.TestCase):
@@ -27,6 +53,19 @@ class ConnectionTest(unittest.TestCase):
 
         self.assertEqual(0, initialise(con.session))
 
+    def test_initialise_adds_only_missing_rows(self):
+        con = Registry().connect(sqlite3, ":memory:")
+        initialise(con.session)
+        handles = {i.handle for i in con.session.query(Component)}
+        self.assertEqual(2, len(handles))
+
+        state = con.session.query(State).first()
+        con.session.delete(state)
+        con.session.commit()
+        self.assertEqual(1, initialise(con.session))
+        self.assertEqual(
+            handles, {i.handle for i in con.session.query(Component)})
+
     def test_connect_and_disconnect(self):
         r = Registry()
         self.assertEqual(0, len(list(r.items)))
@@ -45,3 +84,527 @@ class ConnectionTest(unittest.TestCase):
         dup = r.connect(sqlite3, ":memory:")
         self.assertIsNot(con.engine, dup.engine)
         self.assertEqual(1, len(list(r.items)))
+
+
+class ProfileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.locn = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.locn.name, "test.sl3")
+
+    def tearDown(self):
+        Registry().disconnect(sqlite3, self.path)
+        self.locn.cleanup()
+
+    def pragma(self, con, name):
+        return con.engine.execute("pragma {}".format(name)).scalar()
+
+    def test_default_keeps_rollback_journal(self):
+        con = Registry().connect(sqlite3, self.path)
+        self.assertEqual("delete", self.pragma(con, "journal_mode"))
+        self.assertEqual(1, self.pragma(con, "foreign_keys"))
+
+    def test_balanced_profile(self):
+        con = Registry().connect(sqlite3, self.path, profile="balanced")
+        self.assertEqual("wal", self.pragma(con, "journal_mode"))
+        self.assertEqual(1, self.pragma(con, "synchronous"))
+        self.assertEqual(-65536, self.pragma(con, "cache_size"))
+        self.assertEqual(2, self.pragma(con, "temp_store"))
+        self.assertEqual(5000, self.pragma(con, "busy_timeout"))
+        self.assertEqual(1, self.pragma(con, "foreign_keys"))
+
+    def test_bulk_load_profile(self):
+        con = Registry().connect(sqlite3, self.path, profile="bulk-load")
+        self.assertEqual("wal", self.pragma(con, "journal_mode"))
+        self.assertEqual(0, self.pragma(con, "synchronous"))
+
+    def test_profile_fixed_at_first_connect(self):
+        r = Registry()
+        con = r.connect(sqlite3, self.path, profile="durable")
+        dup = r.connect(sqlite3, self.path, profile="bulk-load")
+        self.assertIs(con.engine, dup.engine)
+        self.assertEqual(2, self.pragma(dup, "synchronous"))
+
+    def test_unknown_profile(self):
+        self.assertRaises(KeyError, SQLite3Connector, profile="turbo")
+
+
+class PooledTest(unittest.TestCase):
+
+    def setUp(self):
+        self.locn = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.locn.name, "test.sl3")
+
+    def tearDown(self):
+        Registry().disconnect(sqlite3, self.path)
+        self.locn.cleanup()
+
+    def test_memory_cannot_be_pooled(self):
+        self.assertRaises(
+            ValueError, Registry().connect, sqlite3, ":memory:", pool_size=2)
+        self.assertNotIn("sqlite:///:memory:", Registry().items)
+
+    def test_threads_have_own_connections(self):
+        con = Registry().connect(
+            sqlite3, self.path, profile="balanced", pool_size=2)
+        self.assertEqual(2, con.engine.pool.size())
+
+        ready = threading.Barrier(2)
+        seen = []
+
+        def work():
+            session = Registry().connect(sqlite3, self.path).session
+            seen.append(id(session.connection().connection.connection))
+            ready.wait(timeout=5)
+            session.close()
+
+        threads = [threading.Thread(target=work) for i in range(2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(2, len(set(seen)))
+
+    def test_transactions_are_isolated(self):
+        r = Registry()
+        writer = r.connect(sqlite3, self.path, pool_size=2).session
+        reader = r.connect(sqlite3, self.path).session
+        writer.add(Component(handle="pooled.test", uuid="0" * 32))
+        writer.flush()
+        self.assertEqual(1, writer.query(Component).count())
+        self.assertEqual(0, reader.query(Component).count())
+        writer.commit()
+        reader.commit()
+        self.assertEqual(1, reader.query(Component).count())
+        writer.close()
+        reader.close()
+
+
+class URLTest(unittest.TestCase):
+
+    def setUp(self):
+        self.locn = tempfile.TemporaryDirectory()
+        self.url = "sqlite:///" + os.path.join(self.locn.name, "test.sl3")
+
+    def tearDown(self):
+        r = Registry()
+        r.disconnect(self.url)
+        r.disconnect("sqlite://")
+        self.locn.cleanup()
+
+    def test_module_and_path_map_to_url(self):
+        r = Registry()
+        con = r.connect(sqlite3, ":memory:")
+        dup = r.connect("sqlite:///:memory:")
+        self.assertIs(con.engine, dup.engine)
+        self.assertIs(sqlite3, con.module)
+        self.assertEqual(":memory:", dup.path)
+        dis = r.disconnect("sqlite:///:memory:")
+        self.assertIs(con.engine, dis.engine)
+        self.assertEqual(0, len(list(r.items)))
+
+    def test_in_memory_url(self):
+        con = Registry().connect("sqlite://")
+        self.assertEqual(0, con.session.query(State).count())
+        self.assertIsNone(con.path)
+
+    def test_file_url_with_engine_options(self):
+        con = Registry().connect(
+            self.url, profile="balanced", pool_size=3, max_overflow=1,
+            statement_cache_size=16,
+            isolation_level="SERIALIZABLE",
+            execution_options={"stream_results": False})
+        self.assertEqual(3, con.engine.pool.size())
+        self.assertEqual(1, con.engine.pool._max_overflow)
+        options = con.engine._execution_options
+        self.assertFalse(options["stream_results"])
+        self.assertEqual(16, options["compiled_cache"].capacity)
+        self.assertEqual(
+            "SERIALIZABLE",
+            con.engine.dialect.get_isolation_level(
+                con.engine.raw_connection().connection))
+
+        initialise(con.session)
+        con.session.query(State).count()
+        con.engine.execute(State.__table__.select()).fetchall()
+        self.assertTrue(options["compiled_cache"])
+        self.assertEqual(
+            "wal", con.engine.execute("pragma journal_mode").scalar())
+
+    def test_connector_by_dialect(self):
+        calls = []
+
+        class Spy(SQLite3Connector):
+
+            def configure(self, engine):
+                calls.append(engine)
+                super().configure(engine)
+
+        r = Registry()
+        r.connectors = dict(r.connectors, sqlite=Spy)
+        try:
+            con = r.connect("sqlite://")
+        finally:
+            del r.connectors
+        self.assertEqual([con.engine], calls)
+        self.assertTrue(issubclass(SQLite3Connector, Connector))
+
+
+class ReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.locn = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.locn.name, "test db.sl3")
+
+    def tearDown(self):
+        r = Registry()
+        r.disconnect(sqlite3, self.path)
+        r.disconnect(sqlite3, ":memory:")
+        self.locn.cleanup()
+
+    def test_reader_sees_committed_writes(self):
+        r = Registry()
+        writer = r.connect(sqlite3, self.path, profile="balanced").session
+        reader = r.reader(sqlite3, self.path).session
+        self.assertIsNot(writer.bind, reader.bind)
+        self.assertEqual(0, reader.query(Component).count())
+
+        writer.add(Component(handle="reader.test", uuid="0" * 32))
+        writer.commit()
+        reader.commit()
+        self.assertEqual(1, reader.query(Component).count())
+        self.assertEqual(
+            1, reader.connection().execute("pragma query_only").scalar())
+        self.assertEqual(
+            "wal", reader.connection().execute(
+                "pragma journal_mode").scalar())
+
+    def test_reader_cannot_write(self):
+        reader = Registry().reader(sqlite3, self.path).session
+        reader.add(Component(handle="reader.test", uuid="0" * 32))
+        self.assertRaises(sqlalchemy.exc.OperationalError, reader.commit)
+        reader.rollback()
+
+    def test_reader_engine_is_kept(self):
+        r = Registry()
+        con = r.reader(sqlite3, self.path)
+        self.assertIs(con.engine, r.reader(sqlite3, self.path).engine)
+        self.assertIsNot(con.engine, r.connect(sqlite3, self.path).engine)
+
+    def test_disconnect_forgets_factories(self):
+        r = Registry()
+        writer = r.connect(sqlite3, self.path).engine
+        reader = r.reader(sqlite3, self.path).engine
+        self.assertIn(writer, r._factories)
+        self.assertIn(reader, r._factories)
+        r.disconnect(sqlite3, self.path)
+        self.assertNotIn(writer, r._factories)
+        self.assertNotIn(reader, r._factories)
+
+    def test_memory_reader_shares_writer(self):
+        r = Registry()
+        con = r.reader(sqlite3, ":memory:")
+        self.assertIs(con.engine, r.connect(sqlite3, ":memory:").engine)
+
+
+class FingerprintTest(unittest.TestCase):
+
+    def setUp(self):
+        self.locn = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.locn.name, "test.sl3")
+        self.statements = []
+        sqlalchemy.event.listen(
+            sqlalchemy.engine.Engine, "before_cursor_execute", self.record)
+
+    def tearDown(self):
+        sqlalchemy.event.remove(
+            sqlalchemy.engine.Engine, "before_cursor_execute", self.record)
+        Registry().disconnect(sqlite3, self.path)
+        self.locn.cleanup()
+
+    def record(self, conn, cursor, statement, parameters, context, many):
+        self.statements.append(statement)
+
+    def test_up_to_date_database_takes_one_query(self):
+        r = Registry()
+        r.connect(sqlite3, self.path)
+        self.assertGreater(len(self.statements), len(metadata.tables))
+        r.disconnect(sqlite3, self.path)
+
+        self.statements.clear()
+        con = r.connect(sqlite3, self.path)
+        self.assertEqual(1, len(self.statements))
+        self.assertEqual(0, con.session.query(State).count())
+
+    def test_changed_fingerprint_runs_ddl(self):
+        engine = Registry().connect(sqlite3, self.path).engine
+        engine.execute(fingerprints.update().values(fingerprint="0" * 40))
+        self.assertTrue(create_schema(engine))
+        self.assertFalse(create_schema(engine))
+        self.assertEqual(
+            1, engine.execute(
+                sqlalchemy.select([sqlalchemy.func.count()]).select_from(
+                    fingerprints)).scalar())
+
+    def test_missing_indexes_are_created(self):
+        engine = Registry().connect(sqlite3, self.path).engine
+        engine.execute("drop index ix_touches_at")
+        engine.execute("drop index ix_resources_touch_id_typ")
+        engine.execute(fingerprints.update().values(fingerprint="0" * 40))
+        self.assertEqual(
+            ["touches.ix_touches_at", "resources.ix_resources_touch_id_typ"],
+            sorted(schema_shortfall(engine, metadata), reverse=True))
+
+        self.assertTrue(create_schema(engine))
+        self.assertEqual([], schema_shortfall(engine, metadata))
+        self.assertFalse(create_schema(engine))
+
+    def test_packed_addresses_are_added_and_filled(self):
+        con = Registry().connect(sqlite3, self.path)
+        initialise(con.session)
+        provider = Provider(uuid=uuid.uuid4().hex, name="testcloud.io")
+        act = Touch(
+            artifact=Subscription(
+                uuid=uuid.uuid4().hex, model=cloudhands.common.__version__,
+                organisation=Organisation(
+                    uuid=uuid.uuid4().hex, name="TestOrg"),
+                provider=provider),
+            actor=con.session.query(Component).first(),
+            state=con.session.query(State).first(),
+            at=datetime.datetime.utcnow())
+        con.session.add_all([
+            IPAddress(value="10.0.0.2", provider=provider, touch=act),
+            IPAddress(value="fe80::1", provider=provider, touch=act),
+            IPAddress(value="unknown", provider=provider, touch=act)])
+        con.session.commit()
+        con.session.close()
+
+        for statement in (
+            "create table old as select id, value from ipaddresses",
+            "drop table ipaddresses",
+            "create table ipaddresses ("
+            "id integer not null primary key references resources (id), "
+            "value varchar(64) not null unique)",
+            "insert into ipaddresses select id, value from old",
+            "drop table old",
+        ):
+            con.engine.execute(statement)
+        con.engine.execute(
+            fingerprints.update().values(fingerprint="0" * 40))
+        self.assertIn(
+            "ipaddresses.packed", schema_shortfall(con.engine, metadata))
+
+        self.assertTrue(create_schema(con.engine))
+        self.assertEqual([], schema_shortfall(con.engine, metadata))
+        self.assertFalse(create_schema(con.engine))
+        self.assertEqual(
+            [ipaddress.ip_address("10.0.0.2"),
+             ipaddress.ip_address("fe80::1"), None],
+            [i.packed for i in con.session.query(
+                IPAddress).order_by(IPAddress.id)])
+
+    def test_missing_column_is_not_stamped(self):
+        engine = sqlalchemy.create_engine("sqlite://")
+        old = sqlalchemy.MetaData()
+        sqlalchemy.Table(
+            "widgets", old,
+            sqlalchemy.Column("id", sqlalchemy.Integer, primary_key=True))
+        self.assertTrue(create_schema(engine, old))
+        self.assertFalse(create_schema(engine, old))
+
+        new = sqlalchemy.MetaData()
+        sqlalchemy.Table(
+            "widgets", new,
+            sqlalchemy.Column("id", sqlalchemy.Integer, primary_key=True),
+            sqlalchemy.Column("name", sqlalchemy.String(64)))
+        self.assertEqual(["widgets.name"], schema_shortfall(engine, new))
+        with self.assertLogs("cloudhands.common.schema", "WARNING"):
+            self.assertTrue(create_schema(engine, new))
+        self.assertEqual(
+            schema_fingerprint(old, engine.dialect),
+            engine.execute(sqlalchemy.select(
+                [fingerprints.c.fingerprint])).scalar())
+        self.assertTrue(create_schema(engine, new))
+
+
+class ConcurrentInitialiseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.locn = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.locn.name, "test.sl3")
+
+    def tearDown(self):
+        Registry().disconnect(sqlite3, self.path)
+        self.locn.cleanup()
+
+    def test_concurrent_initialise(self):
+        Registry().connect(
+            sqlite3, self.path, profile="balanced", pool_size=4)
+        results = []
+
+        def work():
+            session = Registry().connect(sqlite3, self.path).session
+            results.append(initialise(session))
+            session.close()
+
+        threads = [threading.Thread(target=work) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        session = Registry().connect(sqlite3, self.path).session
+        self.assertEqual(4, len(results))
+        self.assertEqual(
+            session.query(State).count() + 2, sum(results))
+        self.assertEqual(2, session.query(Component).count())
+        session.close()
+
+
+class AsyncTest(unittest.TestCase):
+
+    def setUp(self):
+        self.locn = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.locn.name, "test.sl3")
+        self.loop = asyncio.get_event_loop()
+
+    def tearDown(self):
+        Registry().disconnect(sqlite3, self.path)
+        self.locn.cleanup()
+
+    def test_loop_runs_while_database_busy(self):
+        ticks = []
+
+        def busy(session):
+            time.sleep(0.2)
+            return session.query(State).count()
+
+        async def ticker():
+            for i in range(10):
+                ticks.append(i)
+                await asyncio.sleep(0.01)
+
+        con = Registry().connect(sqlite3, self.path)
+        rv, _ = self.loop.run_until_complete(asyncio.gather(
+            Registry().run(busy, con.session), ticker()))
+        self.assertEqual(0, rv)
+        self.assertEqual(10, len(ticks))
+        con.session.close()
+
+    def test_async_session(self):
+        con = Registry().async_connect(
+            sqlite3, self.path, profile="balanced", pool_size=2)
+        self.assertIsInstance(con.session, AsyncSession)
+
+        async def work(session):
+            n = await session.run(initialise)
+            session.session.add(Component(handle="async.test", uuid="0" * 32))
+            await session.commit()
+            rv = await session.all(
+                session.session.query(Component).order_by(Component.handle))
+            top = await session.scalar(
+                session.session.query(
+                    State.id).order_by(State.id.desc()).limit(1))
+            await session.close()
+            return n, rv, top
+
+        n, rv, top = self.loop.run_until_complete(work(con.session))
+        self.assertNotEqual(0, n)
+        self.assertEqual(3, len(rv))
+        self.assertEqual("async.test", rv[0].handle)
+        self.assertEqual(n - 2, top)
+
+
+class UnitOfWorkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.locn = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.locn.name, "test.sl3")
+        self.con = Registry().connect(
+            sqlite3, self.path, pool_size=2,
+            connect_args={"timeout": 0})
+
+    def tearDown(self):
+        self.con.session.close()
+        Registry().disconnect(sqlite3, self.path)
+        self.locn.cleanup()
+
+    def lock(self, seconds):
+        """
+        Holds the write lock of the database from another connection.
+        """
+        held = threading.Event()
+
+        def work():
+            con = sqlite3.connect(self.path, isolation_level=None)
+            con.execute("BEGIN IMMEDIATE")
+            held.set()
+            time.sleep(seconds)
+            con.execute("ROLLBACK")
+            con.close()
+
+        thread = threading.Thread(target=work)
+        thread.start()
+        held.wait(timeout=5)
+        return thread
+
+    def test_session_factory_cached(self):
+        r = Registry()
+        dup = r.connect(sqlite3, self.path)
+        self.assertIs(type(self.con.session), type(dup.session))
+        self.assertIsNot(self.con.session, dup.session)
+        self.assertFalse(dup.session.autoflush)
+
+    def test_commit(self):
+        uow = UnitOfWork(self.con.session)
+        for attempt in uow:
+            with attempt as session:
+                session.add(Component(handle="uow.test", uuid="0" * 32))
+        self.assertEqual(0, uow.retries)
+        self.assertEqual(
+            1, Registry().connect(sqlite3, self.path).session.query(
+                Component).count())
+
+    def test_rollback_on_error(self):
+        uow = UnitOfWork(self.con.session)
+        with self.assertRaises(ZeroDivisionError):
+            for attempt in uow:
+                with attempt as session:
+                    session.add(Component(handle="uow.test", uuid="0" * 32))
+                    session.flush()
+                    1 / 0
+        self.assertEqual(0, uow.retries)
+        self.assertEqual(0, self.con.session.query(Component).count())
+
+    def test_retry_when_busy(self):
+        thread = self.lock(0.2)
+        uow = UnitOfWork(self.con.session, limit=20, delay=0.02, cap=0.05)
+        for attempt in uow:
+            with attempt as session:
+                session.add(Component(handle="uow.test", uuid="0" * 32))
+        thread.join()
+        self.assertGreater(uow.retries, 0)
+        self.assertEqual(1, self.con.session.query(Component).count())
+
+    def test_retries_exhausted(self):
+        thread = self.lock(0.5)
+        uow = UnitOfWork(self.con.session, limit=2, delay=0.001)
+        try:
+            with self.assertRaises(sqlalchemy.exc.OperationalError) as cm:
+                for attempt in uow:
+                    with attempt as session:
+                        session.add(
+                            Component(handle="uow.test", uuid="0" * 32))
+        finally:
+            thread.join()
+        self.assertTrue(is_busy(cm.exception))
+        self.assertEqual(2, uow.retries)
+
+    def test_single_attempt(self):
+        thread = self.lock(0.2)
+        try:
+            with self.assertRaises(sqlalchemy.exc.OperationalError):
+                with UnitOfWork(self.con.session) as session:
+                    session.add(Component(handle="uow.test", uuid="0" * 32))
+        finally:
+            thread.join()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+#   encoding: UTF-8
+
+import logging
+import os.path
+import sqlite3
+import tempfile
+import unittest
+
+import sqlalchemy.exc
+
+from cloudhands.common.connectors import initialise
+from cloudhands.common.connectors import Registry
+from cloudhands.common.instrumentation import Histogram
+from cloudhands.common.instrumentation import Instrument
+from cloudhands.common.instrumentation import bounds
+from cloudhands.common.instrumentation import normalise
+from cloudhands.common.schema import Component
+from cloudhands.common.schema import State
+
+
+class NormaliseTests(unittest.TestCase):
+
+    def test_literals_folded(self):
+        self.assertEqual(
+            "SELECT a FROM t WHERE b = ? AND c = ? AND d IN (?...)",
+            normalise(
+                "SELECT a FROM t\n WHERE b = 'it''s' AND c = 3.5 "
+                "AND d IN (?, ?, ?)"))
+
+    def test_identifiers_kept(self):
+        self.assertEqual(
+            "SELECT t1.x FROM t1 WHERE t1.y = ?",
+            normalise("SELECT t1.x FROM t1 WHERE t1.y = ?"))
+
+
+class HistogramTests(unittest.TestCase):
+
+    def test_observe(self):
+        h = Histogram()
+        for i in (0.00005, 0.003, 0.003, 20):
+            h.observe(i)
+        rv = h.snapshot()
+        self.assertEqual(4, rv["count"])
+        self.assertEqual(20, rv["max"])
+        self.assertAlmostEqual(20.00605, rv["seconds"])
+        counts = dict(rv["buckets"])
+        self.assertEqual(1, counts[bounds[0]])
+        self.assertEqual(2, counts[0.005])
+        self.assertEqual(1, counts[float("inf")])
+        self.assertEqual(4, sum(counts.values()))
+
+
+class InstrumentTests(unittest.TestCase):
+
+    def setUp(self):
+        self.locn = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.locn.name, "test.sl3")
+
+    def tearDown(self):
+        r = Registry()
+        r.disconnect(sqlite3, self.path)
+        r.disconnect(sqlite3, ":memory:")
+        self.locn.cleanup()
+
+    def test_statements_timed_and_rows_counted(self):
+        instrument = Instrument()
+        session = Registry().connect(
+            sqlite3, ":memory:", instrument=instrument).session
+        n = initialise(session)
+        self.assertEqual(n - 2, len(session.query(State).all()))
+        session.query(State).filter(State.name == "x").all()
+
+        rv = instrument.snapshot()
+        selects = [
+            v for k, v in rv["statements"].items()
+            if k.startswith("SELECT") and "FROM states" in k
+            and "states.name = ?" not in k]
+        self.assertTrue(selects)
+        self.assertIn(n - 2, [i["rows"] for i in selects])
+        self.assertTrue(all(i["count"] for i in rv["statements"].values()))
+        inserts = [
+            v for k, v in rv["statements"].items()
+            if k.startswith("INSERT OR IGNORE INTO states")]
+        self.assertEqual([n - 2], [i["rows"] for i in inserts])
+        self.assertGreater(rv["checkout"]["count"], 0)
+
+        instrument.reset()
+        self.assertFalse(instrument.snapshot()["statements"])
+
+    def test_slow_queries_logged_with_plan(self):
+        instrument = Instrument(threshold=0)
+        session = Registry().connect(
+            sqlite3, self.path, pool_size=2, instrument=instrument).session
+        initialise(session)
+        with self.assertLogs(
+            "cloudhands.common.slowquery", logging.WARNING
+        ) as cm:
+            session.query(Component).filter(
+                Component.handle == "x").all()
+        self.assertTrue(any("plan: " in i for i in cm.output))
+        self.assertTrue(any("actors.handle" in i for i in cm.output))
+
+    def test_slow_query_parameters_not_logged(self):
+        instrument = Instrument(threshold=0, explain=False)
+        session = Registry().connect(
+            sqlite3, ":memory:", instrument=instrument).session
+        with self.assertLogs(
+            "cloudhands.common.slowquery", logging.DEBUG
+        ) as cm:
+            session.query(Component).filter(
+                Component.handle == "secret.handle").all()
+        self.assertFalse(any("secret.handle" in i for i in cm.output))
+
+        instrument.parameters = True
+        with self.assertLogs(
+            "cloudhands.common.slowquery", logging.DEBUG
+        ) as cm:
+            session.query(Component).filter(
+                Component.handle == "secret.handle").all()
+        self.assertTrue(any(
+            i.startswith("DEBUG") and "secret.handle" in i
+            for i in cm.output))
+
+    def test_checkout_timed_after_dispose(self):
+        instrument = Instrument()
+        engine = Registry().connect(
+            sqlite3, self.path, pool_size=2, instrument=instrument).engine
+        engine.dispose()
+        instrument.reset()
+        engine.execute("select 1").fetchall()
+        self.assertEqual(1, instrument.snapshot()["checkout"]["count"])
+
+    def test_failed_statement_forgets_start(self):
+        instrument = Instrument()
+        engine = Registry().connect(
+            sqlite3, self.path, pool_size=1, instrument=instrument).engine
+        with engine.connect() as conn:
+            self.assertRaises(
+                sqlalchemy.exc.OperationalError,
+                conn.execute, "select * from nowhere")
+            self.assertEqual([], conn.info["cloudhands_start"])
+
+    def test_reader_instrumented(self):
+        instrument = Instrument()
+        reader = Registry().reader(
+            sqlite3, self.path, instrument=instrument).session
+        reader.query(State).count()
+        self.assertTrue(any(
+            "count(*)" in k for k in instrument.snapshot()["statements"]))
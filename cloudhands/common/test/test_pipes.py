@@ -2,10 +2,23 @@
 #   encoding: UTF-8
 
 import asyncio
+import datetime
+import multiprocessing
 import os
+import threading
 import unittest
 
+from cloudhands.common.pipes import ChunkedCodec
+from cloudhands.common.pipes import LiteralCodec
+from cloudhands.common.pipes import MarshalCodec
+from cloudhands.common.pipes import PickleCodec
 from cloudhands.common.pipes import PipeQueue
+from cloudhands.common.pipes import RingQueue
+from cloudhands.common.pipes import SimplePipeQueue
+from cloudhands.common.pipes import SimpleRingQueue
+from cloudhands.common.pipes import SimpleSocketQueue
+from cloudhands.common.pipes import SocketQueue
+from cloudhands.common.pipes import codecs
 
 
 class PipeQueueTest(unittest.TestCase):
@@ -67,6 +80,44 @@ class PipeQueueTest(unittest.TestCase):
                 self.assertEqual(i, rv[0])
                 self.assertEqual("string", rv[1])
 
+    def test_burst_read_in_one_wakeup(self):
+        loop = asyncio.get_event_loop()
+        with PipeQueue(self.path) as pq:
+            for i in range(500):
+                pq.put_nowait((i, "string"))
+            loop.run_until_complete(asyncio.sleep(0))
+            self.assertEqual(500, pq._q.qsize())
+
+            rv = loop.run_until_complete(pq.get_many(200, timeout=2))
+            self.assertEqual([(i, "string") for i in range(200)], rv)
+            rv = loop.run_until_complete(pq.get_many(1000, timeout=2))
+            self.assertEqual(300, len(rv))
+            self.assertEqual((499, "string"), rv[-1])
+
+    def test_undecodable_message_skipped(self):
+        loop = asyncio.get_event_loop()
+        with PipeQueue(self.path) as pq:
+            pq.put_nowait((datetime.datetime(2014, 1, 1),))
+            pq.put_nowait("S")
+            with self.assertLogs("cloudhands.common.pipes", "ERROR"):
+                rv = loop.run_until_complete(pq.get_many(10, timeout=2))
+            self.assertEqual(["S"], rv)
+
+            pq.put_nowait("T")
+            rv = loop.run_until_complete(
+                asyncio.wait_for(pq.get(), 2))
+            self.assertEqual("T", rv)
+
+    def test_get_many_timeout(self):
+        loop = asyncio.get_event_loop()
+        with PipeQueue(self.path) as pq:
+            rv = loop.run_until_complete(pq.get_many(10, timeout=0.05))
+            self.assertEqual([], rv)
+
+            loop.call_later(0.05, pq.put_nowait, "S")
+            rv = loop.run_until_complete(pq.get_many(10, timeout=2))
+            self.assertEqual(["S"], rv)
+
     def test_queue_returned_by_factory(self):
 
         def factory():
@@ -80,3 +131,340 @@ class PipeQueueTest(unittest.TestCase):
             asyncio.wait_for(pq.get(), 2))
         self.assertEqual("S", rv)
         pq.close()
+
+
+class CodecTest(unittest.TestCase):
+
+    payloads = [
+        "S", (12, "string"), ("job", "0" * 32, [1, 2.5, None]),
+        {"a": (1, 2)}, "line\nbreak"]
+
+    def test_round_trip_in_fragments(self):
+        for codec in (
+            LiteralCodec(), MarshalCodec(), PickleCodec(), ChunkedCodec()
+        ):
+            with self.subTest(codec=type(codec).__name__):
+                data = b"".join(codec.encode(i) for i in self.payloads)
+                buf = bytearray()
+                rv = []
+                for i in range(0, len(data), 7):
+                    buf.extend(data[i:i + 7])
+                    rv.extend(codec.decode(buf))
+                self.assertEqual(self.payloads, rv)
+                self.assertFalse(buf)
+
+    def test_partial_frame_kept(self):
+        codec = MarshalCodec()
+        data = codec.encode((1, 2))
+        buf = bytearray(data[:-1])
+        self.assertEqual([], codec.decode(buf))
+        self.assertEqual(len(data) - 1, len(buf))
+
+    def test_chunks_fit_pipe_buf(self):
+        codec = ChunkedCodec(size=512)
+        frames = codec.frames(("big", "x" * 5000))
+        self.assertGreater(len(frames), 1)
+        self.assertTrue(all(len(i) <= 512 for i in frames))
+        self.assertEqual(1, codec.seq)
+
+    def test_interleaved_producers(self):
+        a, b, reader = ChunkedCodec(), ChunkedCodec(), ChunkedCodec()
+        msgA = ("a", "x" * 20000)
+        msgB = ("b", "y" * 9000)
+        framesA, framesB = a.frames(msgA), b.frames(msgB)
+        self.assertNotEqual(a.producer, b.producer)
+
+        buf = bytearray()
+        rv = []
+        for n in range(max(len(framesA), len(framesB))):
+            for frames in (framesA, framesB):
+                if n < len(frames):
+                    buf.extend(frames[n])
+                    rv.extend(reader.decode(buf))
+        self.assertEqual([msgB, msgA], rv)
+        self.assertFalse(reader.partial)
+
+    def test_incomplete_message_dropped(self):
+        writer, reader = ChunkedCodec(size=128), ChunkedCodec(size=128)
+        frames = writer.frames("x" * 1000)
+        buf = bytearray(frames[0])
+        buf.extend(writer.encode("next"))
+        with self.assertLogs("cloudhands.common.pipes"):
+            self.assertEqual(["next"], reader.decode(buf))
+
+    def test_undecodable_message_skipped(self):
+        for codec in (
+            LiteralCodec(), MarshalCodec(), PickleCodec(), ChunkedCodec()
+        ):
+            with self.subTest(codec=type(codec).__name__):
+                bad = codec.encode("S")
+                bad = bad[:-3] + b"\xff" + bad[-2:]
+                buf = bytearray(codec.encode("first") + bad)
+                buf.extend(codec.encode("last"))
+                with self.assertLogs("cloudhands.common.pipes", "ERROR"):
+                    self.assertEqual(["first", "last"], codec.decode(buf))
+                self.assertFalse(buf)
+
+    def test_literal_format_unchanged(self):
+        self.assertEqual(b"(12, 'string')\n", LiteralCodec().encode(
+            (12, "string")))
+
+
+class CodecQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = "test.fifo"
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def tearDown(self):
+        self.setUp()
+
+    def test_codecs_through_queue(self):
+        loop = asyncio.get_event_loop()
+        for name in codecs:
+            with self.subTest(codec=name):
+                with PipeQueue(self.path, codec=name) as pq:
+                    for payload in CodecTest.payloads:
+                        loop.run_until_complete(
+                            asyncio.wait_for(pq.put(payload), 2))
+                    for payload in CodecTest.payloads:
+                        rv = loop.run_until_complete(
+                            asyncio.wait_for(pq.get(), 2))
+                        self.assertEqual(payload, rv)
+
+    def test_simple_queue(self):
+        with SimplePipeQueue(self.path, codec="marshal") as pq:
+            pq.put_nowait((1, "a"))
+            pq.put_nowait((2, "b"))
+            self.assertEqual((1, "a"), pq.get())
+            self.assertEqual((2, "b"), pq.get())
+
+
+def produce(path, n, size, cls=SimplePipeQueue, codec="chunked"):
+    with cls(path, codec=codec, readable=False) as pq:
+        for i in range(n):
+            pq.put_nowait((os.getpid(), i, "z" * (size if i % 2 else 10)))
+
+
+class MultiProducerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = "test.fifo"
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def tearDown(self):
+        self.setUp()
+
+    def test_concurrent_producers(self):
+        n = 20
+        with SimplePipeQueue(self.path, codec="chunked") as pq:
+            procs = [
+                multiprocessing.Process(
+                    target=produce, args=(self.path, n, 30000))
+                for i in range(3)]
+            for p in procs:
+                p.start()
+
+            rv = {}
+            for i in range(3 * n):
+                pid, seq, payload = pq.get()
+                rv.setdefault(pid, []).append(seq)
+                self.assertEqual(30000 if seq % 2 else 10, len(payload))
+
+            for p in procs:
+                p.join()
+
+        self.assertEqual(3, len(rv))
+        self.assertTrue(all(i == list(range(n)) for i in rv.values()))
+
+
+class BackpressureTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = "test.fifo"
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def tearDown(self):
+        self.setUp()
+
+    def test_slow_consumer_suspends_writer_only(self):
+        loop = asyncio.get_event_loop()
+        events = []
+        ticks = []
+        payloads = [(i, "x" * 4096) for i in range(200)]
+
+        with PipeQueue(
+            self.path, codec="marshal", maxsize=8,
+            on_high=lambda q: events.append("high"),
+            on_low=lambda q: events.append("low")
+        ) as pq:
+
+            async def producer():
+                for payload in payloads:
+                    await pq.put(payload)
+
+            async def ticker():
+                while len(ticks) < 10:
+                    ticks.append(pq._writing)
+                    await asyncio.sleep(0.005)
+
+            async def consumer():
+                await asyncio.sleep(0.1)
+                rv = []
+                for i in payloads:
+                    msg = await pq.get()
+                    rv.append(msg)
+                return rv
+
+            rv = loop.run_until_complete(asyncio.wait_for(
+                asyncio.gather(producer(), ticker(), consumer()), 5))
+
+        self.assertEqual(payloads, rv[2])
+        self.assertEqual(10, len(ticks))
+        self.assertTrue(any(ticks))
+        self.assertEqual("high", events[0])
+        self.assertIn("low", events)
+        self.assertFalse(pq._waiters)
+
+    def test_maxsize_caps_queue(self):
+        loop = asyncio.get_event_loop()
+        held = []
+        for high_water in (None, 50):
+            with self.subTest(high_water=high_water), PipeQueue(
+                self.path, maxsize=10, high_water=high_water,
+                on_high=lambda q: held.append(q._q.qsize())
+            ) as pq:
+                for i in range(2000):
+                    pq.put_nowait(i)
+                loop.run_until_complete(asyncio.sleep(0.01))
+                self.assertEqual(10, pq._q.qsize())
+                self.assertTrue(pq._paused)
+
+                rv = []
+                while len(rv) < 2000:
+                    rv.extend(loop.run_until_complete(
+                        pq.get_many(100, timeout=2)))
+                    self.assertLessEqual(pq._q.qsize(), 10)
+                self.assertEqual(list(range(2000)), rv)
+        self.assertTrue(held)
+        self.assertTrue(all(i <= 10 for i in held))
+
+    def test_close_writes_buffer(self):
+        payloads = [(i, "x" * 4096) for i in range(100)]
+        rv = []
+        with SimplePipeQueue(self.path, codec="marshal") as reader:
+            consumer = threading.Thread(
+                target=lambda: rv.extend(reader.get() for i in payloads))
+            with PipeQueue(
+                self.path, codec="marshal", readable=False
+            ) as pq:
+                for payload in payloads:
+                    pq.put_nowait(payload)
+                self.assertTrue(pq._outbox)
+                consumer.start()
+            consumer.join(5)
+        self.assertEqual(payloads, rv)
+
+    def test_put_nowait_never_blocks(self):
+        with PipeQueue(self.path, codec="marshal", maxsize=1) as pq:
+            for i in range(100):
+                pq.put_nowait((i, "x" * 4096))
+            self.assertTrue(pq._writing)
+            self.assertTrue(pq._outbox)
+
+
+class TransportTest(unittest.TestCase):
+
+    transports = [
+        (SimpleSocketQueue, SocketQueue, "test.sock"),
+        (SimpleRingQueue, RingQueue, "test.ring"),
+    ]
+
+    def setUp(self):
+        self.path = "test.sock"
+        for path in ("test.sock", "test.ring", "test.ring.lock"):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def tearDown(self):
+        self.setUp()
+
+    def test_codecs_through_queue(self):
+        loop = asyncio.get_event_loop()
+        for simple, cls, path in self.transports:
+            for name in codecs:
+                with self.subTest(transport=cls.__name__, codec=name):
+                    with cls(path, codec=name) as pq:
+                        for payload in CodecTest.payloads:
+                            loop.run_until_complete(
+                                asyncio.wait_for(pq.put(payload), 2))
+                        for payload in CodecTest.payloads:
+                            rv = loop.run_until_complete(
+                                asyncio.wait_for(pq.get(), 2))
+                            self.assertEqual(payload, rv)
+
+    def test_simple_queue(self):
+        for simple, cls, path in self.transports:
+            with self.subTest(transport=simple.__name__):
+                with simple(path, codec="marshal") as pq:
+                    pq.put_nowait((1, "a"))
+                    pq.put_nowait((2, "b"))
+                    self.assertEqual((1, "a"), pq.get())
+                    self.assertEqual((2, "b"), pq.get())
+
+    def test_socket_no_history(self):
+        with SimpleSocketQueue(self.path):
+            self.assertRaises(
+                FileExistsError,
+                SimpleSocketQueue(self.path, history=False).__enter__)
+
+    def test_concurrent_producers(self):
+        n = 20
+        for simple, cls, path in self.transports:
+            with self.subTest(transport=simple.__name__):
+                with simple(path, codec="marshal") as pq:
+                    procs = [
+                        multiprocessing.Process(
+                            target=produce,
+                            args=(path, n, 30000, simple, "marshal"))
+                        for i in range(3)]
+                    for p in procs:
+                        p.start()
+
+                    rv = {}
+                    for i in range(3 * n):
+                        pid, seq, payload = pq.get()
+                        rv.setdefault(pid, []).append(seq)
+                        self.assertEqual(
+                            30000 if seq % 2 else 10, len(payload))
+
+                    for p in procs:
+                        p.join()
+
+                self.assertEqual(3, len(rv))
+                self.assertTrue(
+                    all(i == list(range(n)) for i in rv.values()))
+
+    def test_full_ring_suspends_writer(self):
+        loop = asyncio.get_event_loop()
+        payloads = [(i, "x" * 1000) for i in range(50)]
+        with RingQueue("test.ring", codec="marshal", size=4096) as pq:
+            for payload in payloads:
+                pq.put_nowait(payload)
+            self.assertTrue(pq._writing)
+
+            rv = loop.run_until_complete(asyncio.wait_for(
+                asyncio.gather(*(pq.get() for i in payloads)), 5))
+            self.assertEqual(payloads, rv)
+            self.assertFalse(pq._outbox)
@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+#   encoding: UTF-8
+
+import datetime
+import ipaddress
+import sqlite3
+import unittest
+import uuid
+
+from sqlalchemy import event
+import sqlalchemy.exc
+
+import cloudhands.common
+from cloudhands.common.connectors import create_schema
+from cloudhands.common.connectors import fingerprints
+from cloudhands.common.connectors import initialise
+from cloudhands.common.connectors import Registry
+
+from cloudhands.common.queries import by_uuid
+from cloudhands.common.queries import by_uuids
+from cloudhands.common.queries import current_state
+from cloudhands.common.queries import in_network
+from cloudhands.common.queries import in_range
+from cloudhands.common.queries import in_state
+from cloudhands.common.queries import latest_touches
+from cloudhands.common.queries import resource_bundles
+
+from cloudhands.common.schema import Appliance
+from cloudhands.common.schema import Component
+from cloudhands.common.schema import CurrentState
+from cloudhands.common.schema import IPAddress
+from cloudhands.common.schema import Label
+from cloudhands.common.schema import NATRouting
+from cloudhands.common.schema import Node
+from cloudhands.common.schema import Organisation
+from cloudhands.common.schema import Provider
+from cloudhands.common.schema import ProviderReport
+from cloudhands.common.schema import Touch
+from cloudhands.common.schema import User
+from cloudhands.common.schema import rebuild_current_states
+
+from cloudhands.common.states import ApplianceState
+
+
+class CurrentStateTests(unittest.TestCase):
+
+    def setUp(self):
+        """ Populate test database"""
+        session = Registry().connect(sqlite3, ":memory:").session
+        initialise(session)
+        session.add_all((
+            Organisation(uuid=uuid.uuid4().hex, name="TestOrg"),
+            User(handle="Anon", uuid=uuid.uuid4().hex),
+        ))
+        session.commit()
+
+    def tearDown(self):
+        """ Every test gets its own in-memory database """
+        r = Registry()
+        r.disconnect(sqlite3, ":memory:")
+
+    def state(self, session, name):
+        return session.query(ApplianceState).filter(
+            ApplianceState.name == name).one()
+
+    def appliance(self, session, *names):
+        user = session.query(User).one()
+        org = session.query(Organisation).one()
+        app = Appliance(
+            uuid=uuid.uuid4().hex,
+            model=cloudhands.common.__version__,
+            organisation=org)
+        now = datetime.datetime.utcnow()
+        for n, name in enumerate(names):
+            session.add(Touch(
+                artifact=app, actor=user, state=self.state(session, name),
+                at=now + datetime.timedelta(seconds=n)))
+        session.commit()
+        return app
+
+    def test_projection_follows_inserts(self):
+        session = Registry().connect(sqlite3, ":memory:").session
+        app = self.appliance(session, "requested", "configuring")
+        self.assertEqual(1, session.query(CurrentState).count())
+        self.assertIs(
+            self.state(session, "configuring"), current_state(session, app))
+        self.assertIs(app.changes[-1], app.current.touch)
+
+    def test_out_of_order_touch_is_ignored(self):
+        session = Registry().connect(sqlite3, ":memory:").session
+        app = self.appliance(session, "requested", "configuring")
+        then = app.changes[0].at - datetime.timedelta(hours=1)
+        session.add(Touch(
+            artifact=app, actor=session.query(User).one(),
+            state=self.state(session, "deleted"), at=then))
+        session.commit()
+        self.assertIs(
+            self.state(session, "configuring"), current_state(session, app))
+
+    def test_deleting_latest_touch_restores_previous(self):
+        session = Registry().connect(sqlite3, ":memory:").session
+        app = self.appliance(session, "requested", "configuring")
+        session.delete(app.changes[-1])
+        session.commit()
+        self.assertIs(
+            self.state(session, "requested"), current_state(session, app))
+
+        session.delete(app.changes[-1])
+        session.commit()
+        self.assertIs(None, current_state(session, app))
+        self.assertEqual(0, session.query(CurrentState).count())
+
+    def test_in_state(self):
+        session = Registry().connect(sqlite3, ":memory:").session
+        one = self.appliance(session, "requested", "pre_provision")
+        two = self.appliance(session, "pre_provision", "provisioning")
+        three = self.appliance(session, "pre_provision")
+
+        preprovision = self.state(session, "pre_provision")
+        provisioning = self.state(session, "provisioning")
+        self.assertEqual(
+            {one, three}, set(in_state(session, Appliance, preprovision)))
+        self.assertEqual(
+            {one, two, three},
+            set(in_state(session, Appliance, preprovision, provisioning)))
+
+        jobs = [(t.actor, t.artifact) for t in latest_touches(
+            session, Appliance) if t.state is preprovision]
+        self.assertEqual(2, len(jobs))
+
+    def test_rebuild(self):
+        session = Registry().connect(sqlite3, ":memory:").session
+        self.appliance(session, "requested", "pre_provision")
+        self.appliance(session, "pre_provision", "provisioning")
+        before = [tuple(i) for i in session.execute(
+            CurrentState.__table__.select().order_by("artifact_id"))]
+        session.query(CurrentState).delete()
+
+        self.assertEqual(2, rebuild_current_states(session.connection()))
+        after = [tuple(i) for i in session.execute(
+            CurrentState.__table__.select().order_by("artifact_id"))]
+        self.assertEqual(before, after)
+
+    def test_new_projection_is_built_from_history(self):
+        con = Registry().connect(sqlite3, ":memory:")
+        self.appliance(con.session, "requested", "pre_provision")
+        self.appliance(con.session, "pre_provision", "provisioning")
+        con.session.close()
+        con.engine.execute("drop table currentstates")
+        con.engine.execute(
+            fingerprints.update().values(fingerprint="0" * 40))
+
+        self.assertTrue(create_schema(con.engine))
+        preprovision = self.state(con.session, "pre_provision")
+        self.assertEqual(
+            1, in_state(con.session, Appliance, preprovision).count())
+        self.assertEqual(2, con.session.query(CurrentState).count())
+
+
+class ResourceBundleTests(unittest.TestCase):
+
+    def setUp(self):
+        """ Populate test database"""
+        session = Registry().connect(sqlite3, ":memory:").session
+        initialise(session)
+        user = User(handle="Anon", uuid=uuid.uuid4().hex)
+        org = Organisation(uuid=uuid.uuid4().hex, name="TestOrg")
+        running = session.query(ApplianceState).filter(
+            ApplianceState.name == "running").one()
+        now = datetime.datetime.utcnow()
+        net = ipaddress.ip_network("172.16.144.0/28").hosts()
+        for n in range(4):
+            app = Appliance(
+                uuid=uuid.uuid4().hex,
+                model=cloudhands.common.__version__,
+                organisation=org)
+            name = "server{:02}".format(n)
+            configured = Touch(
+                artifact=app, actor=user, state=running, at=now)
+            provisioned = Touch(
+                artifact=app, actor=user, state=running,
+                at=now + datetime.timedelta(seconds=1))
+            session.add_all((
+                Label(name=name, touch=configured),
+                Node(name=name, touch=provisioned),
+                IPAddress(value=str(next(net)), touch=provisioned),
+                ProviderReport(power="on", touch=provisioned),
+            ))
+        session.commit()
+
+    def tearDown(self):
+        """ Every test gets its own in-memory database """
+        r = Registry()
+        r.disconnect(sqlite3, ":memory:")
+
+    def test_bounded_queries_for_artifacts(self):
+        con = Registry().connect(sqlite3, ":memory:")
+        session = con.session
+        apps = session.query(Appliance).all()
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(con.engine, "before_cursor_execute", count)
+        try:
+            bundles = resource_bundles(session, apps)
+            self.assertEqual(6, len(statements))
+            self.assertEqual(8, len(bundles))
+            for touch, bundle in bundles.items():
+                if Label in bundle:
+                    self.assertEqual([Label], list(bundle))
+                else:
+                    self.assertEqual(
+                        {Node, IPAddress, ProviderReport}, set(bundle))
+                self.assertEqual(
+                    sum(len(i) for i in bundle.values()),
+                    len(touch.resources))
+                for resource in touch.resources:
+                    self.assertIs(touch, resource.touch)
+            self.assertEqual(6, len(statements))
+        finally:
+            event.remove(con.engine, "before_cursor_execute", count)
+
+    def test_touches_without_resources(self):
+        session = Registry().connect(sqlite3, ":memory:").session
+        app = session.query(Appliance).first()
+        touch = Touch(
+            artifact=app, actor=app.changes[0].actor,
+            state=app.changes[0].state, at=datetime.datetime.utcnow())
+        session.add(touch)
+        session.commit()
+
+        bundles = resource_bundles(session, [touch])
+        self.assertEqual({touch: {}}, bundles)
+        self.assertEqual([], touch.resources)
+
+
+class UUIDLookupTests(unittest.TestCase):
+
+    def setUp(self):
+        """ Populate test database"""
+        session = Registry().connect(sqlite3, ":memory:").session
+        initialise(session)
+        org = Organisation(uuid=uuid.uuid4().hex, name="TestOrg")
+        session.add_all([
+            Appliance(
+                uuid=uuid.uuid4().hex,
+                model=cloudhands.common.__version__,
+                organisation=org) for i in range(3)])
+        session.add(Provider(uuid=uuid.uuid4().hex, name="testcloud.io"))
+        session.commit()
+
+    def tearDown(self):
+        """ Every test gets its own in-memory database """
+        r = Registry()
+        r.disconnect(sqlite3, ":memory:")
+
+    def test_lookup_across_classes(self):
+        session = Registry().connect(sqlite3, ":memory:").session
+        app = session.query(Appliance).first()
+        actor = session.query(Component).first()
+        provider = session.query(Provider).one()
+
+        self.assertIs(app, by_uuid(session, app.uuid))
+        self.assertIs(app, by_uuid(session, uuid.UUID(app.uuid)))
+        self.assertIs(app, by_uuid(session, str(uuid.UUID(app.uuid))))
+        self.assertIs(app, by_uuid(session, app.uuid, Appliance))
+        self.assertIs(actor, by_uuid(session, actor.uuid))
+        self.assertIs(provider, by_uuid(session, provider.uuid))
+        self.assertIs(None, by_uuid(session, app.uuid, Provider))
+        self.assertIs(None, by_uuid(session, uuid.uuid4()))
+        self.assertRaises(ValueError, by_uuid, session, "not a uuid")
+
+    def test_lookup_many(self):
+        session = Registry().connect(sqlite3, ":memory:").session
+        apps = session.query(Appliance).all()
+        values = [i.uuid for i in apps[:2]] + [uuid.uuid4().hex]
+        self.assertEqual(
+            {i.uuid: i for i in apps[:2]},
+            by_uuids(session, Appliance, values))
+
+    def test_artifact_uuids_are_unique(self):
+        session = Registry().connect(sqlite3, ":memory:").session
+        app = session.query(Appliance).first()
+        session.add(Appliance(
+            uuid=app.uuid,
+            model=cloudhands.common.__version__,
+            organisation=app.organisation))
+        self.assertRaises(sqlalchemy.exc.IntegrityError, session.commit)
+
+
+class IPAddressQueryTests(unittest.TestCase):
+
+    def setUp(self):
+        """ Populate test database"""
+        session = Registry().connect(sqlite3, ":memory:").session
+        session.add_all(
+            IPAddress(value=str(ip))
+            for net in ("192.168.1.0/28", "192.168.2.0/28", "2001:db8::/124")
+            for ip in ipaddress.ip_network(net).hosts())
+        session.add_all(
+            NATRouting(
+                ip_int="10.0.0.{}".format(n),
+                ip_ext="130.246.{}.{}".format(n // 8, n))
+            for n in range(1, 32))
+        session.add(IPAddress(value="unallocated"))
+        session.commit()
+
+    def tearDown(self):
+        """ Every test gets its own in-memory database """
+        r = Registry()
+        r.disconnect(sqlite3, ":memory:")
+
+    def test_packed_value_follows_string(self):
+        session = Registry().connect(sqlite3, ":memory:").session
+        ip = session.query(IPAddress).filter(
+            IPAddress.value == "192.168.2.9").one()
+        self.assertEqual(ipaddress.ip_address("192.168.2.9"), ip.packed)
+        ip.value = "2001:db8::ff"
+        session.commit()
+        self.assertEqual(ipaddress.ip_address("2001:db8::ff"), ip.packed)
+
+        self.assertIs(None, session.query(IPAddress).filter(
+            IPAddress.value == "unallocated").one().packed)
+
+    def test_cidr_containment(self):
+        session = Registry().connect(sqlite3, ":memory:").session
+        rv = in_network(session, IPAddress.packed, "192.168.2.0/24").all()
+        self.assertEqual(
+            ["192.168.2.{}".format(n) for n in range(1, 15)],
+            [i.value for i in rv])
+        self.assertEqual(
+            15, in_network(session, IPAddress.packed, "2001:db8::/64").count())
+        self.assertEqual(
+            0, in_network(session, IPAddress.packed, "10.0.0.0/8").count())
+
+    def test_nat_range_scans(self):
+        session = Registry().connect(sqlite3, ":memory:").session
+        rv = in_range(
+            session, NATRouting.ip_int_packed, "10.0.0.9", "10.0.0.11").all()
+        self.assertEqual(
+            ["10.0.0.9", "10.0.0.10", "10.0.0.11"], [i.ip_int for i in rv])
+        rv = in_network(session, NATRouting.ip_ext_packed, "130.246.1.0/24")
+        self.assertEqual(
+            ["130.246.1.{}".format(n) for n in range(8, 16)],
+            [i.ip_ext for i in rv])
@@ -7,10 +7,13 @@ import sqlite3
 import unittest
 import uuid
 
+from sqlalchemy.orm.exc import NoResultFound
+
 import cloudhands.common
 
 from cloudhands.common.connectors import initialise
 from cloudhands.common.connectors import Registry
+from cloudhands.common.factories import registration
 
 from cloudhands.common.schema import BcryptedPassword
 from cloudhands.common.schema import Registration
@@ -90,3 +93,23 @@ class RegistrationTests(unittest.TestCase):
                 Touch.at > then).first(),
             reg.changes[0])
 
+
+    def test_factory_refuses_duplicate_email(self):
+        session = Registry().connect(sqlite3, ":memory:").session
+        user = User(handle=None, uuid=uuid.uuid4().hex)
+        reg = registration(
+            session, user, "someone@example.com",
+            cloudhands.common.__version__)
+        self.assertIsInstance(reg, Registration)
+        self.assertIs(None, registration(
+            session, user, "someone@example.com",
+            cloudhands.common.__version__))
+        self.assertEqual(1, session.query(Registration).count())
+
+    def test_factory_needs_states(self):
+        session = Registry().connect(sqlite3, ":memory:").session
+        session.query(State).delete()
+        session.commit()
+        self.assertRaises(
+            NoResultFound, registration, session, None,
+            "someone@example.com", cloudhands.common.__version__)
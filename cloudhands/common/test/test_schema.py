@@ -10,6 +10,7 @@ import unittest
 import uuid
 
 import sqlalchemy.exc
+import sqlalchemy.orm.exc
 
 from cloudhands.common.connectors import initialise
 from cloudhands.common.connectors import Registry
@@ -411,6 +412,136 @@ class TestApplianceAndResources(unittest.TestCase):
         self.assertIn(ip, resources)
 
 
+class TestArtifactHistory(unittest.TestCase):
+
+    def setUp(self):
+        """ Populate test database"""
+        session = Registry().connect(sqlite3, ":memory:").session
+        initialise(session)
+        session.add_all((
+            Organisation(uuid=uuid.uuid4().hex, name="TestOrg"),
+            User(handle="Anon", uuid=uuid.uuid4().hex),
+        ))
+        session.commit()
+
+    def tearDown(self):
+        """ Every test gets its own in-memory database """
+        r = Registry()
+        r.disconnect(sqlite3, ":memory:")
+
+    def test_history_of_long_lived_appliance(self):
+        session = Registry().connect(sqlite3, ":memory:").session
+        user = session.query(User).one()
+        org = session.query(Organisation).one()
+        running = session.query(ApplianceState).filter(
+            ApplianceState.name == "running").one()
+        app = Appliance(
+            uuid=uuid.uuid4().hex,
+            model=cloudhands.common.__version__,
+            organisation=org)
+
+        start = datetime.datetime.utcnow()
+        self.assertIs(None, app.latest_touch())
+        self.assertEqual([], app.latest_resources())
+        self.assertEqual([], app.recent_touches(0))
+        self.assertRaises(
+            sqlalchemy.orm.exc.NoResultFound, app.touches_since, 1)
+
+        touches = [
+            Touch(artifact=app, actor=user, state=running,
+                  at=start + datetime.timedelta(minutes=i))
+            for i in range(20)]
+        session.add_all(touches)
+        session.commit()
+
+        self.assertIs(touches[-1], app.latest_touch())
+        self.assertEqual(touches[-3:], app.recent_touches(3))
+        self.assertEqual(touches[15:], app.touches_since(touches[14]))
+        self.assertEqual(touches[15:], app.touches_since(touches[14].id))
+        self.assertEqual(
+            touches[16:], app.touches_since(touches[15].at))
+        self.assertEqual([], app.recent_touches(0))
+        self.assertRaises(
+            sqlalchemy.orm.exc.NoResultFound,
+            app.touches_since, touches[-1].id + 1)
+
+        now = start + datetime.timedelta(hours=1)
+        act = Touch(artifact=app, actor=user, state=running, at=now)
+        node = Node(name="test_server01", touch=act)
+        ip = IPAddress(value="192.168.1.4", touch=act)
+        session.add_all((node, ip))
+        session.commit()
+
+        self.assertIs(act, app.latest_touch())
+        self.assertEqual([ip], app.latest_resources(IPAddress))
+        self.assertEqual({node, ip}, set(app.latest_resources()))
+        self.assertEqual([act], app.touches_since(touches[-1]))
+
+
+class TestStateCache(unittest.TestCase):
+
+    def setUp(self):
+        """ Populate test database"""
+        session = Registry().connect(sqlite3, ":memory:").session
+        initialise(session)
+
+    def tearDown(self):
+        """ Every test gets its own in-memory database """
+        r = Registry()
+        r.disconnect(sqlite3, ":memory:")
+
+    def test_cached_state_is_persistent_in_each_session(self):
+        con = Registry().connect(sqlite3, ":memory:")
+        one = con.session
+        two = Registry().connect(sqlite3, ":memory:").session
+        operational = one.query(ApplianceState).filter(
+            ApplianceState.name == "operational").one()
+
+        self.assertIs(operational, ApplianceState.get(one, "operational"))
+        self.assertEqual(
+            operational.id, ApplianceState.get_id(two, "operational"))
+
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        sqlalchemy.event.listen(con.engine, "before_cursor_execute", count)
+        try:
+            state = ApplianceState.get(two, "operational")
+            self.assertIn(state, two)
+            self.assertIsNot(operational, state)
+            self.assertEqual(operational.id, state.id)
+            self.assertEqual("appliance", state.fsm)
+            self.assertIs(state, ApplianceState.get(two, "operational"))
+            self.assertEqual([], statements)
+        finally:
+            sqlalchemy.event.remove(
+                con.engine, "before_cursor_execute", count)
+
+    def test_state_names_are_cached_per_fsm(self):
+        session = Registry().connect(sqlite3, ":memory:").session
+        self.assertNotEqual(
+            AccessState.get_id(session, "active"),
+            MembershipState.get_id(session, "active"))
+        self.assertRaises(
+            sqlalchemy.orm.exc.NoResultFound,
+            ApplianceState.get, session, "undefined")
+
+    def test_cached_state_in_touch(self):
+        session = Registry().connect(sqlite3, ":memory:").session
+        user = User(handle="Anon", uuid=uuid.uuid4().hex)
+        reg = Registration(
+            uuid=uuid.uuid4().hex,
+            model=cloudhands.common.__version__)
+        valid = RegistrationState.get(session, "valid")
+        session.add(Touch(
+            artifact=reg, actor=user, state=valid,
+            at=datetime.datetime.utcnow()))
+        session.commit()
+        self.assertIs(valid, reg.changes[-1].state)
+
+
 class TestAccessAndGroups(unittest.TestCase):
 
     def setUp(self):
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+#   encoding: UTF-8
+
+import datetime
+import os.path
+import tempfile
+import unittest
+import uuid
+
+from sqlalchemy.orm import joinedload
+
+import cloudhands.common
+from cloudhands.common.connectors import Registry
+from cloudhands.common.schema import Appliance
+from cloudhands.common.schema import CatalogueItem
+from cloudhands.common.schema import Component
+from cloudhands.common.schema import Organisation
+from cloudhands.common.schema import Provider
+from cloudhands.common.schema import Touch
+from cloudhands.common.sharding import Shards
+from cloudhands.common.sharding import copy
+from cloudhands.common.sharding import shard_key
+from cloudhands.common.states import ApplianceState
+
+
+class ShardTests(unittest.TestCase):
+
+    def setUp(self):
+        self.locn = tempfile.TemporaryDirectory()
+        self.urls = [
+            "sqlite:///" + os.path.join(self.locn.name, "{}.sl3".format(i))
+            for i in range(3)]
+        self.shards = Shards(*self.urls)
+        self.shards.initialise()
+
+    def tearDown(self):
+        r = Registry()
+        for url in self.urls:
+            r.disconnect(url)
+        self.locn.cleanup()
+
+    def test_shard_key(self):
+        val = uuid.uuid4()
+        self.assertEqual(val.int, shard_key(val))
+        self.assertEqual(val.int, shard_key(val.hex))
+        self.assertEqual(val.int, shard_key(str(val)))
+        self.assertEqual(
+            val.int, shard_key(Organisation(uuid=val.hex, name="")))
+
+    def test_copy_omits_keys(self):
+        org = Organisation(id=7, uuid=uuid.uuid4().hex, name="TestOrg")
+        rv = copy(org)
+        self.assertIsNone(rv.id)
+        self.assertEqual(org.uuid, rv.uuid)
+        self.assertEqual(org.name, rv.name)
+
+    def test_reference_data_on_every_shard(self):
+        org = Organisation(uuid=uuid.uuid4().hex, name="TestOrg")
+        provider = Provider(uuid=uuid.uuid4().hex, name="testcloud.io")
+        rv = self.shards.replicate(org, provider)
+        self.assertEqual(3, len(rv))
+        self.assertTrue(all(i[0].uuid == org.uuid for i in rv))
+
+        self.shards.replicate(org)
+        counts = self.shards.map(lambda s: s.query(Organisation).count())
+        self.assertEqual([1, 1, 1], counts)
+        counts = self.shards.map(lambda s: s.query(Component).count())
+        self.assertEqual([2, 2, 2], counts)
+
+    def test_components_share_identity(self):
+        rv = self.shards.map(lambda s: sorted(
+            (i.handle, i.uuid) for i in s.query(Component)))
+        self.assertEqual(2, len(rv[0]))
+        self.assertEqual([rv[0]] * 3, rv)
+        self.assertEqual(0, self.shards.initialise())
+
+    def test_links_resolved_by_uuid(self):
+        org = Organisation(uuid=uuid.uuid4().hex, name="TestOrg")
+        item = CatalogueItem(
+            uuid=uuid.uuid4().hex, name="nano", description="",
+            natrouted=False, organisation=org)
+        rv = self.shards.replicate(org, item)
+        for held_org, held_item in rv:
+            self.assertIs(held_org, held_item.organisation)
+        counts = self.shards.map(lambda s: s.query(CatalogueItem).filter(
+            CatalogueItem.organisation_id != None).count())
+        self.assertEqual([1, 1, 1], counts)
+
+    def test_unresolved_link_rejected(self):
+        org = Organisation(uuid=uuid.uuid4().hex, name="TestOrg")
+        item = CatalogueItem(
+            uuid=uuid.uuid4().hex, name="nano", description="",
+            natrouted=False, organisation=org)
+        self.assertRaises(ValueError, self.shards.replicate, item)
+        self.assertRaises(ValueError, copy, item)
+        self.assertRaises(
+            ValueError, copy, CatalogueItem(
+                uuid=uuid.uuid4().hex, name="nano", description="",
+                natrouted=False, organisation_id=7))
+
+    def test_artifacts_routed_by_uuid(self):
+        org = Organisation(uuid=uuid.uuid4().hex, name="TestOrg")
+        self.shards.replicate(org)
+
+        uuids = [uuid.uuid4().hex for i in range(12)]
+        for n, val in enumerate(uuids):
+            session = self.shards.session(val)
+            actor = session.query(Component).first()
+            app = Appliance(
+                uuid=val, model=cloudhands.common.__version__,
+                organisation=session.query(Organisation).one())
+            session.add(Touch(
+                artifact=app, actor=actor,
+                state=ApplianceState.get(session, "requested"),
+                at=datetime.datetime(2014, 1, 1, 0, n)))
+            session.commit()
+
+        counts = self.shards.map(lambda s: s.query(Appliance).count())
+        self.assertEqual(12, sum(counts))
+        for val in uuids:
+            self.assertEqual(
+                [1 if i == self.shards.index(val) else 0 for i in range(3)],
+                self.shards.map(lambda s: s.query(Appliance).filter(
+                    Appliance.uuid == val).count()))
+            self.assertEqual(val, self.shards.artifact(val).uuid)
+
+        touches = self.shards.query(
+            lambda s: s.query(Touch).options(
+                joinedload(Touch.artifact)).order_by(Touch.at),
+            key=lambda x: x.at)
+        self.assertEqual(12, len(touches))
+        self.assertEqual(sorted(i.at for i in touches),
+                         [i.at for i in touches])
+        self.assertEqual(uuids, [i.artifact.uuid for i in touches])
@@ -2,7 +2,15 @@
 # encoding: UTF-8
 
 import unittest
+import uuid
 
+import sqlalchemy
+from sqlalchemy import Column
+from sqlalchemy import Integer
+from sqlalchemy import MetaData
+from sqlalchemy.schema import Table
+
+from cloudhands.common.types import BinaryUUID
 from cloudhands.common.types import NamedDict
 from cloudhands.common.types import NamedList
 
@@ -24,3 +32,34 @@ class TestNamedList(unittest.TestCase):
         self.assertEqual(2, d[1])
         self.assertEqual(2, len(d))
         self.assertEqual("testname", d.name)
+
+
+class TestBinaryUUID(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = sqlalchemy.create_engine("sqlite://")
+        self.table = Table(
+            "things", MetaData(),
+            Column("id", Integer, primary_key=True),
+            Column("uuid", BinaryUUID, nullable=True, unique=True))
+        self.table.create(self.engine)
+
+    def test_hex_round_trip(self):
+        value = uuid.uuid4()
+        self.engine.execute(self.table.insert(), [
+            {"uuid": value.hex}, {"uuid": str(uuid.uuid4())},
+            {"uuid": uuid.uuid4()}, {"uuid": None}])
+
+        row = self.engine.execute(self.table.select().where(
+            self.table.c.uuid == value.hex)).first()
+        self.assertEqual(value.hex, row.uuid)
+        self.assertEqual(1, row.id)
+
+        row = self.engine.execute(self.table.select().where(
+            self.table.c.uuid == str(value))).first()
+        self.assertEqual(value.hex, row.uuid)
+
+        self.assertEqual(
+            [16, 16, 16, None],
+            [i[0] for i in self.engine.execute(
+                "select length(uuid) from things order by id")])
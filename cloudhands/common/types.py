@@ -1,6 +1,12 @@
 #!/usr/bin/env python3
 # encoding: UTF-8
 
+import ipaddress
+import uuid
+
+from sqlalchemy.types import BINARY
+from sqlalchemy.types import TypeDecorator
+
 
 def name(self, name):
     """
@@ -12,3 +18,66 @@ def name(self, name):
 
 NamedDict = type("NamedDict", (dict,), {"name": name})
 NamedList = type("NamedList", (list,), {"name": name})
+
+
+class BinaryUUID(TypeDecorator):
+    """
+    Stores a uuid in 16 bytes rather than as 32 hex characters, halving
+    the size of the column and its indexes. Values are bound from hex
+    strings (with or without hyphens) or :py:class:`uuid.UUID` objects,
+    and are always returned as 32 character hex strings. Code written for
+    `CHAR(32)` uuid columns works unchanged.
+    """
+
+    impl = BINARY(16)
+
+    def process_bind_param(self, value, dialect):
+        if value is None or isinstance(value, bytes):
+            return value
+        elif isinstance(value, uuid.UUID):
+            return value.bytes
+        else:
+            return uuid.UUID(hex=value).bytes
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        else:
+            return uuid.UUID(bytes=bytes(value)).hex
+
+
+class PackedIPAddress(TypeDecorator):
+    """
+    Stores an IPv4 or IPv6 address as 17 bytes: the version number then
+    the address as a 16 byte big-endian integer. Bytewise comparison of
+    stored values therefore orders addresses numerically, with all IPv4
+    addresses before IPv6, so ranges and networks can be found with an
+    indexed BETWEEN.
+
+    Values are bound from strings or :py:mod:`ipaddress` objects and are
+    returned as :py:mod:`ipaddress` objects.
+    """
+
+    impl = BINARY(17)
+
+    @staticmethod
+    def pack(value):
+        addr = ipaddress.ip_address(value)
+        return bytes([addr.version]) + int(addr).to_bytes(16, "big")
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        else:
+            return PackedIPAddress.pack(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        else:
+            value = bytes(value)
+            number = int.from_bytes(value[1:], "big")
+            if value[0] == 4:
+                return ipaddress.IPv4Address(number)
+            else:
+                return ipaddress.IPv6Address(number)
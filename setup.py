@@ -33,7 +33,10 @@ setup(
         "License :: OSI Approved :: BSD License"
     ],
     namespace_packages=["cloudhands"],
-    packages=["cloudhands.common", "cloudhands.common.test"],
+    packages=[
+        "cloudhands.common",
+        "cloudhands.common.bench",
+        "cloudhands.common.test"],
     package_data={
         "cloudhands.common": [],
         "cloudhands.common.test": [],
@@ -43,6 +46,7 @@ setup(
     ],
     entry_points={
         "console_scripts": [
+            "cloudhands-audit = cloudhands.common.audit:run",
         ],
         "jasmin.component.fsm": [
             "access = cloudhands.common.states:AccessState",